@@ -1,11 +1,19 @@
 import streamlit as st
-import google.generativeai as genai
-from PIL import Image
 import datetime
-from fpdf import FPDF
-import tempfile
+import time
+from pathan.router import model_router
+from pathan.cache import response_cache, response_key
+from pathan.streaming import STREAM_OUTPUT
+from pathan.imaging import prepare_upload
+from pathan.report import create_consult_pdf
+from pathan.metrics import span, start_exporter
+from pathan.resources import configure_genai
+from pathan.chat import BoundedChat
+from pathan.scheduler import model_scheduler
+from pathan.artifacts import session_artifacts
 
 st.set_page_config(page_title="PathanAI", page_icon="🔬")
+start_exporter()
 
 # --- БЕЗОПАСНОЕ ПОДКЛЮЧЕНИЕ КЛЮЧА ---
 try:
@@ -14,92 +22,28 @@ except (FileNotFoundError, KeyError):
     st.error("⚠️ Ключ API не найден! Настройте 'Secrets' в панели управления Streamlit Cloud.")
     st.stop()
 
-genai.configure(api_key=api_key)
-
-# --- ФУНКЦИЯ ГЕНЕРАЦИИ PDF ---
-def create_pdf(patient_data, analysis_text, image_obj):
-    pdf = FPDF()
-    pdf.add_page()
-    
-    # 1. Подключаем русский шрифт
-    try:
-        pdf.add_font('DejaVu', '', 'DejaVuSans.ttf', uni=True)
-        pdf.set_font('DejaVu', '', 12)
-    except:
-        pdf.set_font("Arial", size=12)
-
-    # 2. Заголовок
-    pdf.set_font('DejaVu', '', 20)
-    pdf.cell(0, 10, 'PathanAI: Медицинское заключение', ln=True, align='C')
-    pdf.set_font('DejaVu', '', 10)
-    pdf.cell(0, 10, 'Система поддержки принятия врачебных решений', ln=True, align='C')
-    pdf.ln(5)
-
-    # 3. Данные пациента
-    pdf.set_fill_color(240, 240, 240)
-    pdf.set_font('DejaVu', '', 12)
-    
-    pdf.cell(0, 10, 'ДАННЫЕ ПАЦИЕНТА:', ln=True, fill=True)
-    text_data = (
-        f"Пол: {patient_data['gender']} | Вес: {patient_data['weight']} кг | Д.Р.: {patient_data['dob']}\n"
-        f"Курение: {patient_data['smoking']}\n"
-        f"Биопсия: {patient_data['biopsy']} | Ткань: {patient_data['tissue']}\n"
-        f"Анамнез: {patient_data['anamnesis']}"
-    )
-    pdf.multi_cell(0, 8, text_data)
-    pdf.ln(5)
-
-    # 4. Изображение
-    if image_obj:
-        try:
-            if image_obj.mode == 'RGBA':
-                image_obj = image_obj.convert('RGB')
-                
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
-                image_obj.save(tmp.name)
-                pdf.image(tmp.name, x=55, w=100) 
-                pdf.ln(5)
-        except Exception as e:
-            pdf.set_font('DejaVu', '', 10)
-            pdf.cell(0, 10, f'[Не удалось добавить изображение: {str(e)}]', ln=True)
-
-    # 5. Результаты
-    pdf.set_fill_color(240, 240, 240)
-    pdf.set_font('DejaVu', '', 12)
-    pdf.cell(0, 10, 'ЗАКЛЮЧЕНИЕ ИИ:', ln=True, fill=True)
-    pdf.ln(2)
-    
-    clean_text = analysis_text.replace('**', '').replace('##', '').replace('* ', '- ')
-    pdf.multi_cell(0, 6, clean_text)
-    
-    # 6. Подвал
-    pdf.ln(10)
-    pdf.set_font('DejaVu', '', 8)
-    pdf.cell(0, 10, 'Дисклеймер: Данный отчет создан ИИ-прототипом PathanAI. Требует верификации врачом.', ln=True, align='C')
-
-    return pdf.output(dest='S').encode('latin-1')
+configure_genai(api_key)
 
 # --- ПОЛУЧЕНИЕ МОДЕЛИ ---
 def get_model():
-    valid_model = None
+    # Модель выбирается на каждый запрос по задержкам и ошибкам (см. pathan/router.py)
     try:
-        all_models = [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
-        for name in all_models:
-            if 'flash' in name:
-                valid_model = name
-                break
-        if not valid_model:
-            for name in all_models:
-                if 'pro' in name:
-                    valid_model = name
-                    break
-        if not valid_model and all_models:
-            valid_model = all_models[0]
+        router = model_router()
+        return router if router.candidates() else None
     except:
-        pass
-    return valid_model
+        return None
+
+model = get_model()
 
-model_name = get_model()
+def wait_in_queue(ticket):
+    # Вызовы модели идут через общую очередь процесса (pathan/scheduler.py)
+    note = st.empty()
+    while ticket.waiting():
+        position = model_scheduler().position(ticket)
+        if position:
+            note.info(f"⏳ Запрос в очереди к модели, позиция: {position}")
+        time.sleep(0.5)
+    note.empty()
 
 # --- ИНТЕРФЕЙС ---
 st.title("🔬 PathanAI")
@@ -126,12 +70,19 @@ with st.expander("📝 Данные пациента", expanded=True):
     anamnesis = st.text_area("Анамнез:", placeholder="Жалобы...")
 
 # --- ИСТОРИЯ ---
-if "messages" not in st.session_state:
-    st.session_state.messages = []
+# Переписка и заключение лежат в общем хранилище артефактов (pathan/artifacts.py),
+# в состоянии сессии - только объект с ключами
+if "artifacts" not in st.session_state:
+    st.session_state.artifacts = session_artifacts()
+artifacts = st.session_state.artifacts
 if "chat_session" not in st.session_state:
     st.session_state.chat_session = None
-if "full_analysis" not in st.session_state:
-    st.session_state.full_analysis = ""
+
+def get_messages():
+    return artifacts.get_json("messages", [])
+
+def add_message(role, content):
+    artifacts.put_json("messages", get_messages() + [{"role": role, "content": content}])
 
 # --- ШАГ 2: ФОТО ---
 st.markdown("---")
@@ -141,19 +92,21 @@ if "last_file" not in st.session_state:
     st.session_state.last_file = None
 
 if uploaded_file and uploaded_file.name != st.session_state.last_file:
-    st.session_state.messages = []
+    artifacts.drop("messages", "full_analysis")
     st.session_state.chat_session = None
-    st.session_state.full_analysis = ""
     st.session_state.last_file = uploaded_file.name
 
 # --- ЛОГИКА ---
 if uploaded_file:
-    image = Image.open(uploaded_file)
-    st.image(image, caption="Образец", width=300)
+    prepared = prepare_upload(uploaded_file)
+    image = prepared.blob()
+    st.image(prepared.data, caption="Образец", width=300)
 
-    if not st.session_state.messages:
+    messages = get_messages()
+    full_analysis = artifacts.get_text("full_analysis", "")
+    if not messages:
         if st.button("🚀 Начать анализ", type="primary"):
-            if not model_name:
+            if not model:
                 st.error("Ошибка AI.")
             else:
                 with st.spinner('Анализ...'):
@@ -170,35 +123,48 @@ if uploaded_file:
                     4. ОЧЕНЬ КРАТКИЙ ВЫВОД.
                     """
                     try:
-                        model = genai.GenerativeModel(model_name)
-                        chat = model.start_chat(history=[])
-                        response = chat.send_message([initial_prompt, image])
-                        
-                        st.session_state.chat_session = chat
-                        st.session_state.full_analysis = response.text
-                        st.session_state.messages.append({"role": "assistant", "content": response.text})
+                        cache_key = response_key(model.label(), initial_prompt, prepared.data)
+                        text = response_cache().get(cache_key)
+                        if text is None:
+                            # Одинаковый запрос из другой сессии присоединяется к уже идущему вызову
+                            ticket = model_scheduler().submit(
+                                cache_key, lambda: model.generate_content([initial_prompt, image], stream=STREAM_OUTPUT),
+                                stream=STREAM_OUTPUT, on_done=lambda answer: response_cache().put(cache_key, answer))
+                            with span("model_call"):
+                                if STREAM_OUTPUT:
+                                    with st.chat_message("assistant"):
+                                        wait_in_queue(ticket)
+                                        text = st.write_stream(ticket.stream())
+                                else:
+                                    wait_in_queue(ticket)
+                                    text = ticket.result()
+
+                        # Уточняющие вопросы: снимок по ссылке на файл, история в пределах бюджета (pathan/chat.py)
+                        st.session_state.chat_session = BoundedChat(model, initial_prompt, prepared, text)
+                        artifacts.put_text("full_analysis", text)
+                        add_message("assistant", text)
                         st.rerun()
                     except Exception as e:
                         st.error(f"Ошибка: {e}")
 
     # ЧАТ
-    for message in st.session_state.messages:
+    for message in messages:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
 
     # --- КНОПКА СКАЧИВАНИЯ PDF ---
-    if st.session_state.full_analysis:
+    if full_analysis:
         st.markdown("---")
         p_data = {
             "gender": gender, "weight": weight, "dob": dob, "smoking": smoking,
             "biopsy": biopsy_method, "tissue": tissue_type, "anamnesis": anamnesis
         }
         
-        pdf_bytes = create_pdf(p_data, st.session_state.full_analysis, image)
-        
+        # PDF собирается только по нажатию, а не на каждом перезапуске скрипта
         st.download_button(
             label="📄 Скачать официальный отчет (PDF)",
-            data=pdf_bytes,
+            data=lambda: create_consult_pdf(p_data, full_analysis, prepared.data),
+            on_click="ignore",
             file_name=f"PathanAI_Report_{datetime.date.today()}.pdf",
             mime="application/pdf"
         )
@@ -207,13 +173,18 @@ if uploaded_file:
     if prompt := st.chat_input("Вопрос по снимку..."):
         with st.chat_message("user"):
             st.markdown(prompt)
-        st.session_state.messages.append({"role": "user", "content": prompt})
+        add_message("user", prompt)
 
         if st.session_state.chat_session:
             try:
-                response = st.session_state.chat_session.send_message(prompt)
-                with st.chat_message("assistant"):
-                    st.markdown(response.text)
-                st.session_state.messages.append({"role": "assistant", "content": response.text})
+                with st.chat_message("assistant"), span("model_call"):
+                    ticket = st.session_state.chat_session.send_message(prompt, stream=STREAM_OUTPUT)
+                    wait_in_queue(ticket)
+                    if STREAM_OUTPUT:
+                        text = st.write_stream(ticket.stream())
+                    else:
+                        text = ticket.result()
+                        st.markdown(text)
+                add_message("assistant", text)
             except Exception as e:
                 st.error(f"Ошибка: {e}")
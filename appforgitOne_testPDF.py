@@ -1,16 +1,28 @@
 import streamlit as st
-import google.generativeai as genai
-from PIL import Image
 import datetime
-from fpdf import FPDF
-import tempfile
-from pyairtable import Api
 import time
-import requests
-from io import BytesIO
+import pandas as pd
+from pathan.streaming import STREAM_OUTPUT
+from pathan.imaging import prepare_image, prepare_upload
+from pathan.report import create_pdf, record_patient
+from pathan.archive import archive_mirror
+from pathan.assets import asset_store
+from pathan.analytics import GENDERS, archive_stats
+from pathan.phash import DUPLICATE_DISTANCE, HASH_FIELD, SIMILAR_DISTANCE, image_phash, phash_index
+from pathan.users import session_tokens, user_directory
+from pathan.pipeline import analysis_fields, archive_writer, build_prompt, extract_summary, submit_analysis
+from pathan.artifacts import artifact_store, session_artifacts
+from pathan.export import FORMATS, export_job, start_export
+from pathan.wsi import WSI_EXTENSIONS, WSI_SUPPORTED, is_wsi, prepare_wsi_upload
+from pathan.batch import BATCH_CONCURRENCY, expand_uploads, run_batch
+from pathan.scheduler import model_scheduler
+from pathan.router import model_router
+from pathan.metrics import span, start_exporter, summary, timed
+from pathan.resources import airtable_tables, configure_genai, http_session
 
 # --- НАСТРОЙКА СТРАНИЦЫ ---
 st.set_page_config(page_title="PathanAI Pro", page_icon="🔬", layout="wide")
+start_exporter()
 
 # --- СЛОВАРЬ ПЕРЕВОДОВ (TR) ---
 TR = {
@@ -31,6 +43,7 @@ TR = {
     "btn_logout": {"RU": "Выйти", "EN": "Logout"},
     "tab_new_analysis": {"RU": "🧬 Новый анализ", "EN": "🧬 New Analysis"},
     "tab_archive": {"RU": "🗂 Общая база", "EN": "🗂 Patient Database"},
+    "tab_analytics": {"RU": "📊 Аналитика", "EN": "📊 Analytics"},
     "sec_patient": {"RU": "Данные пациента", "EN": "Patient Data"},
     "in_p_name": {"RU": "ФИО Пациента", "EN": "Patient Name"},
     "ph_p_name": {"RU": "Иванов И.И.", "EN": "John Doe"},
@@ -40,9 +53,12 @@ TR = {
     "in_method": {"RU": "Метод", "EN": "Method"},
     "in_dob": {"RU": "Дата рождения", "EN": "Date of Birth"},
     "in_weight": {"RU": "Вес (кг)", "EN": "Weight (kg)"},
+    "in_tissue": {"RU": "Ткань", "EN": "Tissue"},
     "in_anamnesis": {"RU": "Анамнез / Описание", "EN": "Anamnesis / Description"},
     "sec_upload": {"RU": "Загрузка материала", "EN": "Upload Image"},
     "upl_label": {"RU": "Загрузить снимок", "EN": "Upload histology image"},
+    "wsi_info": {"RU": "Слайд {w}×{h} px, полей для анализа: {n}", "EN": "Slide {w}×{h} px, fields for analysis: {n}"},
+    "err_wsi": {"RU": "Не удалось прочитать слайд", "EN": "Could not read the slide"},
     "btn_run": {"RU": "🚀 Запустить анализ", "EN": "🚀 Run Analysis"},
     "warn_name": {"RU": "Введите ФИО!", "EN": "Enter Patient Name!"},
     "spinner": {"RU": "Анализ...", "EN": "Analyzing..."},
@@ -56,17 +72,62 @@ TR = {
     "arch_empty": {"RU": "Архив пуст.", "EN": "Database is empty."},
     "exp_full": {"RU": "📄 Полный текст", "EN": "📄 Full Report"},
     "btn_print": {"RU": "🖨️ Печать PDF", "EN": "🖨️ Print PDF"},
-    "pdf_title": {"RU": "PathanAI: Медицинское заключение", "EN": "PathanAI: Medical Report"},
-    "pdf_data": {"RU": "ДАННЫЕ:", "EN": "PATIENT DATA:"},
-    "pdf_concl": {"RU": "ЗАКЛЮЧЕНИЕ:", "EN": "CONCLUSION:"},
-    "pdf_pat": {"RU": "Пациент", "EN": "Patient"},
-    "pdf_gen": {"RU": "Пол", "EN": "Gender"},
-    "pdf_meth": {"RU": "Метод", "EN": "Method"},
-    "pdf_w": {"RU": "Вес", "EN": "Weight"},
-    "pdf_dob": {"RU": "Д.Р.", "EN": "DOB"},
-    "pdf_anam": {"RU": "Анамнез", "EN": "History"}
+    "dup_found": {"RU": "⚠️ Этот снимок уже анализировался: {name}, {date}. Заключение можно открыть без повторного анализа.", "EN": "⚠️ This image has already been analyzed: {name}, {date}. The conclusion can be opened without a new analysis."},
+    "dup_show": {"RU": "📄 Прежнее заключение", "EN": "📄 Previous conclusion"},
+    "similar": {"RU": "🔍 Похожие случаи", "EN": "🔍 Similar cases"},
+    "similar_none": {"RU": "Похожих снимков в архиве нет.", "EN": "No similar images in the archive."},
+    "similarity": {"RU": "сходство", "EN": "similarity"},
+    "an_total": {"RU": "Случаев", "EN": "Cases"},
+    "an_turn_p50": {"RU": "Срок, медиана", "EN": "Turnaround, median"},
+    "an_turn_p90": {"RU": "Срок, p90", "EN": "Turnaround, p90"},
+    "an_weeks": {"RU": "Случаев по неделям", "EN": "Cases per week"},
+    "an_turn_weeks": {"RU": "Медиана срока по неделям, мин", "EN": "Median turnaround per week, min"},
+    "an_by_method": {"RU": "По методу", "EN": "By method"},
+    "an_by_tissue": {"RU": "По ткани", "EN": "By tissue"},
+    "an_by_gender": {"RU": "По полу", "EN": "By gender"},
+    "an_empty": {"RU": "За выбранный период случаев нет.", "EN": "No cases in the selected period."},
+    "arch_search": {"RU": "Поиск (ФИО, вывод, заключение)", "EN": "Search (name, summary, conclusion)"},
+    "arch_all": {"RU": "Все", "EN": "All"},
+    "arch_dates": {"RU": "Период", "EN": "Date range"},
+    "arch_found": {"RU": "Найдено", "EN": "Found"},
+    "arch_page": {"RU": "Страница", "EN": "Page"},
+    "exp_title": {"RU": "📦 Массовый экспорт", "EN": "📦 Bulk export"},
+    "exp_doctor": {"RU": "Врач", "EN": "Doctor"},
+    "exp_format": {"RU": "Формат", "EN": "Format"},
+    "exp_zip": {"RU": "ZIP (отдельные PDF)", "EN": "ZIP (separate PDFs)"},
+    "exp_pdf": {"RU": "Один общий PDF", "EN": "Single merged PDF"},
+    "exp_count": {"RU": "Записей к экспорту", "EN": "Records to export"},
+    "exp_run": {"RU": "Начать экспорт", "EN": "Start export"},
+    "exp_cancel": {"RU": "Отменить", "EN": "Cancel"},
+    "exp_ready": {"RU": "📥 Скачать экспорт", "EN": "📥 Download export"},
+    "exp_failed": {"RU": "Экспорт не удался", "EN": "Export failed"},
+    "exp_on_disk": {"RU": "Экспорт {size} МБ слишком велик для скачивания из браузера. Сузьте фильтры или попросите администратора забрать файл с сервера.", "EN": "The {size} MB export is too large to download in the browser. Narrow the filters or ask an administrator to take the file from the server."},
+    "exp_server_file": {"RU": "Файл на сервере", "EN": "File on the server"},
+    "exp_partial": {"RU": "Не вошли в экспорт (ошибка сборки отчёта): {n}. {error}", "EN": "Left out of the export (report failed to render): {n}. {error}"},
+    "ops_title": {"RU": "⚙️ Служебное", "EN": "⚙️ Operations"},
+    "ops_queue": {"RU": "В очереди записи", "EN": "Write queue"},
+    "ops_written": {"RU": "Записано", "EN": "Written"},
+    "ops_failed": {"RU": "Ошибки записи", "EN": "Failed writes"},
+    "ops_retries": {"RU": "Повторы", "EN": "Retries"},
+    "ops_dropped": {"RU": "Нет колонок в Airtable, записи сохраняются без них", "EN": "Columns missing in Airtable, records are saved without them"},
+    "ops_latency": {"RU": "Задержки по этапам", "EN": "Stage latency"},
+    "ops_sessions": {"RU": "Сессий с данными", "EN": "Sessions with data"},
+    "ops_artifacts": {"RU": "Память / диск сессий, МБ", "EN": "Session memory / disk, MB"},
+    "ops_model_queue": {"RU": "Очередь к модели / в работе", "EN": "Model queue / running"},
+    "ops_coalesced": {"RU": "Объединено / 429", "EN": "Coalesced / 429"},
+    "ops_models": {"RU": "Модели (хеджей: {h}, переключений: {f})", "EN": "Models (hedged: {h}, failovers: {f})"},
+    "queue_pos": {"RU": "⏳ Запрос в очереди к модели, позиция: {n}", "EN": "⏳ Waiting for the model, position in queue: {n}"},
+    "batch_mode": {"RU": "Пакетный режим (несколько снимков / zip)", "EN": "Batch mode (multiple images / zip)"},
+    "batch_label": {"RU": "Загрузить снимки или zip", "EN": "Upload images or a zip"},
+    "batch_count": {"RU": "Снимков", "EN": "Images"},
+    "batch_run": {"RU": "🚀 Анализировать все", "EN": "🚀 Analyze all"},
+    "batch_done": {"RU": "Готово", "EN": "Done"}
 }
 
+BIOPSY_METHODS = ["Мазок", "Пункция", "Эксцизия", "Резекция"]
+TISSUE_TYPES = ["Кожа", "Слизистая", "Лимфоузел", "Молочная железа", "Печень", "Легкое", "Другое"]
+ARCHIVE_PAGE_SIZE = 20
+
 # --- CSS: СКРЫТИЕ ЭЛЕМЕНТОВ ---
 st.markdown("""
     <style>
@@ -84,14 +145,16 @@ st.markdown("""
 
 # --- ИНИЦИАЛИЗАЦИЯ СОСТОЯНИЯ ---
 if 'language' not in st.session_state: st.session_state.language = 'RU'
+# Заключение, PDF и результаты пакета лежат в хранилище артефактов, в сессии - только ключи
+if 'artifacts' not in st.session_state: st.session_state.artifacts = session_artifacts()
 if 'analysis_result' not in st.session_state: st.session_state.analysis_result = None
 if 'analysis_pdf' not in st.session_state: st.session_state.analysis_pdf = None
 if 'uploader_key' not in st.session_state: st.session_state.uploader_key = 0
 if 'user_id' not in st.session_state: st.session_state.user_id = None
 if 'user_name' not in st.session_state: st.session_state.user_name = None
+if 'user_role' not in st.session_state: st.session_state.user_role = None
 
 # Глобальные переменные для API
-api = None
 users_table = None
 records_table = None
 
@@ -109,121 +172,159 @@ def t(key):
     return key
 
 # --- ПОДКЛЮЧЕНИЕ КЛЮЧЕЙ ---
+# Клиенты создаются один раз на процесс (pathan/resources.py), перезапуск скрипта берёт готовые
 try:
     if "GEMINI_API_KEY" in st.secrets:
-        genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
+        configure_genai(st.secrets["GEMINI_API_KEY"])
     
     if "airtable" in st.secrets:
-        api = Api(st.secrets["airtable"]["API_TOKEN"])
-        base_id = st.secrets["airtable"]["BASE_ID"]
-        users_table = api.table(base_id, st.secrets["airtable"]["TABLE_USERS"])
-        records_table = api.table(base_id, st.secrets["airtable"]["TABLE_RECORDS"])
+        # ENDPOINT_URL позволяет направить клиент на локальную заглушку (bench/airtable_stub.py)
+        users_table, records_table = airtable_tables(st.secrets["airtable"])
 except Exception: pass
 
 # --- ФУНКЦИИ ЛОГИКИ ---
+@timed("login")
 def login_user(name, password):
+    # Пользователь ищется в справочнике процесса (pathan/users.py), пароль сверяется с хэшем
     if not name or not password or not users_table: return None
-    try:
-        matches = users_table.all(formula=f"{{Name}}='{name}'")
-        if matches and matches[0]['fields'].get('Password') == password:
-            return matches[0]
+    try: return user_directory(users_table).authenticate(name, password)
     except: return None
-    return None
 
 def get_user_by_id(record_id):
-    if not users_table: return None
-    try: return users_table.get(record_id)
+    if not users_table or not record_id: return None
+    try: return user_directory(users_table).by_id(record_id)
     except: return None
 
 def register_user(name, password, email):
     if not users_table: return False
-    try:
-        if users_table.all(formula=f"{{Name}}='{name}'"): return False
-        users_table.create({"Name": name, "Password": password, "Email": email, "Role": "Doctor"})
-        return True
+    try: return user_directory(users_table).register(name, password, email) is not None
     except: return False
 
-def save_analysis(patient_data, analysis_full, summary, image_file, user_id):
+def analyze_image(prompt, prepared, stream=False):
+    # stream=True выводит текст в текущий элемент Streamlit, вызывать только из потока скрипта
+    txt, ticket = submit_analysis(prompt, prepared, stream)
+    if ticket is not None:
+        with span("model_call"):
+            if stream:
+                wait_in_queue(ticket)
+                txt = st.write_stream(ticket.stream())
+            else:
+                txt = ticket.result()
+    return txt
+
+def wait_in_queue(ticket):
+    note = st.empty()
+    while ticket.waiting():
+        position = model_scheduler().position(ticket)
+        if position: note.info(t("queue_pos").format(n=position))
+        time.sleep(0.5)
+    note.empty()
+
+@timed("save_analysis")
+def save_analysis(patient_data, analysis_full, summary, image_file, user_id, turnaround=None):
     if not records_table: return
-    try:
-        records_table.create({
-            "Patient Name": patient_data['p_name'],
-            "Gender": patient_data['gender'],
-            "Weight": patient_data['weight'],
-            "Birth Date": str(patient_data['dob']),
-            "Anamnesis": patient_data['anamnesis'],
-            "Biopsy Method": patient_data['biopsy'],
-            "AI Conclusion": analysis_full,
-            "Short Summary": summary,
-            "Doctor": [user_id]
-        })
+    try: archive_writer(records_table).submit(analysis_fields(patient_data, analysis_full, summary, image_file, user_id, turnaround))
     except: pass
 
-def get_all_history_records():
-    if not records_table: return []
+@timed("save_analysis")
+def save_analyses(results, user_id):
+    # results: [(patient_data, analysis_full, summary, image_file, turnaround)], одна пачка в очередь записи
+    if not records_table or not results: return
+    try: archive_writer(records_table).submit_many([analysis_fields(p, a, s, img, user_id, ta) for p, a, s, img, ta in results])
+    except: pass
+
+@timed("archive_fetch")
+def search_history(text, biopsy, gender, date_range, page):
+    if not records_table: return [], 0
+    try:
+        mirror = archive_mirror(records_table)
+        mirror.maybe_sync()
+        date_from, date_to = (list(date_range) + [None, None])[:2]
+        return mirror.search(text, biopsy, gender, date_from, date_to, ARCHIVE_PAGE_SIZE, page * ARCHIVE_PAGE_SIZE)
+    except: return [], 0
+
+def get_conclusion(record_id):
+    if not records_table: return ''
+    try: return archive_mirror(records_table).conclusion(record_id)
+    except: return ''
+
+def similar_records(hash_value, max_distance, limit=5, exclude=None):
+    # Записи архива с близким перцептивным хэшем снимка (pathan/phash.py)
+    if not records_table or not hash_value: return []
     try:
-        all_records = records_table.all()
-        all_records.sort(key=lambda x: x.get('createdTime', ''), reverse=True)
-        processed = []
-        for r in all_records:
-            fields = r.get('fields', {})
-            fields['record_id'] = r.get('id')
-            fields['created_time'] = r.get('createdTime', '')
-            processed.append(fields)
-        return processed
+        mirror = archive_mirror(records_table)
+        found = [(mirror.get(rid), dist) for rid, dist in phash_index(mirror).near(hash_value, max_distance, limit, exclude)]
+        return [(rec, dist) for rec, dist in found if rec]
     except: return []
 
+def refresh_history():
+    if not records_table: return
+    try: archive_mirror(records_table).sync()
+    except: pass
+
 def reset_analysis():
+    st.session_state.artifacts.drop("analysis_result", "analysis_pdf", "batch_results")
     st.session_state.analysis_result = None
     st.session_state.analysis_pdf = None
+    st.session_state.batch_results = None
     st.session_state["w_p_name"] = ""
     st.session_state["w_weight"] = 0.0
     st.session_state["w_anamnesis"] = ""
     st.session_state["w_dob"] = datetime.date(1980, 1, 1)
     st.session_state.uploader_key += 1
 
+@timed("image_fetch")
 def get_image_from_url(url):
-    try: return Image.open(BytesIO(requests.get(url).content))
+    try:
+        resp = http_session().get(url)
+        resp.raise_for_status()
+        return prepare_image(resp.content)
     except: return None
 
-def create_pdf(patient_data, analysis_text, image_obj, lang_code):
-    def pdf_t(k): return TR[k][lang_code]
-    pdf = FPDF()
-    pdf.add_page()
-    try: pdf.add_font('DejaVu', '', 'DejaVuSans.ttf', uni=True); pdf.set_font('DejaVu', '', 12)
-    except: pdf.set_font("Arial", size=12)
-    
-    pdf.set_font('DejaVu', '', 20)
-    pdf.cell(0, 10, pdf_t("pdf_title"), ln=True, align='C')
-    pdf.ln(5)
-    pdf.set_fill_color(240, 240, 240)
-    pdf.set_font('DejaVu', '', 12)
-    pdf.cell(0, 10, pdf_t("pdf_data"), ln=True, fill=True)
-    text = f"{pdf_t('pdf_pat')}: {patient_data['p_name']}\n{pdf_t('pdf_gen')}: {patient_data['gender']} | {pdf_t('pdf_meth')}: {patient_data['biopsy']}\n{pdf_t('pdf_w')}: {patient_data['weight']} | {pdf_t('pdf_dob')}: {patient_data['dob']}\n{pdf_t('pdf_anam')}: {patient_data['anamnesis']}"
-    pdf.multi_cell(0, 8, text)
-    pdf.ln(5)
-    if image_obj:
-        try:
-            if image_obj.mode == 'RGBA': image_obj = image_obj.convert('RGB')
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
-                image_obj.save(tmp.name)
-                pdf.image(tmp.name, x=(210-100)/2, w=100)
-        except: pass
-    pdf.ln(5)
-    pdf.cell(0, 10, pdf_t("pdf_concl"), ln=True, fill=True)
-    pdf.ln(2)
-    pdf.multi_cell(0, 6, analysis_text.replace('**', '').replace('##', '').replace('* ', '- '))
-    return pdf.output(dest='S').encode('latin-1')
-
-# Авто-вход
+def record_image(item, size="pdf", fetch=True):
+    # Снимок записи из локального хранилища; вложение Airtable скачивается
+    # не больше одного раза и дальше живёт под своим хэшем
+    try:
+        store = asset_store()
+        attachment = (item.get('Image') or [{}])[0]
+        data = store.thumbnail(store.record_digest(item), size)
+        if data is not None or not fetch or not attachment.get('url') or size != "pdf": return data
+        fetched = get_image_from_url(attachment['url'])
+        if not fetched: return None
+        store.put(fetched.data, fetched.digest)
+        if attachment.get('id'): store.alias(attachment['id'], fetched.digest)
+        return store.thumbnail(fetched.digest, size)
+    except: return None
+
+def doctor_names():
+    # id врача -> имя из справочника пользователей процесса
+    try: return {r['id']: r['fields'].get('Name', r['id']) for r in user_directory(users_table).records()}
+    except: return {}
+
+def export_records(dates, method, doctor, fmt):
+    # Массовая выгрузка идёт в фоне; снимки только из локального хранилища, без сети
+    mirror = archive_mirror(records_table)
+    date_from, date_to = (list(dates) + [None, None])[:2]
+    filters = {"biopsy": method, "date_from": date_from, "date_to": date_to, "doctor": doctor}
+    job = start_export(mirror.iter_records(**filters), mirror.count(**filters), fmt, st.session_state.language,
+                       image_for=lambda fields: record_image(fields, "pdf", fetch=False))
+    st.session_state.export_job = job.id
+
+@st.fragment(run_every=1.0)
+def export_progress(job):
+    if job.state != "running": st.rerun()
+    st.progress(job.progress, text=f"{job.done + job.failed} / {job.total}")
+    if st.button(t("exp_cancel"), key="exp_cancel"): job.cancel()
+
+# Авто-вход: в URL токен сессии, выданный при входе, а не id пользователя
 def try_auto_login():
-    query_params = st.query_params
-    uid_in_url = query_params.get("uid", None)
-    if st.session_state.user_id is None and uid_in_url:
-        user_rec = get_user_by_id(uid_in_url)
+    token = st.query_params.get("session", None)
+    if st.session_state.user_id is None and token:
+        user_rec = get_user_by_id(session_tokens().resolve(token))
         if user_rec:
             st.session_state.user_id = user_rec['id']
             st.session_state.user_name = user_rec['fields'].get('Name')
+            st.session_state.user_role = user_rec['fields'].get('Role')
 try_auto_login()
 
 # ==========================================
@@ -248,7 +349,8 @@ if st.session_state.user_id is None:
                 if u:
                     st.session_state.user_id = u['id']
                     st.session_state.user_name = u['fields'].get('Name')
-                    st.query_params["uid"] = u['id']
+                    st.session_state.user_role = u['fields'].get('Role')
+                    st.query_params["session"] = session_tokens().issue(u['id'])
                     st.rerun()
                 else: st.error(t("err_login"))
         with tab2:
@@ -267,13 +369,46 @@ else:
         st.write(f"👨‍⚕️ **{st.session_state.user_name}**")
         if st.button(t("btn_logout")):
             st.session_state.user_id = None
+            st.session_state.user_role = None
+            session_tokens().revoke(st.query_params.get("session", None))
             st.query_params.clear()
             st.rerun()
     with c_lang:
         if st.button("🇬🇧/🇷🇺", key="lang_main"): toggle_language(); st.rerun()
 
+    # Панель для администраторов
+    if st.session_state.user_role == "Admin" and records_table:
+        with st.sidebar:
+            st.subheader(t("ops_title"))
+            w = archive_writer(records_table).stats()
+            o1, o2 = st.columns(2)
+            o1.metric(t("ops_queue"), w["queued"]); o2.metric(t("ops_written"), w["written"])
+            o1.metric(t("ops_failed"), w["failed"]); o2.metric(t("ops_retries"), w["retries"])
+            if w["last_error"]: st.caption(w["last_error"])
+            if w["dropped_fields"]: st.warning(f"{t('ops_dropped')}: {', '.join(w['dropped_fields'])}")
+            a = artifact_store().stats()
+            o1.metric(t("ops_sessions"), a["sessions"]); o2.metric(t("ops_artifacts"), f"{a['memory'] / 2**20:.1f} / {a['disk'] / 2**20:.1f}")
+            m = model_scheduler().stats()
+            o1.metric(t("ops_model_queue"), f"{m['queued']} / {m['running']}"); o2.metric(t("ops_coalesced"), f"{m['coalesced']} / {m['rate_limited']}")
+            router = model_router()
+            routes = router.stats()
+            if routes:
+                st.caption(t("ops_models").format(h=router.hedged, f=router.failovers))
+                st.dataframe([
+                    {"model": r["model"].split("/")[-1], "calls": r["calls"], "wins": r["wins"],
+                     "p95, ms": round(r["p95"] * 1000) if r["p95"] is not None else None, "errors, %": round(r["errors"] * 100)}
+                    for r in routes
+                ], hide_index=True, width="stretch")
+            stages = summary()
+            if stages:
+                st.caption(t("ops_latency"))
+                st.dataframe([
+                    {"stage": s["stage"], "n": s["count"], "p50, ms": round(s["p50"] * 1000), "p95, ms": round(s["p95"] * 1000)}
+                    for s in stages
+                ], hide_index=True, width="stretch")
+
     st.markdown("---")
-    tab_new, tab_archive = st.tabs([t("tab_new_analysis"), t("tab_archive")])
+    tab_new, tab_archive, tab_analytics = st.tabs([t("tab_new_analysis"), t("tab_archive"), t("tab_analytics")])
 
     # Вкладка 1
     with tab_new:
@@ -282,49 +417,97 @@ else:
             p_name = st.text_input(t("in_p_name"), placeholder=t("ph_p_name"), key="w_p_name")
             c1, c2, c3 = st.columns(3)
             gender = c1.selectbox(t("in_gender"), [t("opt_male"), t("opt_female")], key="w_gender")
-            biopsy = c2.selectbox(t("in_method"), ["Мазок", "Пункция", "Эксцизия", "Резекция"], key="w_biopsy")
+            biopsy = c2.selectbox(t("in_method"), BIOPSY_METHODS, key="w_biopsy")
             dob = c3.date_input(t("in_dob"), datetime.date(1980,1,1), key="w_dob")
             c4, c5 = st.columns(2)
             weight = c4.number_input(t("in_weight"), 0.0, key="w_weight")
+            tissue = c5.selectbox(t("in_tissue"), TISSUE_TYPES, key="w_tissue")
             anamnesis = st.text_area(t("in_anamnesis"), height=100, key="w_anamnesis")
 
         st.write("")
         with st.container(border=True):
             st.subheader(t("sec_upload"))
-            upl = st.file_uploader(t("upl_label"), type=["jpg", "png", "jpeg"], key=f"upl_{st.session_state.uploader_key}")
+            batch_mode = st.toggle(t("batch_mode"), key="w_batch")
+            upl_types = ["jpg", "png", "jpeg"] + (list(WSI_EXTENSIONS) if WSI_SUPPORTED else [])
+            upl = None if batch_mode else st.file_uploader(t("upl_label"), type=upl_types, key=f"upl_{st.session_state.uploader_key}")
+            prepared = None
             if upl:
-                img = Image.open(upl)
-                st.image(img, width=400)
+                try: prepared = prepare_wsi_upload(upl) if is_wsi(upl.name) else prepare_upload(upl)
+                except Exception as e: st.error(f"{t('err_wsi')}: {e}")
+            if prepared:
+                # Отсчёт срока выполнения - с момента загрузки снимка
+                if st.session_state.get("upload_digest") != prepared.digest:
+                    st.session_state.upload_digest, st.session_state.upload_started = prepared.digest, time.time()
+                    # Тот же снимок (пересжатый, переснятый) уже есть в архиве - до вызова модели.
+                    # Проверка один раз на загрузку: после анализа в архиве будет и своя новая запись
+                    try: dups = similar_records(image_phash(prepared), DUPLICATE_DISTANCE, limit=1)
+                    except: dups = []
+                    st.session_state.upload_dups = [{k: rec.get(k, '') for k in ("record_id", "Patient Name", "created_time")} for rec, _ in dups]
+                st.image(prepared.data, width=400)
+                tiles = len(getattr(prepared, "tiles", ()))
+                if is_wsi(upl.name): st.caption(t("wsi_info").format(w=prepared.slide_size[0], h=prepared.slide_size[1], n=tiles))
+                for rec in st.session_state.get("upload_dups") or []:
+                    st.warning(t("dup_found").format(name=rec['Patient Name'] or '-', date=rec['created_time'][:10]))
+                    with st.expander(t("dup_show")): st.write(get_conclusion(rec['record_id']))
                 if st.button(t("btn_run"), type="primary", use_container_width=True):
                     if not p_name: st.warning(t("warn_name"))
                     else:
                         with st.spinner(t("spinner")):
                             try:
-                                model = genai.GenerativeModel('gemini-flash-latest')
-                                if st.session_state.language == 'RU':
-                                    prompt = f"Роль: Патологоанатом. Пациент: {p_name}, {gender}, {weight}, {dob}. Метод: {biopsy}. Анамнез: {anamnesis}. Опиши гистологию, дай заключение и КРАТКИЙ ВЫВОД."
-                                else:
-                                    prompt = f"Role: Pathologist. Patient: {p_name}, {gender}, {weight}, {dob}. Method: {biopsy}. History: {anamnesis}. Describe histology, provide conclusion and SHORT SUMMARY."
-
-                                res = model.generate_content([prompt, img])
-                                txt = res.text
-                                separator = "ВЫВОД" if "ВЫВОД" in txt else ("SUMMARY" if "SUMMARY" in txt else None)
-                                summ = txt.split(separator)[-1][:200] if separator else "See full report"
-                                
-                                p_data = {"p_name": p_name, "gender": gender, "weight": weight, "dob": dob, "anamnesis": anamnesis, "biopsy": biopsy}
-                                st.session_state.analysis_result = txt
-                                save_analysis(p_data, txt, summ, img, st.session_state.user_id)
-                                st.session_state.analysis_pdf = create_pdf(p_data, txt, img, st.session_state.language)
+                                p_data = {"p_name": p_name, "gender": gender, "weight": weight, "dob": dob, "anamnesis": anamnesis, "biopsy": biopsy, "tissue": tissue}
+                                # Текст выводится по мере генерации, итог идёт дальше как раньше
+                                txt = analyze_image(build_prompt(p_data, st.session_state.language, tiles), prepared, stream=STREAM_OUTPUT)
+                                summ = extract_summary(txt)
+                                st.session_state.analysis_result = st.session_state.artifacts.put_text("analysis_result", txt)
+                                save_analysis(p_data, txt, summ, prepared, st.session_state.user_id, time.time() - st.session_state.upload_started)
+                                st.session_state.analysis_pdf = st.session_state.artifacts.put("analysis_pdf", create_pdf(p_data, txt, prepared.data, st.session_state.language))
                                 st.success(t("success_save")); st.rerun()
                             except Exception as e: st.error(f"{t('err_api')}: {e}")
 
+            if batch_mode:
+                files = st.file_uploader(t("batch_label"), type=["jpg", "png", "jpeg", "zip"], accept_multiple_files=True, key=f"batch_{st.session_state.uploader_key}")
+                # Распаковка zip-архивов один раз на набор файлов, а не на каждый перезапуск скрипта
+                files_key = tuple(getattr(f, "file_id", f.name) for f in files or [])
+                if st.session_state.get("batch_files_key") != files_key:
+                    st.session_state.batch_slides = expand_uploads(files) if files else []
+                    st.session_state.batch_files_key = files_key
+                slides = st.session_state.batch_slides
+                if slides:
+                    st.caption(f"{t('batch_count')}: {len(slides)}")
+                    if st.button(t("batch_run"), type="primary", use_container_width=True):
+                        if not p_name: st.warning(t("warn_name"))
+                        else:
+                            p_data = {"p_name": p_name, "gender": gender, "weight": weight, "dob": dob, "anamnesis": anamnesis, "biopsy": biopsy, "tissue": tissue}
+                            prompt = build_prompt(p_data, st.session_state.language)
+                            def analyze_slide(slide):
+                                prepared = prepare_upload(slide[1])
+                                return prepared, analyze_image(prompt, prepared)
+                            results = [None] * len(slides)
+                            batch_started = time.time()
+                            progress = st.progress(0.0)
+                            done = 0
+                            # Вызовы идут в пуле потоков, элементы Streamlit обновляются только отсюда
+                            for i, res, err in run_batch(slides, analyze_slide, BATCH_CONCURRENCY):
+                                done += 1
+                                results[i] = {"name": slides[i][0], "text": res[1] if res else None, "prepared": res[0] if res else None, "error": str(err) if err else None, "turnaround": time.time() - batch_started}
+                                progress.progress(done / len(slides), text=f"{slides[i][0]} ({done}/{len(slides)})")
+                            ok = [r for r in results if r["text"]]
+                            save_analyses([(p_data, r["text"], f"[{r['name']}] {extract_summary(r['text'])}", r["prepared"], r["turnaround"]) for r in ok], st.session_state.user_id)
+                            st.session_state.batch_results = st.session_state.artifacts.put_json("batch_results", [{k: r[k] for k in ("name", "text", "error")} for r in results])
+                            st.success(f"{t('batch_done')}: {len(ok)}/{len(slides)}")
+                for r in (st.session_state.artifacts.get_json("batch_results") if st.session_state.get("batch_results") else None) or []:
+                    with st.expander(("⚠️ " if r["error"] else "✅ ") + r["name"]):
+                        st.write(r["text"] or f"{t('err_api')}: {r['error']}")
+
         if st.session_state.analysis_result:
+            artifacts = st.session_state.artifacts
             st.markdown("---"); st.subheader(t("res_title"))
-            st.write(st.session_state.analysis_result)
+            st.write(artifacts.get_text("analysis_result", ""))
             c_d1, c_d2 = st.columns(2)
             with c_d1:
                 if st.session_state.analysis_pdf:
-                    st.download_button(t("btn_download"), st.session_state.analysis_pdf, "report.pdf", "application/pdf", use_container_width=True)
+                    # Байты PDF читаются из хранилища только по нажатию
+                    st.download_button(t("btn_download"), lambda: artifacts.get("analysis_pdf"), "report.pdf", "application/pdf", on_click="ignore", use_container_width=True)
             with c_d2: st.button(t("btn_reset"), on_click=reset_analysis, use_container_width=True, type="secondary")
 
     # Вкладка 2
@@ -332,8 +515,56 @@ else:
         col_head, col_refresh = st.columns([4, 1])
         with col_head: st.subheader(t("arch_title"))
         with col_refresh:
-            if st.button(t("btn_refresh"), use_container_width=True): st.rerun()
-        history = get_all_history_records()
+            if st.button(t("btn_refresh"), use_container_width=True): refresh_history(); st.rerun()
+        if records_table:
+            with st.expander(t("exp_title")):
+                e1, e2, e3 = st.columns(3)
+                e_dates = e1.date_input(t("arch_dates"), value=(), key="exp_dates")
+                e_method = e2.selectbox(t("in_method"), [t("arch_all")] + BIOPSY_METHODS, key="exp_method")
+                e_method = None if e_method == t("arch_all") else e_method
+                doctors = {t("arch_all"): None}
+                doctors.update({name: rid for rid, name in doctor_names().items()})
+                e_doctor = doctors.get(e3.selectbox(t("exp_doctor"), list(doctors), key="exp_doctor"))
+                formats = {t("exp_" + f): f for f in FORMATS}
+                e_format = formats[st.radio(t("exp_format"), list(formats), horizontal=True, key="exp_format")]
+                e_date_from, e_date_to = (list(e_dates) + [None, None])[:2]
+                try: e_count = archive_mirror(records_table).count(biopsy=e_method, date_from=e_date_from, date_to=e_date_to, doctor=e_doctor)
+                except: e_count = 0
+                st.caption(f"{t('exp_count')}: {e_count}")
+                job = export_job(st.session_state.get("export_job"))
+                if job and job.state == "running": export_progress(job)
+                else:
+                    if st.button(t("exp_run"), disabled=not e_count, use_container_width=True):
+                        try: export_records(e_dates, e_method, e_doctor, e_format); st.rerun()
+                        except Exception as e: st.error(f"{t('exp_failed')}: {e}")
+                    if job and job.state == "done" and job.failed:
+                        # Часть отчётов не собралась - файл неполный
+                        st.warning(t("exp_partial").format(n=job.failed, error=job.error or ""))
+                    if job and job.state == "done" and job.downloadable:
+                        st.download_button(t("exp_ready"), job.read, f"pathan_export_{job.id}.{job.fmt}",
+                                           "application/zip" if job.fmt == "zip" else "application/pdf",
+                                           on_click="ignore", use_container_width=True)
+                    elif job and job.state == "done":
+                        st.info(t("exp_on_disk").format(size=round(job.size / 1048576)))
+                        # Путь на сервере нужен только администратору
+                        if st.session_state.user_role == "Admin":
+                            st.caption(t("exp_server_file")); st.code(job.path, language=None)
+                    elif job and job.state == "error": st.error(f"{t('exp_failed')}: {job.error}")
+        f1, f2, f3, f4 = st.columns([3, 2, 2, 3])
+        q = f1.text_input(t("arch_search"), key="arch_q")
+        f_method = f2.selectbox(t("in_method"), [t("arch_all")] + BIOPSY_METHODS, key="arch_method")
+        f_method = None if f_method == t("arch_all") else f_method
+        genders = {t("arch_all"): None, t("opt_male"): "male", t("opt_female"): "female"}
+        f_gender = genders.get(f3.selectbox(t("in_gender"), list(genders), key="arch_gender"))
+        f_dates = f4.date_input(t("arch_dates"), value=(), key="arch_dates")
+        filters = (q, f_method, f_gender, tuple(f_dates))
+        if st.session_state.get("arch_filters") != filters:
+            st.session_state.arch_filters = filters
+            st.session_state.arch_page = 0
+        page = st.session_state.get("arch_page", 0)
+        history, total = search_history(q, f_method, f_gender, f_dates, page)
+        pages = max(1, -(-total // ARCHIVE_PAGE_SIZE))
+        st.caption(f"{t('arch_found')}: {total}")
         if history:
             for item in history:
                 rec_id = item.get('record_id')
@@ -351,18 +582,64 @@ else:
                     with c_h1: st.markdown(f"**{icon} {p_name_db}**")
                     with c_h2: st.caption(f"📅 {date_created}")
                     with c_h3: st.caption(f"🔬 {method}")
-                    st.divider(); st.write(summary)
-                    with st.expander(t("exp_full")):
-                        st.write(item.get('AI Conclusion', ''))
+                    st.divider()
+                    thumb = record_image(item, "card")
+                    if thumb:
+                        c_img, c_sum = st.columns([1, 4])
+                        c_img.image(thumb)
+                        c_sum.write(summary)
+                    else: st.write(summary)
+                    # Полное заключение загружается только для раскрытой записи
+                    if st.toggle(t("exp_full"), key=f"full_{rec_id}"):
+                        conclusion = get_conclusion(rec_id)
+                        st.write(conclusion)
                         st.markdown("---")
                         if st.button(t("btn_print"), key=f"btn_{rec_id}", use_container_width=True):
                             with st.spinner("PDF..."):
-                                img_obj = None
-                                if 'Image' in item and len(item['Image']) > 0:
-                                    img_obj = get_image_from_url(item['Image'][0].get('url'))
-                                pdf_bytes = create_pdf({
-                                    'p_name': p_name_db, 'gender': item.get('Gender', '?'), 'weight': item.get('Weight', 0),
-                                    'dob': item.get('Birth Date', '-'), 'anamnesis': item.get('Anamnesis', '-'), 'biopsy': method
-                                }, item.get('AI Conclusion', ''), img_obj, st.session_state.language)
+                                img_data = record_image(item)
+                                pdf_bytes = create_pdf(record_patient(item), conclusion, img_data, st.session_state.language)
                                 st.download_button(t("btn_download"), pdf_bytes, f"Report_{p_name_db}.pdf", "application/pdf", key=f"dl_{rec_id}")
+                    if item.get(HASH_FIELD) and st.toggle(t("similar"), key=f"sim_{rec_id}"):
+                        similar = similar_records(item[HASH_FIELD], SIMILAR_DISTANCE, exclude=rec_id)
+                        if not similar: st.caption(t("similar_none"))
+                        for rec, dist in similar:
+                            s_img, s_text = st.columns([1, 4])
+                            s_thumb = record_image(rec, "card", fetch=False)
+                            if s_thumb: s_img.image(s_thumb)
+                            s_text.markdown(f"**{rec.get('Patient Name', '-')}** · {rec.get('created_time', '')[:10]} · {rec.get('Biopsy Method', '-')} · {t('similarity')} {100 - dist * 100 // 64}%")
+                            s_text.caption(rec.get('Short Summary', '-'))
+            if pages > 1:
+                p1, p2, p3 = st.columns([1, 2, 1])
+                if p1.button("◀", disabled=page == 0, use_container_width=True):
+                    st.session_state.arch_page = page - 1; st.rerun()
+                p2.caption(f"{t('arch_page')} {page + 1} / {pages}")
+                if p3.button("▶", disabled=page >= pages - 1, use_container_width=True):
+                    st.session_state.arch_page = page + 1; st.rerun()
+        else: st.info(t("arch_empty"))
+
+    # Вкладка 3
+    with tab_analytics:
+        if records_table:
+            a_dates = st.date_input(t("arch_dates"), value=(), key="an_dates")
+            a_from, a_to = (list(a_dates) + [None, None])[:2]
+            try: stats = archive_stats(archive_mirror(records_table)).summary(a_from, a_to)
+            except Exception as e: stats = None; st.error(f"{t('err_api')}: {e}")
+            if stats and stats["total"]:
+                turn = stats["turnaround"]
+                m1, m2, m3 = st.columns(3)
+                m1.metric(t("an_total"), stats["total"])
+                duration = lambda sec: f"{sec:.0f} s" if sec < 120 else f"{sec / 60:.1f} min"
+                m2.metric(t("an_turn_p50"), duration(turn['p50']) if turn else "-")
+                m3.metric(t("an_turn_p90"), duration(turn['p90']) if turn else "-")
+                st.caption(t("an_weeks"))
+                st.bar_chart(pd.Series(dict(stats["weeks"])))
+                if stats["turnaround_weeks"]:
+                    st.caption(t("an_turn_weeks"))
+                    st.line_chart(pd.Series({w: m / 60 for w, m in stats["turnaround_weeks"]}))
+                gender_names = dict(zip(GENDERS, ("-", t("opt_male"), t("opt_female"))))
+                g1, g2, g3 = st.columns(3)
+                g1.caption(t("an_by_method")); g1.bar_chart(pd.Series(dict(stats["method"])), horizontal=True)
+                g2.caption(t("an_by_tissue")); g2.bar_chart(pd.Series(dict(stats["tissue"])), horizontal=True)
+                g3.caption(t("an_by_gender")); g3.bar_chart(pd.Series({gender_names[g]: n for g, n in stats["gender"]}), horizontal=True)
+            elif stats is not None: st.info(t("an_empty"))
         else: st.info(t("arch_empty"))
@@ -0,0 +1 @@
+# Офлайн-бенчмарки PathanAI: локальные заглушки Gemini и Airtable.
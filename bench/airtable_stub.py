@@ -0,0 +1,168 @@
+import datetime
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+# --- ЛОКАЛЬНАЯ ЗАГЛУШКА AIRTABLE REST API ---
+# Понимает запросы pyairtable: список с пагинацией, get, create/batch create,
+# update. Из формул поддерживаются {Поле}='значение' и
+# IS_AFTER(LAST_MODIFIED_TIME(), DATETIME_PARSE('...')); остальные игнорируются.
+
+PAGE_SIZE = 100
+BATCH_LIMIT = 10
+
+_EQ = re.compile(r"^\{(.+?)\}\s*=\s*'(.*)'$")
+_AFTER = re.compile(r"IS_AFTER\(LAST_MODIFIED_TIME\(\),\s*DATETIME_PARSE\('([^']+)'\)\)")
+
+
+def _now_iso():
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+class AirtableStub:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.tables = {}
+        self.requests = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = None
+
+    # --- данные ---
+    def _new_record(self, fields, created_time=None):
+        now = _now_iso()
+        return {"id": "rec%014d" % next(self._ids), "createdTime": created_time or now, "fields": dict(fields), "_modified": now}
+
+    def seed(self, table, fields_list, created_times=None):
+        with self._lock:
+            rows = self.tables.setdefault(table, [])
+            for i, fields in enumerate(fields_list):
+                rows.append(self._new_record(fields, created_times[i] if created_times else None))
+
+    def _public(self, record):
+        return {k: v for k, v in record.items() if not k.startswith("_")}
+
+    def _filter(self, rows, formula):
+        if not formula:
+            return rows
+        m = _EQ.match(formula.strip())
+        if m:
+            field, value = m.group(1), m.group(2).replace("\\'", "'")
+            return [r for r in rows if str(r["fields"].get(field, "")) == value]
+        m = _AFTER.search(formula)
+        if m:
+            since = m.group(1)
+            return [r for r in rows if r["_modified"] > since]
+        return rows
+
+    def list(self, table, params):
+        with self._lock:
+            rows = self._filter(self.tables.get(table, []), params.get("filterByFormula"))
+            offset = int(params.get("offset") or 0)
+            size = min(PAGE_SIZE, int(params.get("pageSize") or PAGE_SIZE))
+            page = [self._public(r) for r in rows[offset:offset + size]]
+        out = {"records": page}
+        if offset + size < len(rows):
+            out["offset"] = str(offset + size)
+        return 200, out
+
+    def get(self, table, record_id):
+        with self._lock:
+            for r in self.tables.get(table, []):
+                if r["id"] == record_id:
+                    return 200, self._public(r)
+        return 404, {"error": "NOT_FOUND"}
+
+    def create(self, table, body):
+        with self._lock:
+            rows = self.tables.setdefault(table, [])
+            if "records" in body:
+                if len(body["records"]) > BATCH_LIMIT:
+                    return 422, {"error": {"type": "INVALID_RECORDS"}}
+                created = [self._new_record(r.get("fields", {})) for r in body["records"]]
+                rows.extend(created)
+                return 200, {"records": [self._public(r) for r in created]}
+            record = self._new_record(body.get("fields", {}))
+            rows.append(record)
+            return 200, self._public(record)
+
+    def update(self, table, record_id, body):
+        with self._lock:
+            for r in self.tables.get(table, []):
+                if r["id"] == record_id:
+                    r["fields"].update(body.get("fields", {}))
+                    r["_modified"] = _now_iso()
+                    return 200, self._public(r)
+        return 404, {"error": "NOT_FOUND"}
+
+    # --- HTTP ---
+    def start(self, port=0):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _route(self):
+                parsed = urlparse(self.path)
+                parts = [unquote(p) for p in parsed.path.split("/") if p]
+                return parts, {k: v[0] for k, v in parse_qs(parsed.query).items()}
+
+            def _body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length) or b"{}")
+
+            def _send(self, status, payload):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _handle(self, method):
+                with stub._lock:
+                    stub.requests += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                parts, params = self._route()
+                if len(parts) < 3 or parts[0] != "v0":
+                    return self._send(404, {"error": "NOT_FOUND"})
+                table = parts[2]
+                rest = parts[3:]
+                if method == "GET" and not rest:
+                    return self._send(*stub.list(table, params))
+                if method == "POST" and rest == ["listRecords"]:
+                    return self._send(*stub.list(table, self._body()))
+                if method == "GET" and len(rest) == 1:
+                    return self._send(*stub.get(table, rest[0]))
+                if method == "POST" and not rest:
+                    return self._send(*stub.create(table, self._body()))
+                if method == "PATCH" and len(rest) == 1:
+                    return self._send(*stub.update(table, rest[0], self._body()))
+                return self._send(404, {"error": "NOT_FOUND"})
+
+            def do_GET(self): self._handle("GET")
+            def do_POST(self): self._handle("POST")
+            def do_PATCH(self): self._handle("PATCH")
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="airtable-stub", daemon=True).start()
+        return self
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
@@ -0,0 +1,120 @@
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+import google.generativeai as genai
+
+# --- ЗАГЛУШКА GEMINI ---
+# Поддельная GenerativeModel с настраиваемой задержкой и размером ответа.
+# Запоминает размер каждого запроса, чтобы видеть рост контекста.
+
+MODELS = ("models/gemini-flash-latest", "models/gemini-pro-latest")
+
+
+class FakeSettings:
+    latency = 0.05          # до первого чанка, секунд
+    latency_per_kb = 0.0    # добавка за каждый КБ запроса, чтобы рост контекста был виден и по времени
+    chunk_latency = 0.005   # между чанками
+    output_chars = 1500
+    chunks = 20
+    # Деградировавшие модели: имя -> (доля медленных ответов, добавка в секундах)
+    degraded = {}
+
+
+settings = FakeSettings()
+requests_log = []
+_log_lock = threading.Lock()
+
+
+def request_size(contents):
+    # Примерный объём запроса в байтах: текст + inline-данные + ссылки на файлы
+    total = 0
+    items = contents if isinstance(contents, (list, tuple)) else [contents]
+    for item in items:
+        if isinstance(item, str):
+            total += len(item.encode("utf-8"))
+        elif isinstance(item, (bytes, bytearray)):
+            total += len(item)
+        elif isinstance(item, dict):
+            if "parts" in item:
+                total += request_size(item["parts"])
+            elif "data" in item:
+                total += len(item["data"])
+            else:
+                total += len(str(item))
+        else:
+            total += len(str(getattr(item, "uri", item)))
+    return total
+
+
+def _text(prompt_size):
+    body = ("Микроскопическое описание: ткань без особенностей. " * 100)[: max(0, settings.output_chars - 40)]
+    return body + "\nКРАТКИЙ ВЫВОД / SUMMARY: норма."
+
+
+class FakeResponse:
+    def __init__(self, text, stream):
+        self.text = text
+        self._stream = stream
+
+    @property
+    def parts(self):
+        return [SimpleNamespace(text=self.text)]
+
+    def __iter__(self):
+        n = max(1, settings.chunks)
+        step = max(1, len(self.text) // n)
+        for i in range(0, len(self.text), step):
+            if i:
+                time.sleep(settings.chunk_latency)
+            yield SimpleNamespace(text=self.text[i:i + step])
+
+    def resolve(self):
+        pass
+
+
+class FakeChatSession:
+    def __init__(self, model, history=None):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, content, stream=False, **kwargs):
+        contents = self.history + [{"role": "user", "parts": content if isinstance(content, list) else [content]}]
+        response = self.model.generate_content(contents, stream=stream)
+        self.history = contents + [{"role": "model", "parts": [response.text]}]
+        return response
+
+
+class FakeGenerativeModel:
+    def __init__(self, model_name="models/gemini-flash-latest", **kwargs):
+        self.model_name = model_name
+
+    def start_chat(self, history=None, **kwargs):
+        return FakeChatSession(self, history)
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        size = request_size(contents)
+        with _log_lock:
+            requests_log.append({"model": self.model_name, "bytes": size})
+        slow_share, slow_extra = settings.degraded.get(self.model_name, (0.0, 0.0))
+        extra = slow_extra if random.random() < slow_share else 0.0
+        time.sleep(settings.latency + settings.latency_per_kb * size / 1024.0 + extra)
+        return FakeResponse(_text(size), stream)
+
+    def count_tokens(self, contents, **kwargs):
+        return SimpleNamespace(total_tokens=request_size(contents) // 4)
+
+
+def fake_list_models():
+    return [SimpleNamespace(name=n, supported_generation_methods=["generateContent", "countTokens"]) for n in MODELS]
+
+
+def fake_upload_file(path, mime_type=None, **kwargs):
+    return SimpleNamespace(uri="https://fake.local/files/slide", mime_type=mime_type, name="files/slide")
+
+
+def install():
+    genai.GenerativeModel = FakeGenerativeModel
+    genai.list_models = fake_list_models
+    genai.upload_file = fake_upload_file
@@ -0,0 +1,508 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# --- ОФЛАЙН-БЕНЧМАРК ---
+# python -m bench.run --out bench_results.json
+# Всё работает локально: Gemini заменён bench/fakes.py, Airtable - bench/airtable_stub.py.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = os.path.join(ROOT, "appforgitOne_testPDF.py")
+USERS_TABLE = "users"
+BASE_ID = "appBench"
+
+COLD_START_CODE = """
+import sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, {root!r})
+from bench import fakes
+fakes.install()
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file({app!r}, default_timeout=120)
+for k, v in {secrets!r}.items(): at.secrets[k] = v
+at.run()
+print(time.perf_counter() - t0)
+"""
+
+
+def stats(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {"n": 0}
+    return {
+        "n": len(samples),
+        "mean": statistics.fmean(samples),
+        "p50": samples[len(samples) // 2],
+        "p95": samples[min(len(samples) - 1, int(0.95 * len(samples)))],
+        "min": samples[0],
+        "max": samples[-1],
+    }
+
+
+def archive_fields(i):
+    return {
+        "Patient Name": f"Пациент {i}",
+        "Gender": "Мужской" if i % 2 else "Женский",
+        "Weight": 60 + i % 40,
+        "Birth Date": "1980-01-01",
+        "Anamnesis": "Жалоб нет",
+        "Biopsy Method": ["Мазок", "Пункция", "Эксцизия", "Резекция"][i % 4],
+        "AI Conclusion": "Микроскопическое описание без особенностей. " * 30,
+        "Short Summary": "норма" if i % 9 else "карцинома",
+    }
+
+
+def seed_archive(stub, table, n):
+    created = [f"2024-{1 + i % 12:02d}-{1 + i % 28:02d}T10:{i % 60:02d}:00.000Z" for i in range(n)]
+    stub.seed(table, [archive_fields(i) for i in range(n)], created)
+
+
+def secrets_for(stub, records_table):
+    return {
+        "GEMINI_API_KEY": "bench",
+        "airtable": {
+            "API_TOKEN": "bench", "BASE_ID": BASE_ID, "ENDPOINT_URL": stub.url,
+            "TABLE_USERS": USERS_TABLE, "TABLE_RECORDS": records_table,
+        },
+    }
+
+
+def app_test(secrets):
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(APP, default_timeout=120)
+    for k, v in secrets.items():
+        at.secrets[k] = v
+    return at
+
+
+def timed_run(at):
+    t0 = time.perf_counter()
+    at.run()
+    elapsed = time.perf_counter() - t0
+    if at.exception:
+        raise RuntimeError(at.exception[0].value)
+    return elapsed
+
+
+# --- сценарии ---
+def bench_cold_start(secrets, runs):
+    samples = []
+    code = COLD_START_CODE.format(root=ROOT, app=APP, secrets=secrets)
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-W", "ignore", "-c", code], capture_output=True, text=True, cwd=ROOT, env=os.environ.copy())
+        if out.returncode != 0:
+            raise RuntimeError(out.stderr[-2000:])
+        samples.append(float(out.stdout.strip().splitlines()[-1]))
+    return stats(samples)
+
+
+def bench_login(stub, secrets, runs):
+    # Вход по паролю и перезагрузка страницы с токеном сессии в URL; запросы к
+    # таблице пользователей считаются по заглушке Airtable
+    from pathan.metrics import summary
+    samples, reloads, token = [], [], None
+    requests_before = stub.requests
+    for _ in range(runs):
+        at = app_test(secrets)
+        timed_run(at)
+        at.text_input(key="login_name").set_value("Dr Bench")
+        at.text_input(key="login_pass").set_value("bench-password")
+        button = next(b for b in at.button if b.label in ("Войти", "Sign In"))
+        button.click()
+        samples.append(timed_run(at))
+        if not at.session_state.user_id:
+            raise RuntimeError("login failed")
+        token = at.query_params["session"]
+    login_requests = stub.requests - requests_before
+    requests_before = stub.requests
+    for _ in range(runs):
+        at = app_test(secrets)
+        at.query_params["session"] = token
+        reloads.append(timed_run(at))
+        if not at.session_state.user_id:
+            raise RuntimeError("auto-login failed")
+    hashing = next((s for s in summary() if s["stage"] == "password_hash"), {})
+    return {"login": stats(samples), "reload": stats(reloads), "airtable_requests_login": login_requests,
+            "airtable_requests_reload": stub.requests - requests_before, "password_hash_p50": hashing.get("p50")}
+
+
+def bench_rerun(secrets, user_id, reruns):
+    at = app_test(secrets)
+    at.session_state.user_id = user_id
+    at.session_state.user_name = "Dr Bench"
+    first = timed_run(at)
+    samples = [timed_run(at) for _ in range(reruns)]
+    return {"first": first, "rerun": stats(samples)}
+
+
+def bench_pdf(count):
+    from PIL import Image
+    from io import BytesIO
+    from pathan.imaging import prepare_image
+    from pathan.report import build_report, create_pdf
+    buf = BytesIO()
+    Image.effect_noise((1600, 1200), 64).convert("RGB").save(buf, format="JPEG")
+    image = prepare_image(buf.getvalue()).data
+    patient = {"p_name": "Пациент", "gender": "Мужской", "biopsy": "Мазок", "weight": 70, "dob": "1980-01-01", "anamnesis": "нет"}
+    text = "Микроскопическое описание без особенностей. " * 60
+    t0 = time.perf_counter()
+    samples = []
+    for i in range(count):
+        s = time.perf_counter()
+        build_report(patient, text + str(i), image, "RU")
+        samples.append(time.perf_counter() - s)
+    total = time.perf_counter() - t0
+    create_pdf(patient, text, image, "RU")
+    s = time.perf_counter()
+    create_pdf(patient, text, image, "RU")
+    return {"build": stats(samples), "reports_per_sec": count / total, "memo_hit": time.perf_counter() - s}
+
+
+def bench_chat(turns):
+    # Размер запроса и задержка на каждый уточняющий вопрос: BoundedChat против
+    # обычной ChatSession с inline-снимком в истории. BoundedChat идёт через
+    # планировщик, обычная сессия - напрямую; ведро запросов на время сценария
+    # снимается, иначе задержка BoundedChat - это ожидание лимита RPM
+    from PIL import Image
+    from io import BytesIO
+    from bench.fakes import FakeGenerativeModel, requests_log
+    from pathan.chat import BoundedChat
+    from pathan.imaging import prepare_image
+    from pathan.scheduler import TokenBucket, model_scheduler
+    buf = BytesIO()
+    Image.effect_noise((1600, 1200), 64).convert("RGB").save(buf, format="JPEG")
+    prepared = prepare_image(buf.getvalue())
+    model = FakeGenerativeModel()
+    prompt = "Ты эксперт-патологоанатом. Анализ снимка."
+    analysis = model.generate_content([prompt, prepared.blob()]).text
+    sessions = {
+        "bounded": BoundedChat(model, prompt, prepared, analysis),
+        "unbounded": model.start_chat(history=[
+            {"role": "user", "parts": [prompt, prepared.blob()]},
+            {"role": "model", "parts": [analysis]},
+        ]),
+    }
+    sessions["bounded"]._file.result()
+    scheduler = model_scheduler()
+    limiter, scheduler.bucket = scheduler.bucket, TokenBucket(rate_per_minute=1e9)
+    out = {}
+    try:
+        for name, chat in sessions.items():
+            sizes, latencies = [], []
+            for i in range(turns):
+                if name == "bounded":
+                    chat._wait_compaction()
+                before = len(requests_log)
+                s = time.perf_counter()
+                chat.send_message(f"Уточняющий вопрос {i}: что насчёт краёв резекции?").text
+                latencies.append(time.perf_counter() - s)
+                sizes.append(requests_log[before]["bytes"])
+            out[name] = {"request_bytes_first": sizes[0], "request_bytes_last": sizes[-1], "request_bytes_max": max(sizes),
+                         "latency": stats(latencies), "latency_last": latencies[-1]}
+    finally:
+        scheduler.bucket = limiter
+    out["bounded"]["compactions"] = sessions["bounded"].compactions
+    return out
+
+
+def bench_routing(calls, slow_share, slow_extra):
+    # Время до первого чанка, когда основная модель часть ответов отдаёт с большой
+    # задержкой: вызовы только в неё против маршрутизатора с хеджированием
+    from bench import fakes
+    from pathan.models import ModelRegistry
+    from pathan.resources import generative_model
+    from pathan.router import ModelRouter
+    from pathan.scheduler import ModelScheduler, TokenBucket
+    primary = fakes.MODELS[0]
+    fakes.settings.degraded = {primary: (slow_share, slow_extra)}
+    # Вызовы идут по одному, поэтому хеджу всегда хватает слота; лимит RPM здесь не меряется
+    router = ModelRouter(registry_=ModelRegistry(list_models=fakes.fake_list_models),
+                         scheduler=ModelScheduler(bucket=TokenBucket(rate_per_minute=1e9)))
+    callers = {
+        "pinned": lambda: generative_model(primary).generate_content(["Анализ снимка"], stream=True),
+        "routed": lambda: router.generate_content(["Анализ снимка"], stream=True),
+    }
+    out = {}
+    try:
+        for name, call in callers.items():
+            latencies = []
+            for _ in range(calls):
+                s = time.perf_counter()
+                next(iter(call()))
+                latencies.append(time.perf_counter() - s)
+            out[name] = stats(latencies)
+    finally:
+        fakes.settings.degraded = {}
+    out["routed"].update(hedged=router.hedged, hedges_skipped=router.hedges_skipped, failovers=router.failovers,
+                         wins={r["model"]: r["wins"] for r in router.stats()})
+    return out
+
+
+def bench_phash(size, queries=200):
+    # Хэш одного снимка и поиск по индексу из size записей
+    import random
+    from PIL import Image
+    from io import BytesIO
+    from pathan.phash import DUPLICATE_DISTANCE, SIMILAR_DISTANCE, PHashIndex, phash
+    buf = BytesIO()
+    Image.effect_noise((1536, 1152), 64).convert("RGB").save(buf, format="JPEG")
+    hashing = []
+    for _ in range(20):
+        s = time.perf_counter()
+        value = phash(buf.getvalue())
+        hashing.append(time.perf_counter() - s)
+    rng = random.Random(0)
+    index = PHashIndex()
+    s = time.perf_counter()
+    for i in range(size):
+        index.add(f"rec{i}", "%016x" % rng.getrandbits(64))
+    build = time.perf_counter() - s
+    out = {"hash": stats(hashing), "build_s": build}
+    for name, distance in (("duplicate", DUPLICATE_DISTANCE), ("similar", SIMILAR_DISTANCE)):
+        lookups = []
+        for _ in range(queries):
+            s = time.perf_counter()
+            index.near(value, distance)
+            lookups.append(time.perf_counter() - s)
+        out[name] = stats(lookups)
+    return out
+
+
+def bench_analytics(size, renders=20):
+    # Сводка вкладки аналитики: первичная загрузка столбцов, повторная отрисовка
+    # без изменений и отрисовка после каждой новой записи
+    from pathan.analytics import ArchiveStats, FIELDS
+    from pathan.archive import ArchiveMirror
+    mirror = ArchiveMirror(None, os.path.join(tempfile.mkdtemp(prefix="pathan-analytics-"), "archive.sqlite"))
+    records = []
+    for i in range(size):
+        fields = archive_fields(i)
+        fields.update({"Tissue": ["Кожа", "Печень", "Легкое"][i % 3], "Turnaround Seconds": 30 + i % 600})
+        records.append({"id": f"rec{i}", "createdTime": f"2024-{1 + i % 12:02d}-{1 + i % 28:02d}T10:00:00.000Z", "fields": fields})
+    for i in range(0, size, 1000):
+        mirror.upsert(records[i:i + 1000])
+    aggregates = ArchiveStats()
+    s = time.perf_counter()
+    aggregates.load(mirror.columns(FIELDS))
+    load = time.perf_counter() - s
+    mirror.listeners.append(aggregates.on_records)
+    cold, cached, updated = [], [], []
+    for i in range(renders):
+        aggregates.version += 1
+        s = time.perf_counter(); aggregates.summary(); cold.append(time.perf_counter() - s)
+        s = time.perf_counter(); aggregates.summary(); cached.append(time.perf_counter() - s)
+        s = time.perf_counter()
+        mirror.upsert([dict(records[i], id=f"new{i}")])
+        aggregates.summary()
+        updated.append(time.perf_counter() - s)
+    return {"records": size, "load_s": load, "summary": stats(cold),
+            "summary_cached": stats(cached), "new_record_and_summary": stats(updated)}
+
+
+def bench_service(secrets, jobs):
+    # Сервис без Streamlit: время импорта воркера, приём задания и полный путь
+    # задания (модель, запись в Airtable, PDF) через HTTP. Задания сверх запаса
+    # общего ведра запросов ждут лимит PATHAN_GEMINI_RPM - это видно в хвосте.
+    # Два экземпляра с общим каталогом заданий: статус спрашивается у обоих по очереди
+    import asyncio
+    import base64
+    import http.client
+    import threading
+    from PIL import Image
+    from io import BytesIO
+    from pathan.pipeline import archive_writer
+    from pathan.resources import airtable_tables
+    from pathan.service import AnalysisService, JobStore
+    code = "import sys, time; t0 = time.perf_counter(); import pathan.service; print(time.perf_counter() - t0, 'streamlit' in sys.modules)"
+    proc = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=ROOT, check=True)
+    import_s, streamlit_loaded = proc.stdout.split()
+    users_table, table = airtable_tables(dict(secrets["airtable"], TABLE_RECORDS="records_service"))
+    doctor = users_table.all(max_records=1)[0]["id"]
+    token = "bench-token"
+    root = os.path.join(os.environ["PATHAN_DATA_DIR"], "bench_service")
+    loop = asyncio.new_event_loop()
+    conns = []
+    for _ in range(2):
+        service = AnalysisService(table, users_table=users_table, token=token, store=JobStore(root))
+        port = loop.run_until_complete(service.start("127.0.0.1", 0))
+        conns.append(http.client.HTTPConnection("127.0.0.1", port))
+    threading.Thread(target=loop.run_forever, name="bench-service", daemon=True).start()
+    conn, calls = conns[0], [0]
+
+    def call(method, path, payload=None, auth=True, peer=False):
+        c = conns[calls[0] % 2] if peer else conn
+        calls[0] += 1
+        headers = {"Authorization": f"Bearer {token}"} if auth else {}
+        c.request(method, path, json.dumps(payload) if payload is not None else None, headers)
+        response = c.getresponse()
+        body = response.read()
+        return response.status, body
+
+    accepted, started, ids = [], {}, []
+    for i in range(jobs):
+        buf = BytesIO()
+        Image.effect_noise((1024, 768), 40 + i).convert("RGB").save(buf, format="JPEG")
+        payload = {"patient": {"p_name": f"Пациент {i}", "gender": "Мужской", "biopsy": "Мазок", "tissue": "Кожа"},
+                   "image": base64.b64encode(buf.getvalue()).decode("ascii"), "filename": f"slide{i}.jpg",
+                   "doctor": doctor if i % 2 else None}
+        s = time.perf_counter()
+        status, body = call("POST", "/jobs", payload)
+        accepted.append(time.perf_counter() - s)
+        if status != 202:
+            raise RuntimeError(f"POST /jobs -> {status} {body[:200]}")
+        ids.append(json.loads(body)["id"])
+        started[ids[-1]] = s
+    total, done, failed = [], set(), 0
+    deadline = time.time() + 120
+    while len(done) < len(ids) and time.time() < deadline:
+        for job_id in ids:
+            if job_id in done:
+                continue
+            job = json.loads(call("GET", f"/jobs/{job_id}", peer=True)[1])
+            if job["status"] in ("done", "failed"):
+                done.add(job_id)
+                failed += job["status"] == "failed"
+                total.append(time.perf_counter() - started[job_id])
+        time.sleep(0.02)
+    pdf_status, pdf = call("GET", f"/jobs/{ids[0]}/pdf", peer=True)
+    unauthorized = call("GET", f"/jobs/{ids[0]}/pdf", auth=False)[0]
+    unknown_doctor = call("POST", "/jobs", dict(payload, doctor="rec" + "0" * 14))[0]
+    writer = archive_writer(table)
+    while writer.stats()["queued"] and time.time() < deadline:
+        time.sleep(0.05)
+    health = json.loads(call("GET", "/healthz")[1])
+    metrics_ok = b"pathan_service_jobs" in call("GET", "/metrics")[1]
+    for c in conns:
+        c.close()
+    loop.call_soon_threadsafe(loop.stop)
+    return {"worker_import_s": float(import_s), "worker_imports_streamlit": streamlit_loaded == "True",
+            "accept": stats(accepted), "job": stats(total), "jobs": len(ids), "failed": failed,
+            "pdf_ok": pdf_status == 200 and pdf[:4] == b"%PDF", "records_written": writer.stats()["written"],
+            "health": health["jobs"], "metrics_ok": metrics_ok,
+            "no_token_status": unauthorized, "unknown_doctor_status": unknown_doctor}
+
+
+def bench_archive(stub, sizes):
+    from pyairtable import Api
+    from pathan.archive import ArchiveMirror
+    api = Api("bench", endpoint_url=stub.url)
+    out = {}
+    for n in sizes:
+        table_name = f"records_{n}"
+        seed_archive(stub, table_name, n)
+        table = api.table(BASE_ID, table_name)
+        path = os.path.join(os.environ["PATHAN_DATA_DIR"], f"bench_archive_{n}.sqlite")
+        mirror = ArchiveMirror(table, path)
+        requests_before = stub.requests
+        t0 = time.perf_counter(); mirror.sync(); cold = time.perf_counter() - t0
+        cold_requests = stub.requests - requests_before
+        t0 = time.perf_counter(); records = mirror.records(); read_all = time.perf_counter() - t0
+        pages = []
+        for _ in range(20):
+            s = time.perf_counter(); mirror.search(limit=20); pages.append(time.perf_counter() - s)
+        searches = []
+        for _ in range(20):
+            s = time.perf_counter(); mirror.search(text="карцин", biopsy="Мазок", limit=20); searches.append(time.perf_counter() - s)
+        t0 = time.perf_counter(); direct = table.all(); direct_fetch = time.perf_counter() - t0
+        out[str(n)] = {
+            "records": len(records), "cold_sync": cold, "cold_sync_requests": cold_requests,
+            "read_all": read_all, "page": stats(pages), "search": stats(searches),
+            "direct_table_all": direct_fetch, "direct_records": len(direct),
+        }
+    return out
+
+
+def git_rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=ROOT).stdout.strip()
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline PathanAI benchmarks")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--archive-sizes", default="100,1000,10000")
+    parser.add_argument("--rerun-archive", type=int, default=1000)
+    parser.add_argument("--reruns", type=int, default=20)
+    parser.add_argument("--logins", type=int, default=10)
+    parser.add_argument("--cold-starts", type=int, default=3)
+    parser.add_argument("--pdf-count", type=int, default=50)
+    parser.add_argument("--model-latency", type=float, default=0.05)
+    parser.add_argument("--model-latency-per-kb", type=float, default=0.0002)
+    parser.add_argument("--airtable-latency", type=float, default=0.0)
+    parser.add_argument("--chat-turns", type=int, default=30)
+    parser.add_argument("--route-calls", type=int, default=60)
+    parser.add_argument("--phash-size", type=int, default=100000)
+    parser.add_argument("--analytics-size", type=int, default=100000)
+    parser.add_argument("--service-jobs", type=int, default=20)
+    parser.add_argument("--route-slow-share", type=float, default=0.2)
+    parser.add_argument("--route-slow-extra", type=float, default=2.0)
+    parser.add_argument("--only", default="", help="comma-separated subset: cold_start,login,rerun,pdf,archive,chat,routing,phash,analytics,service")
+    args = parser.parse_args(argv)
+
+    data_dir = tempfile.mkdtemp(prefix="pathan-bench-")
+    os.environ["PATHAN_DATA_DIR"] = data_dir
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+
+    from bench import fakes
+    from bench.airtable_stub import AirtableStub
+    fakes.install()
+    fakes.settings.latency = args.model_latency
+    fakes.settings.latency_per_kb = args.model_latency_per_kb
+
+    stub = AirtableStub(latency=args.airtable_latency).start()
+    stub.seed(USERS_TABLE, [{"Name": "Dr Bench", "Password": "bench-password", "Role": "Doctor"}])
+    user_id = stub.tables[USERS_TABLE][0]["id"]
+    seed_archive(stub, "records_rerun", args.rerun_archive)
+    secrets = secrets_for(stub, "records_rerun")
+
+    only = set(filter(None, args.only.split(",")))
+    results = {}
+    scenarios = [
+        ("cold_start", lambda: bench_cold_start(secrets, args.cold_starts)),
+        ("login", lambda: bench_login(stub, secrets, args.logins)),
+        ("rerun", lambda: bench_rerun(secrets, user_id, args.reruns)),
+        ("pdf", lambda: bench_pdf(args.pdf_count)),
+        ("archive", lambda: bench_archive(stub, [int(n) for n in args.archive_sizes.split(",") if n])),
+        ("chat", lambda: bench_chat(args.chat_turns)),
+        ("routing", lambda: bench_routing(args.route_calls, args.route_slow_share, args.route_slow_extra)),
+        ("phash", lambda: bench_phash(args.phash_size)),
+        ("analytics", lambda: bench_analytics(args.analytics_size)),
+        ("service", lambda: bench_service(secrets, args.service_jobs)),
+    ]
+    for name, fn in scenarios:
+        if only and name not in only:
+            continue
+        print(f"[bench] {name} ...", file=sys.stderr)
+        try:
+            results[name] = fn()
+        except Exception as e:
+            results[name] = {"error": f"{type(e).__name__}: {e}"}
+    stub.stop()
+
+    from pathan.metrics import summary
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "git": git_rev(), "python": platform.python_version(), "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "results": results,
+        "stages": summary(),
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False, default=str)
+    print(json.dumps(results, indent=2, ensure_ascii=False, default=str))
+
+
+if __name__ == "__main__":
+    main()
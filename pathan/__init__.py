@@ -0,0 +1,2 @@
+# Общие компоненты PathanAI, используемые обоими приложениями.
+# Модули пакета не импортируют streamlit и живут на уровне процесса сервера.
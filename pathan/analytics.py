@@ -0,0 +1,183 @@
+import datetime
+import threading
+
+import numpy as np
+
+from pathan.archive import GENDER_VALUES
+from pathan.metrics import span
+
+# --- АНАЛИТИКА АРХИВА ---
+# Поля записей, нужные для сводки, хранятся по столбцам в массивах NumPy:
+# категории - целыми кодами, дата - номером дня, срок выполнения - float
+# (NaN у старых записей). Столбцы один раз заполняются из зеркала архива,
+# дальше их обновляет слушатель зеркала при записи и синхронизации.
+# Сводка - bincount по столбцам, она кэшируется до следующего изменения.
+
+TISSUE_FIELD = "Tissue"
+TURNAROUND_FIELD = "Turnaround Seconds"
+FIELDS = ("Biopsy Method", TISSUE_FIELD, "Gender", TURNAROUND_FIELD)
+GENDERS = ("unknown", "male", "female")
+_GENDER_CODES = {v: GENDERS.index(key) for key, values in GENDER_VALUES.items() for v in values}
+_EPOCH = datetime.date(1970, 1, 1)
+
+
+def day_number(value):
+    # Дата или ISO-строка -> дней от 1970-01-01, -1 если даты нет
+    if isinstance(value, datetime.date):
+        return (value - _EPOCH).days
+    try: return (datetime.date.fromisoformat((value or "")[:10]) - _EPOCH).days
+    except ValueError: return -1
+
+
+def _week_start(week):
+    # Неделя с понедельника: 1970-01-01 - четверг
+    return _EPOCH + datetime.timedelta(days=int(week) * 7 - 3)
+
+
+class Codes:
+    def __init__(self):
+        self.labels = []
+        self._codes = {}
+
+    def code(self, value):
+        value = str(value) if value not in (None, "") else "-"
+        c = self._codes.get(value)
+        if c is None:
+            c = self._codes[value] = len(self.labels)
+            self.labels.append(value)
+        return c
+
+
+def _counts(codes, labels):
+    n = np.bincount(codes, minlength=len(labels))
+    return sorted(((labels[i], int(n[i])) for i in np.flatnonzero(n)), key=lambda x: -x[1])
+
+
+class ArchiveStats:
+    def __init__(self, capacity=1024):
+        self._lock = threading.Lock()
+        self._ids = []
+        self._slots = {}
+        self.methods = Codes()
+        self.tissues = Codes()
+        self.version = 0
+        self._cache = None
+        self._method = np.zeros(capacity, np.int32)
+        self._tissue = np.zeros(capacity, np.int32)
+        self._gender = np.zeros(capacity, np.int8)
+        self._day = np.zeros(capacity, np.int32)
+        self._turnaround = np.zeros(capacity, np.float32)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _grow(self, size):
+        capacity = len(self._day)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for name in ("_method", "_tissue", "_gender", "_day", "_turnaround"):
+            old = getattr(self, name)
+            new = np.zeros(capacity, old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def _put(self, record_id, created_time, method, tissue, gender, turnaround):
+        i = self._slots.get(record_id)
+        if i is None:
+            self._grow(len(self._ids) + 1)
+            i = self._slots[record_id] = len(self._ids)
+            self._ids.append(record_id)
+        self._method[i] = self.methods.code(method)
+        self._tissue[i] = self.tissues.code(tissue)
+        self._gender[i] = _GENDER_CODES.get(gender, 0)
+        self._day[i] = day_number(created_time)
+        try: self._turnaround[i] = float(turnaround) if turnaround is not None else np.nan
+        except (TypeError, ValueError): self._turnaround[i] = np.nan
+
+    def _remove(self, record_id):
+        i = self._slots.pop(record_id, None)
+        if i is None:
+            return
+        last = len(self._ids) - 1
+        if i != last:
+            self._ids[i] = self._ids[last]
+            self._slots[self._ids[i]] = i
+            for a in (self._method, self._tissue, self._gender, self._day, self._turnaround):
+                a[i] = a[last]
+        self._ids.pop()
+
+    def load(self, rows):
+        # rows: [(id, created_time, метод, ткань, пол, срок)] из ArchiveMirror.columns(FIELDS)
+        with self._lock:
+            self._grow(len(self._ids) + len(rows))
+            for row in rows:
+                self._put(*row)
+            self.version += 1
+
+    def on_records(self, records):
+        # Слушатель зеркала архива
+        with self._lock:
+            for r in records:
+                if r.get('deleted'):
+                    self._remove(r['id'])
+                    continue
+                f = r.get('fields', {})
+                self._put(r['id'], r.get('createdTime', ''), *(f.get(name) for name in FIELDS))
+            self.version += 1
+
+    def summary(self, date_from=None, date_to=None):
+        key = (self.version, date_from, date_to)
+        cached = self._cache
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        with span("analytics_summary"), self._lock:
+            n = len(self._ids)
+            day = self._day[:n]
+            mask = day >= 0
+            if date_from: mask &= day >= day_number(date_from)
+            if date_to: mask &= day <= day_number(date_to)
+            method, tissue, gender = self._method[:n][mask], self._tissue[:n][mask], self._gender[:n][mask]
+            day, turnaround = day[mask], self._turnaround[:n][mask]
+            method_labels, tissue_labels = list(self.methods.labels), list(self.tissues.labels)
+        result = {
+            "total": int(len(day)),
+            "method": _counts(method, method_labels),
+            "tissue": _counts(tissue, tissue_labels),
+            "gender": _counts(gender, GENDERS),
+            "weeks": [], "turnaround": None, "turnaround_weeks": [],
+        }
+        if len(day):
+            # Недели без записей тоже попадают в ряд - с нулём
+            week = (day + 3) // 7
+            first = int(week.min())
+            result["weeks"] = [(_week_start(first + i), int(c)) for i, c in enumerate(np.bincount(week - first))]
+            done = ~np.isnan(turnaround)
+            if done.any():
+                t, w = turnaround[done], week[done]
+                p50, p90 = np.percentile(t, [50, 90])
+                result["turnaround"] = {"n": int(len(t)), "mean": float(t.mean()), "p50": float(p50), "p90": float(p90)}
+                # Медиана по неделям: сортировка по (неделя, срок) и середина каждой группы
+                order = np.lexsort((t, w))
+                t, w = t[order], w[order]
+                weeks, start, count = np.unique(w, return_index=True, return_counts=True)
+                result["turnaround_weeks"] = [(_week_start(wk), float(m)) for wk, m in zip(weeks, t[start + (count - 1) // 2])]
+        self._cache = (key, result)
+        return result
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def archive_stats(mirror):
+    # Одна сводка на зеркало архива; столбцы заполняются из SQLite один раз на процесс
+    with _stats_lock:
+        stats = _stats.get(id(mirror))
+        if stats is None:
+            stats = _stats[id(mirror)] = ArchiveStats()
+            mirror.listeners.append(stats.on_records)
+            with span("analytics_load"):
+                stats.load(mirror.columns(FIELDS))
+        return stats
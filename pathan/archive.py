@@ -0,0 +1,298 @@
+import datetime
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from pathan.config import data_path, env_float
+from pathan.metrics import span
+
+# --- ЛОКАЛЬНОЕ ЗЕРКАЛО АРХИВА ---
+# Таблица записей Airtable копируется в SQLite и догружается по дельтам
+# (LAST_MODIFIED_TIME). Архив читается из зеркала, а не из сети.
+
+SYNC_INTERVAL = env_float("PATHAN_ARCHIVE_SYNC_INTERVAL", 30)
+FULL_SYNC_INTERVAL = env_float("PATHAN_ARCHIVE_FULL_SYNC_INTERVAL", 6 * 3600)
+# Запас на расхождение часов между сервером и Airtable
+CLOCK_SKEW = 120
+FTS_VERSION = "2"
+# Значения пола в записях зависят от языка интерфейса при сохранении
+TEXT_FIELDS = ('Patient Name', 'Short Summary', 'AI Conclusion')
+GENDER_VALUES = {"male": ("Мужской", "Male"), "female": ("Женский", "Female")}
+
+
+def _iso(ts):
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def _field(name):
+    return "json_extract(fields, '$.\"%s\"')" % name
+
+
+def flatten(record):
+    # Плоская запись: поля Airtable плюс record_id и created_time
+    fields = dict(record.get('fields', {}))
+    fields['record_id'] = record.get('id')
+    fields['created_time'] = record.get('createdTime', '')
+    return fields
+
+
+class ArchiveMirror:
+    def __init__(self, table, path=None):
+        self.table = table
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._syncing = False
+        self.listeners = []
+        self._db = sqlite3.connect(path or data_path("archive.sqlite"), check_same_thread=False)
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS records ("
+            " id TEXT PRIMARY KEY, created_time TEXT NOT NULL, fields TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS records_created ON records(created_time DESC);"
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);"
+        )
+        self.fts = self._init_fts()
+        self._db.commit()
+
+    def _init_fts(self):
+        # Полнотекстовый индекс по ФИО, краткому выводу и заключению
+        # rowid индекса совпадает с rowid записи в records, удаление идёт по ключу, а не сканированием
+        rebuild = self._meta("fts_version") != FTS_VERSION
+        try:
+            if rebuild:
+                self._db.execute("DROP TABLE IF EXISTS records_fts")
+            self._db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS records_fts USING fts5("
+                "patient_name, summary, conclusion, tokenize='unicode61 remove_diacritics 2')"
+            )
+        except sqlite3.OperationalError:
+            return False
+        if rebuild:
+            for rowid, fields in self._db.execute("SELECT rowid, fields FROM records").fetchall():
+                self._index(rowid, json.loads(fields))
+            self._set_meta("fts_version", FTS_VERSION)
+        return True
+
+    def _index(self, rowid, fields):
+        self._db.execute("DELETE FROM records_fts WHERE rowid=?", (rowid,))
+        self._db.execute(
+            "INSERT INTO records_fts(rowid, patient_name, summary, conclusion) VALUES (?,?,?,?)",
+            (rowid, fields.get('Patient Name', ''), fields.get('Short Summary', ''), fields.get('AI Conclusion', '')),
+        )
+
+    def _meta(self, key, default=None):
+        row = self._db.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key, value):
+        self._db.execute("INSERT OR REPLACE INTO meta(key, value) VALUES (?,?)", (key, str(value)))
+
+    def last_sync(self):
+        with self._lock:
+            return float(self._meta("last_sync", 0))
+
+    def upsert(self, records):
+        if not records:
+            return
+        with self._lock:
+            for r in records:
+                # ON CONFLICT сохраняет rowid записи, на него ссылается полнотекстовый индекс
+                rowid = self._db.execute(
+                    "INSERT INTO records(id, created_time, fields) VALUES (?,?,?) "
+                    "ON CONFLICT(id) DO UPDATE SET created_time=excluded.created_time, fields=excluded.fields "
+                    "RETURNING rowid",
+                    (r['id'], r.get('createdTime', ''), json.dumps(r.get('fields', {}), ensure_ascii=False)),
+                ).fetchone()[0]
+                if self.fts:
+                    self._index(rowid, r.get('fields', {}))
+            self._db.commit()
+        self._notify(records)
+
+    def _notify(self, records):
+        # Слушатели (индексы, аналитика) получают изменённые записи; удалённые - с пометкой deleted
+        for listener in list(self.listeners):
+            try: listener(records)
+            except Exception: pass
+
+    def sync(self, full=False):
+        with self._sync_lock, span("archive_sync"):
+            started = time.time()
+            with self._lock:
+                last = float(self._meta("last_sync", 0))
+                last_full = float(self._meta("last_full_sync", 0))
+            full = full or not last or started - last_full > FULL_SYNC_INTERVAL
+            options = {}
+            if not full:
+                options["formula"] = f"IS_AFTER(LAST_MODIFIED_TIME(), DATETIME_PARSE('{_iso(last - CLOCK_SKEW)}'))"
+            seen = set()
+            stale = []
+            count = 0
+            for page in self.table.iterate(**options):
+                self.upsert(page)
+                seen.update(r['id'] for r in page)
+                count += len(page)
+            with self._lock:
+                if full:
+                    # Полная сверка удаляет записи, которых больше нет в Airtable
+                    stale = [row[0] for row in self._db.execute("SELECT id FROM records") if row[0] not in seen]
+                    if self.fts:
+                        self._db.executemany("DELETE FROM records_fts WHERE rowid IN (SELECT rowid FROM records WHERE id=?)", [(i,) for i in stale])
+                    self._db.executemany("DELETE FROM records WHERE id=?", [(i,) for i in stale])
+                    self._set_meta("last_full_sync", started)
+                self._set_meta("last_sync", started)
+                self._db.commit()
+            if stale:
+                self._notify([{'id': i, 'deleted': True} for i in stale])
+            return count
+
+    def _sync_in_background(self):
+        try: self.sync()
+        except Exception: pass
+        finally:
+            with self._lock:
+                self._syncing = False
+
+    def maybe_sync(self):
+        last = self.last_sync()
+        if not last:
+            # Зеркало ещё пустое: первая загрузка синхронно
+            self.sync()
+            return
+        if time.time() - last < SYNC_INTERVAL:
+            return
+        with self._lock:
+            if self._syncing:
+                return
+            self._syncing = True
+        threading.Thread(target=self._sync_in_background, daemon=True).start()
+
+    def records(self, limit=None, offset=0):
+        sql = "SELECT id, created_time, fields FROM records ORDER BY created_time DESC"
+        args = ()
+        if limit is not None:
+            sql += " LIMIT ? OFFSET ?"
+            args = (limit, offset)
+        with self._lock:
+            rows = self._db.execute(sql, args).fetchall()
+        return [flatten({'id': i, 'createdTime': c, 'fields': json.loads(f)}) for i, c, f in rows]
+
+    def get(self, record_id):
+        with self._lock:
+            row = self._db.execute("SELECT id, created_time, fields FROM records WHERE id=?", (record_id,)).fetchone()
+        if row is None:
+            return None
+        return flatten({'id': row[0], 'createdTime': row[1], 'fields': json.loads(row[2])})
+
+    def _filters(self, text=None, biopsy=None, gender=None, date_from=None, date_to=None, doctor=None):
+        where, args = [], []
+        if text and text.strip():
+            if self.fts:
+                terms = " ".join('"%s"*' % w.replace('"', '""') for w in text.split())
+                where.append("rowid IN (SELECT rowid FROM records_fts WHERE records_fts MATCH ?)")
+                args.append(terms)
+            else:
+                for w in text.split():
+                    where.append("(" + " OR ".join(_field(f) + " LIKE ?" for f in TEXT_FIELDS) + ")")
+                    args.extend(["%" + w + "%"] * len(TEXT_FIELDS))
+        if biopsy:
+            where.append(_field('Biopsy Method') + " = ?")
+            args.append(biopsy)
+        if gender in GENDER_VALUES:
+            where.append(_field('Gender') + " IN (?, ?)")
+            args.extend(GENDER_VALUES[gender])
+        if date_from:
+            where.append("created_time >= ?")
+            args.append(str(date_from))
+        if date_to:
+            # Включительно: всё, что раньше следующего дня
+            where.append("created_time < ?")
+            args.append(str(date_to + datetime.timedelta(days=1)))
+        if doctor:
+            # Doctor - связь с таблицей пользователей, список id
+            where.append("EXISTS (SELECT 1 FROM json_each(fields, '$.Doctor') WHERE value = ?)")
+            args.append(doctor)
+        return where, args
+
+    def search(self, text=None, biopsy=None, gender=None, date_from=None, date_to=None, limit=20, offset=0, doctor=None):
+        # Страница архива без полного заключения; возвращает (записи, всего найдено)
+        where, args = self._filters(text, biopsy, gender, date_from, date_to, doctor)
+        clause = (" WHERE " + " AND ".join(where)) if where else ""
+        with self._lock:
+            total = self._db.execute("SELECT COUNT(*) FROM records" + clause, args).fetchone()[0]
+            rows = self._db.execute(
+                "SELECT id, created_time, json_remove(fields, '$.\"AI Conclusion\"') FROM records" + clause
+                + " ORDER BY created_time DESC LIMIT ? OFFSET ?",
+                args + [limit, offset],
+            ).fetchall()
+        return [flatten({'id': i, 'createdTime': c, 'fields': json.loads(f)}) for i, c, f in rows], total
+
+    def iter_records(self, batch=200, **filters):
+        # Полные записи по фильтру порциями; курсор по (created_time, rowid),
+        # в памяти не больше одной порции
+        where, args = self._filters(**filters)
+        cursor = None
+        while True:
+            page_where = where + (["(created_time, rowid) < (?, ?)"] if cursor else [])
+            clause = (" WHERE " + " AND ".join(page_where)) if page_where else ""
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT rowid, id, created_time, fields FROM records" + clause
+                    + " ORDER BY created_time DESC, rowid DESC LIMIT ?",
+                    args + list(cursor or ()) + [batch],
+                ).fetchall()
+            for _, i, c, f in rows:
+                yield flatten({'id': i, 'createdTime': c, 'fields': json.loads(f)})
+            if len(rows) < batch:
+                return
+            cursor = (rows[-1][2], rows[-1][0])
+
+    def count(self, **filters):
+        where, args = self._filters(**filters)
+        clause = (" WHERE " + " AND ".join(where)) if where else ""
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM records" + clause, args).fetchone()[0]
+
+    def field_values(self, name):
+        # [(id, значение)] по всем записям, где поле заполнено
+        with self._lock:
+            return self._db.execute(
+                "SELECT id, " + _field(name) + " AS v FROM records WHERE v IS NOT NULL"
+            ).fetchall()
+
+    def columns(self, names):
+        # [(id, created_time, значения полей...)] по всем записям, без разбора JSON в Python
+        with self._lock:
+            return self._db.execute(
+                "SELECT id, created_time, " + ", ".join(_field(n) for n in names) + " FROM records"
+            ).fetchall()
+
+    def conclusion(self, record_id):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT " + _field('AI Conclusion') + " FROM records WHERE id=?", (record_id,)
+            ).fetchone()
+        return (row[0] or '') if row else ''
+
+
+_mirrors = {}
+_mirrors_lock = threading.Lock()
+
+
+def table_key(table):
+    try: return f"{table.base.id}_{table.id_or_name}"
+    except Exception: return str(id(table))
+
+
+def archive_mirror(table):
+    # Одно зеркало на таблицу на процесс, общее для всех сессий
+    key = table_key(table)
+    with _mirrors_lock:
+        mirror = _mirrors.get(key)
+        if mirror is None:
+            name = hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+            mirror = ArchiveMirror(table, data_path(f"archive_{name}.sqlite"))
+            _mirrors[key] = mirror
+        else:
+            mirror.table = table
+        return mirror
@@ -0,0 +1,208 @@
+import json
+import os
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+
+from pathan.config import data_path, env_float, env_int
+from pathan.metrics import register_gauge
+
+# --- АРТЕФАКТЫ СЕССИЙ ---
+# Крупные объекты сессии (PDF, тексты заключений, история чата) лежат в общем
+# хранилище, а в st.session_state - только короткие ключи. Память
+# ограничена общим лимитом: давно не использованное вытесняется на диск,
+# диск тоже ограничен. Артефакты сессии удаляются, когда Streamlit
+# освобождает её состояние (weakref-финализатор) или после простоя.
+
+ARTIFACT_MEMORY_BYTES = env_int("PATHAN_ARTIFACT_MEMORY_BYTES", 64 * 1024 * 1024)
+ARTIFACT_DISK_BYTES = env_int("PATHAN_ARTIFACT_DISK_BYTES", 1024 * 1024 * 1024)
+ARTIFACT_IDLE_TTL = env_float("PATHAN_ARTIFACT_IDLE_TTL", 4 * 3600)
+SWEEP_INTERVAL = 60
+
+
+def _alive(pid):
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    except OSError: pass
+    return True
+
+
+def _remove_orphans(parent):
+    # Каталоги процессов, которых уже нет: после перезапуска их артефакты никому не принадлежат
+    for name in os.listdir(parent):
+        if not name.isdigit() or int(name) == os.getpid() or _alive(int(name)):
+            continue
+        directory = os.path.join(parent, name)
+        for f in os.listdir(directory):
+            try: os.remove(os.path.join(directory, f))
+            except OSError: pass
+        try: os.rmdir(directory)
+        except OSError: pass
+
+
+class ArtifactStore:
+    def __init__(self, root=None, memory_bytes=ARTIFACT_MEMORY_BYTES, disk_bytes=ARTIFACT_DISK_BYTES, idle_ttl=ARTIFACT_IDLE_TTL):
+        self.root = root or os.path.dirname(data_path("artifacts", str(os.getpid()), "x"))
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.idle_ttl = idle_ttl
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()   # handle -> bytes
+        self._disk = OrderedDict()     # handle -> size
+        self._owner = {}               # handle -> session
+        self._sessions = {}            # session -> {handle: size}
+        self._touched = {}             # session -> time
+        self._memory_size = 0
+        self._disk_size = 0
+        self._last_sweep = time.time()
+        os.makedirs(self.root, exist_ok=True)
+        _remove_orphans(os.path.dirname(self.root))
+
+    def _path(self, handle):
+        return os.path.join(self.root, handle)
+
+    def put(self, session, data, handle=None):
+        handle = handle or uuid.uuid4().hex
+        with self._lock:
+            self._drop(handle)
+            self._memory[handle] = data
+            self._memory_size += len(data)
+            self._owner[handle] = session
+            self._sessions.setdefault(session, {})[handle] = len(data)
+            self._touched[session] = time.time()
+            self._spill()
+        self._maybe_sweep()
+        return handle
+
+    def get(self, handle):
+        with self._lock:
+            session = self._owner.get(handle)
+            if session is None:
+                return None
+            self._touched[session] = time.time()
+            data = self._memory.get(handle)
+            if data is not None:
+                self._memory.move_to_end(handle)
+                return data
+            self._disk.move_to_end(handle)
+        try:
+            with open(self._path(handle), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, handle):
+        with self._lock:
+            self._drop(handle)
+
+    def _drop(self, handle):
+        session = self._owner.pop(handle, None)
+        if session is not None:
+            self._sessions.get(session, {}).pop(handle, None)
+        data = self._memory.pop(handle, None)
+        if data is not None:
+            self._memory_size -= len(data)
+        size = self._disk.pop(handle, None)
+        if size is not None:
+            self._disk_size -= size
+            try: os.remove(self._path(handle))
+            except OSError: pass
+
+    def _spill(self):
+        # Давно не использованное уходит из памяти на диск
+        while self._memory_size > self.memory_bytes and len(self._memory) > 1:
+            handle, data = self._memory.popitem(last=False)
+            self._memory_size -= len(data)
+            with open(self._path(handle), "wb") as f:
+                f.write(data)
+            self._disk[handle] = len(data)
+            self._disk_size += len(data)
+        while self._disk_size > self.disk_bytes and self._disk:
+            self._drop(next(iter(self._disk)))
+
+    def release(self, session):
+        with self._lock:
+            for handle in list(self._sessions.pop(session, {})):
+                self._drop(handle)
+            self._touched.pop(session, None)
+
+    def _maybe_sweep(self):
+        now = time.time()
+        if now - self._last_sweep < SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        with self._lock:
+            idle = [s for s, t in self._touched.items() if now - t > self.idle_ttl]
+        for session in idle:
+            self.release(session)
+
+    def session_bytes(self):
+        with self._lock:
+            return {session: sum(sizes.values()) for session, sizes in self._sessions.items() if sizes}
+
+    def stats(self):
+        with self._lock:
+            return {"memory": self._memory_size, "disk": self._disk_size, "sessions": len(self._sessions)}
+
+
+class SessionArtifacts:
+    # Хранится в st.session_state; когда Streamlit освобождает состояние
+    # закрытой сессии, финализатор удаляет все её артефакты
+    def __init__(self, store):
+        self.store = store
+        self.id = uuid.uuid4().hex[:12]
+        self._handles = {}
+        weakref.finalize(self, store.release, self.id)
+
+    def put(self, name, data):
+        # Один артефакт на имя: новое значение заменяет старое
+        self._handles[name] = self.store.put(self.id, data, self._handles.get(name))
+        return self._handles[name]
+
+    def get(self, name):
+        handle = self._handles.get(name)
+        return self.store.get(handle) if handle else None
+
+    def put_text(self, name, text):
+        return self.put(name, text.encode("utf-8"))
+
+    def get_text(self, name, default=None):
+        data = self.get(name)
+        return data.decode("utf-8") if data is not None else default
+
+    def put_json(self, name, value):
+        return self.put(name, json.dumps(value, ensure_ascii=False).encode("utf-8"))
+
+    def get_json(self, name, default=None):
+        data = self.get(name)
+        return json.loads(data) if data is not None else default
+
+    def drop(self, *names):
+        for name in names:
+            handle = self._handles.pop(name, None)
+            if handle: self.store.delete(handle)
+
+    def __contains__(self, name):
+        return name in self._handles
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def artifact_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ArtifactStore()
+                register_gauge("pathan_session_bytes", "Artifact bytes held per session", _store.session_bytes)
+                register_gauge("pathan_artifact_memory_bytes", "Session artifact bytes kept in memory", lambda: _store.stats()["memory"])
+                register_gauge("pathan_artifact_disk_bytes", "Session artifact bytes spilled to disk", lambda: _store.stats()["disk"])
+    return _store
+
+
+def session_artifacts():
+    return SessionArtifacts(artifact_store())
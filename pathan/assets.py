@@ -0,0 +1,224 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from io import BytesIO
+
+from PIL import Image
+
+from pathan.config import data_path, env_int
+from pathan.imaging import to_rgb
+from pathan.metrics import register_gauge, span
+
+# --- ЛОКАЛЬНОЕ ХРАНИЛИЩЕ СНИМКОВ ---
+# Снимки лежат на диске под своим sha256 (тот же digest, что у PreparedImage).
+# Записи Airtable ссылаются на снимок по хэшу ("Image Hash"). Миниатюры
+# фиксированных размеров создаются при сохранении и вытесняются по своему
+# лимиту, отдельно от оригиналов: они в десятки раз меньше, поэтому карточки
+# архива и повторная печать PDF не ходят в сеть и после того, как оригинал
+# вытеснен.
+
+ASSET_MAX_BYTES = env_int("PATHAN_ASSET_MAX_BYTES", 512 * 1024 * 1024)
+THUMB_MAX_BYTES = env_int("PATHAN_THUMB_MAX_BYTES", 256 * 1024 * 1024)
+# Длинная сторона миниатюры: карточка архива и картинка в PDF
+THUMB_SIZES = {"card": 256, "pdf": 1024}
+THUMB_QUALITY = 80
+
+
+def asset_key(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class AssetStore:
+    def __init__(self, root=None, max_bytes=ASSET_MAX_BYTES, thumb_max_bytes=THUMB_MAX_BYTES):
+        self.root = root or os.path.dirname(data_path("assets", "index.sqlite"))
+        self.max_bytes = max_bytes
+        self.thumb_max_bytes = thumb_max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(self.root, "index.sqlite"), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS originals ("
+            "digest TEXT PRIMARY KEY, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS originals_accessed ON originals(accessed)")
+        # Внешние ключи (например, id вложения Airtable) -> хэш снимка
+        self._db.execute("CREATE TABLE IF NOT EXISTS aliases (key TEXT PRIMARY KEY, digest TEXT NOT NULL)")
+        new_thumbs = not self._db.execute("SELECT 1 FROM sqlite_master WHERE name='thumbs'").fetchone()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS thumbs ("
+            "digest TEXT NOT NULL, kind TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL,"
+            " PRIMARY KEY (digest, kind))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS thumbs_accessed ON thumbs(accessed)")
+        if new_thumbs:
+            self._index_thumbs()
+        self._db.commit()
+
+    def _index_thumbs(self):
+        # Миниатюры, созданные до учёта их размера, один раз попадают в индекс
+        now = time.time()
+        for kind in THUMB_SIZES:
+            for directory, _, files in os.walk(os.path.join(self.root, kind)):
+                for name in files:
+                    if name.endswith(".jpg"):
+                        self._db.execute("INSERT OR IGNORE INTO thumbs VALUES (?,?,?,?)",
+                                         (name[:-4], kind, os.path.getsize(os.path.join(directory, name)), now))
+
+    def _path(self, digest, kind="original"):
+        return os.path.join(self.root, kind, digest[:2], digest + ".jpg")
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "%s.%d.tmp" % (path, threading.get_ident())
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def put(self, data, digest=None):
+        # data - JPEG (PreparedImage.data); повторное сохранение того же снимка ничего не пишет
+        digest = digest or asset_key(data)
+        now = time.time()
+        with self._lock:
+            known = self._db.execute("SELECT 1 FROM originals WHERE digest=?", (digest,)).fetchone()
+            if known and os.path.exists(self._path(digest)):
+                self._db.execute("UPDATE originals SET accessed=? WHERE digest=?", (now, digest))
+                self._db.commit()
+                return digest
+        with span("asset_store"):
+            self._write(self._path(digest), data)
+            self._make_thumbs(digest, data)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO originals(digest, size, accessed) VALUES (?,?,?)",
+                (digest, len(data), now),
+            )
+            self._evict(keep=digest)
+            self._db.commit()
+        return digest
+
+    def _make_thumbs(self, digest, data):
+        im = to_rgb(Image.open(BytesIO(data)))
+        made = []
+        # От большей миниатюры к меньшей, каждый раз уменьшая уже уменьшенное
+        for name, side in sorted(THUMB_SIZES.items(), key=lambda kv: -kv[1]):
+            path = self._path(digest, name)
+            if os.path.exists(path):
+                continue
+            im.thumbnail((side, side), Image.LANCZOS)
+            buf = BytesIO()
+            im.save(buf, format="JPEG", quality=THUMB_QUALITY, optimize=True)
+            self._write(path, buf.getvalue())
+            made.append((digest, name, len(buf.getvalue()), time.time()))
+        if made:
+            with self._lock:
+                self._db.executemany("INSERT OR REPLACE INTO thumbs VALUES (?,?,?,?)", made)
+                self._evict_thumbs(keep=digest)
+                self._db.commit()
+
+    def _evict_thumbs(self, keep=None):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM thumbs").fetchone()[0]
+        if total <= self.thumb_max_bytes:
+            return
+        # Миниатюры снимка вытесняются вместе: по времени последнего обращения к любой из них
+        rows = self._db.execute(
+            "SELECT digest, SUM(size) FROM thumbs GROUP BY digest ORDER BY MAX(accessed)").fetchall()
+        for digest, size in rows:
+            if digest == keep:
+                continue
+            for kind in THUMB_SIZES:
+                try: os.remove(self._path(digest, kind))
+                except FileNotFoundError: pass
+            self._db.execute("DELETE FROM thumbs WHERE digest=?", (digest,))
+            total -= size
+            if total <= self.thumb_max_bytes:
+                break
+
+    def _evict(self, keep=None):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM originals").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Оригиналы вытесняются по своему лимиту, миниатюры - по своему
+        for digest, size in self._db.execute("SELECT digest, size FROM originals ORDER BY accessed").fetchall():
+            if digest == keep:
+                continue
+            try: os.remove(self._path(digest))
+            except FileNotFoundError: pass
+            self._db.execute("DELETE FROM originals WHERE digest=?", (digest,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except (FileNotFoundError, TypeError):
+            return None
+
+    def original(self, digest):
+        data = self._read(self._path(digest)) if digest else None
+        if data is not None:
+            with self._lock:
+                self._db.execute("UPDATE originals SET accessed=? WHERE digest=?", (time.time(), digest))
+                self._db.commit()
+        return data
+
+    def thumbnail(self, digest, name="card"):
+        if not digest:
+            return None
+        data = self._read(self._path(digest, name))
+        if data is None:
+            # Миниатюры старых или вытесненных снимков догенерируются из оригинала, если он ещё есть
+            original = self._read(self._path(digest))
+            if original is None:
+                return None
+            self._make_thumbs(digest, original)
+            data = self._read(self._path(digest, name))
+        else:
+            with self._lock:
+                self._db.execute("UPDATE thumbs SET accessed=? WHERE digest=? AND kind=?", (time.time(), digest, name))
+                self._db.commit()
+        return data
+
+    def alias(self, key, digest):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO aliases(key, digest) VALUES (?,?)", (key, digest))
+            self._db.commit()
+
+    def lookup(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT digest FROM aliases WHERE key=?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def record_digest(self, fields):
+        # Хэш снимка записи: своё поле "Image Hash" или ранее скачанное вложение Airtable
+        digest = fields.get('Image Hash')
+        attachment = (fields.get('Image') or [{}])[0]
+        if not digest and attachment.get('id'):
+            digest = self.lookup(attachment['id'])
+        return digest
+
+    def stats(self):
+        with self._lock:
+            count, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM originals").fetchone()
+            thumbs = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM thumbs").fetchone()[0]
+        return {"originals": count, "bytes": size, "thumb_bytes": thumbs}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def asset_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = AssetStore()
+                register_gauge("pathan_asset_bytes", "Bytes of original slide images kept locally",
+                               lambda: _store.stats()["bytes"])
+                register_gauge("pathan_thumb_bytes", "Bytes of thumbnails kept locally",
+                               lambda: _store.stats()["thumb_bytes"])
+    return _store
@@ -0,0 +1,54 @@
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
+
+from pathan.config import env_int
+
+# --- ПАКЕТНЫЙ АНАЛИЗ ---
+# Несколько снимков одного случая анализируются параллельно. Одновременных
+# вызовов не больше BATCH_CONCURRENCY; частоту вызовов Gemini ограничивает
+# token bucket в общем планировщике (pathan/scheduler.py).
+
+BATCH_CONCURRENCY = env_int("PATHAN_BATCH_CONCURRENCY", 4)
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+ZIP_MAX_FILES = env_int("PATHAN_ZIP_MAX_FILES", 200)
+ZIP_MAX_FILE_BYTES = env_int("PATHAN_ZIP_MAX_FILE_BYTES", 64 * 1024 * 1024)
+
+
+def expand_uploads(files):
+    # Снимки и zip-архивы со снимками -> список (имя, байты)
+    out = []
+    for f in files:
+        name = getattr(f, "name", "upload")
+        data = f.getvalue()
+        if not name.lower().endswith(".zip"):
+            out.append((name, data))
+            continue
+        with zipfile.ZipFile(BytesIO(data)) as zf:
+            for info in zf.infolist():
+                base = os.path.basename(info.filename)
+                if info.is_dir() or info.filename.startswith("__MACOSX") or base.startswith("."):
+                    continue
+                if not base.lower().endswith(IMAGE_EXTENSIONS) or info.file_size > ZIP_MAX_FILE_BYTES:
+                    continue
+                out.append((base, zf.read(info)))
+                if len(out) >= ZIP_MAX_FILES:
+                    break
+    return out
+
+
+def run_batch(items, fn, concurrency=BATCH_CONCURRENCY, bucket=None):
+    # Возвращает результаты по мере готовности: (индекс, результат, ошибка).
+    # bucket - дополнительное ограничение частоты для fn, не идущих через планировщик
+    def call(item):
+        if bucket is not None: bucket.acquire()
+        return fn(item)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="pathan-batch") as pool:
+        futures = {pool.submit(call, item): i for i, item in enumerate(items)}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
@@ -0,0 +1,89 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+from pathan.config import data_path, env_float, env_int
+
+# --- КЭШ ОТВЕТОВ МОДЕЛИ ---
+# Ключ - хэш (модель, промпт, байты снимка). Повторный анализ того же снимка
+# с теми же данными пациента отдаёт сохранённый текст без вызова Gemini.
+
+CACHE_MAX_BYTES = env_int("PATHAN_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+CACHE_TTL = env_float("PATHAN_CACHE_TTL", 7 * 24 * 3600)
+
+
+def response_key(model_name, prompt, image_bytes):
+    h = hashlib.sha256()
+    for part in (model_name or "", prompt or ""):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    h.update(image_bytes or b"")
+    return h.hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path=None, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path or data_path("responses.sqlite"), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, text TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed)")
+        self._db.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT text, created FROM responses WHERE key=?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                self._db.execute("DELETE FROM responses WHERE key=?", (key,))
+                self._db.commit()
+                return None
+            self._db.execute("UPDATE responses SET accessed=? WHERE key=?", (now, key))
+            self._db.commit()
+            return row[0]
+
+    def put(self, key, text):
+        if not text:
+            return
+        now = time.time()
+        size = len(text.encode("utf-8"))
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses(key, text, size, created, accessed) VALUES (?,?,?,?,?)",
+                (key, text, size, now, now),
+            )
+            self._evict(now)
+            self._db.commit()
+
+    def _evict(self, now):
+        self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Вытесняем давно не использованные записи, пока не уложимся в лимит
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+            self._db.execute("DELETE FROM responses WHERE key=?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def response_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache()
+    return _cache
@@ -0,0 +1,150 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import google.generativeai as genai
+
+from pathan.config import env_int
+from pathan.metrics import span
+from pathan.scheduler import model_scheduler
+
+# --- ОГРАНИЧЕННЫЙ КОНТЕКСТ ЧАТА ---
+# Снимок загружается в Gemini Files API один раз, в уточняющих вопросах
+# передаётся ссылка на файл, а не inline-байты. Первый анализ закреплён в
+# контексте, последние ходы идут как есть, а всё, что старше и не влезает в
+# бюджет токенов, в фоне сжимается моделью в краткий пересказ. Размер
+# запроса на каждый вопрос перестаёт расти с длиной консультации.
+
+CHAT_HISTORY_TOKENS = env_int("PATHAN_CHAT_HISTORY_TOKENS", 3000)
+CHAT_KEEP_TURNS = env_int("PATHAN_CHAT_KEEP_TURNS", 2)
+CHAT_SUMMARY_WORDS = 150
+# Файлы в Gemini живут 48 часов
+FILE_TTL = 47 * 3600
+FILE_CACHE_SIZE = 64
+
+COMPACT_PROMPT = (
+    "Кратко перескажи эту часть консультации врача по гистологическому снимку: "
+    "вопросы врача и ключевые факты из ответов. Не больше {words} слов, без вступлений."
+)
+
+
+def estimate_tokens(text):
+    # Грубая оценка без сетевого вызова count_tokens: ~3 символа на токен для русского текста
+    return len(text or "") // 3 + 1
+
+
+_files = OrderedDict()
+_files_lock = threading.Lock()
+_uploader = ThreadPoolExecutor(max_workers=2, thread_name_prefix="pathan-upload")
+
+
+def _upload(prepared):
+    with span("file_upload"):
+        return genai.upload_file(BytesIO(prepared.data), mime_type=prepared.mime_type)
+
+
+def slide_file(prepared):
+    # Future со ссылкой на загруженный файл; один снимок загружается один раз на процесс
+    now = time.time()
+    with _files_lock:
+        entry = _files.get(prepared.digest)
+        if entry and now - entry[0] < FILE_TTL and not (entry[1].done() and entry[1].exception()):
+            _files.move_to_end(prepared.digest)
+            return entry[1]
+        future = _uploader.submit(_upload, prepared)
+        _files[prepared.digest] = (now, future)
+        while len(_files) > FILE_CACHE_SIZE:
+            _files.popitem(last=False)
+        return future
+
+
+class BoundedChat:
+    def __init__(self, model, prompt, prepared, analysis, budget=CHAT_HISTORY_TOKENS, keep_turns=CHAT_KEEP_TURNS):
+        self.model = model
+        self.prompt = prompt
+        self.prepared = prepared
+        self.analysis = analysis
+        self.budget = budget
+        self.keep_turns = keep_turns
+        self.summary = ""
+        self.turns = []
+        self.compactions = 0
+        self._file = slide_file(prepared)
+        self._lock = threading.Lock()
+        self._compacting = None
+
+    def _image(self):
+        # Пока файл загружается (или если загрузка не удалась) - inline-байты
+        if self._file.done() and not self._file.exception():
+            return self._file.result()
+        return self.prepared.blob()
+
+    def history_tokens(self):
+        return estimate_tokens(self.summary) + sum(estimate_tokens(q) + estimate_tokens(a) for q, a in self.turns)
+
+    def contents(self, question):
+        contents = [
+            {"role": "user", "parts": [self.prompt, self._image()]},
+            {"role": "model", "parts": [self.analysis]},
+        ]
+        if self.summary:
+            contents.append({"role": "user", "parts": ["Ранее в консультации: " + self.summary]})
+            contents.append({"role": "model", "parts": ["Понял, учитываю."]})
+        for q, a in self.turns:
+            contents.append({"role": "user", "parts": [q]})
+            contents.append({"role": "model", "parts": [a]})
+        contents.append({"role": "user", "parts": [question]})
+        return contents
+
+    def _wait_compaction(self):
+        thread = self._compacting
+        if thread is not None:
+            thread.join()
+
+    def send_message(self, question, stream=False):
+        # Возвращает билет планировщика: .text ждёт полный ответ, .stream() отдаёт
+        # куски по мере генерации. Ход записывается в историю, когда ответ получен
+        self._wait_compaction()
+        with self._lock:
+            contents = self.contents(question)
+        return model_scheduler().submit(
+            None, lambda: self.model.generate_content(contents, stream=stream), stream=stream,
+            on_done=lambda answer: self.record(question, answer))
+
+    def record(self, question, answer):
+        with self._lock:
+            self.turns.append((question, answer))
+            self._start_compaction()
+
+    def _start_compaction(self):
+        # Вызывается под _lock: одновременно идёт не больше одного сжатия
+        over = self.history_tokens() > self.budget and len(self.turns) > self.keep_turns
+        if over and self._compacting is None:
+            self._compacting = threading.Thread(target=self._compact, name="pathan-chat-compact", daemon=True)
+            self._compacting.start()
+
+    def _compact(self):
+        try:
+            with self._lock:
+                old = self.turns[:-self.keep_turns] if self.keep_turns else list(self.turns)
+                summary = self.summary
+            transcript = ([("Ранее", summary)] if summary else []) + [(f"Врач: {q}", f"Ответ: {a}") for q, a in old]
+            text = "\n".join(f"{q}\n{a}" for q, a in transcript)
+            try:
+                with span("chat_compact"):
+                    prompt = [COMPACT_PROMPT.format(words=CHAT_SUMMARY_WORDS), text]
+                    new_summary = model_scheduler().submit(None, lambda: self.model.generate_content(prompt)).result().strip()
+            except Exception:
+                # Без пересказа старые ходы просто отбрасываются, чтобы запрос не рос
+                new_summary = summary
+            with self._lock:
+                self.summary = new_summary
+                self.turns = self.turns[len(old):]
+                self.compactions += 1
+        finally:
+            with self._lock:
+                self._compacting = None
+                # Ходы, записанные во время сжатия, могли снова превысить бюджет
+                self._start_compaction()
@@ -0,0 +1,25 @@
+import os
+
+# --- ОБЩИЕ НАСТРОЙКИ ---
+# Каталог для локальных данных процесса (кэши, журналы, зеркала)
+DATA_DIR = os.environ.get("PATHAN_DATA_DIR", ".pathan")
+
+
+def data_path(*parts):
+    path = os.path.join(DATA_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
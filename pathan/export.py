@@ -0,0 +1,203 @@
+import multiprocessing
+import os
+import re
+import threading
+import time
+import uuid
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+from pypdf import PdfReader, PdfWriter
+
+from pathan.config import data_path, env_int
+from pathan.metrics import observe
+from pathan.report import build_report, record_patient
+
+# --- МАССОВЫЙ ЭКСПОРТ АРХИВА ---
+# Отчёты собираются в пуле процессов (тот же макет, что у create_pdf) и
+# по мере готовности дописываются в ZIP на диске. Задача идёт в фоновом
+# потоке, в работе не больше нескольких отчётов на процесс, поэтому память
+# не растёт с числом записей, а поток скрипта Streamlit не занят.
+
+EXPORT_WORKERS = env_int("PATHAN_EXPORT_WORKERS", min(4, os.cpu_count() or 1))
+# Объединённый PDF собирается в памяти (pypdf), поэтому его размер ограничен
+EXPORT_MERGE_MAX = env_int("PATHAN_EXPORT_MERGE_MAX", 500)
+EXPORT_KEEP = env_int("PATHAN_EXPORT_KEEP", 8)
+# Кнопка скачивания Streamlit держит файл в памяти сервера целиком; выгрузки
+# крупнее забираются с диска по пути файла
+EXPORT_DOWNLOAD_MAX = env_int("PATHAN_EXPORT_DOWNLOAD_MAX", 200 * 1024 * 1024)
+IN_FLIGHT_PER_WORKER = 2
+
+FORMATS = ("zip", "pdf")
+
+
+def _render(args):
+    # Выполняется в процессе пула
+    patient, text, image_data, lang = args
+    return build_report(patient, text, image_data, lang)
+
+
+def file_name(fields):
+    name = re.sub(r'[^\w\- ]+', '', fields.get('Patient Name') or 'No Name').strip().replace(' ', '_')
+    return f"{(fields.get('created_time') or '')[:10]}_{name or 'report'}_{fields.get('record_id', '')}.pdf"
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def export_pool():
+    # Один пул на процесс: экспорты разных пользователей встают в общую очередь
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: сервер многопоточный, fork мог бы унести в дочерний процесс чужие блокировки
+            _pool = ProcessPoolExecutor(max_workers=EXPORT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _reset_pool(broken):
+    # Упавший пул больше не принимает задачи, следующий экспорт создаст новый
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+class ExportJob:
+    def __init__(self, records, total, fmt, lang, image_for=None):
+        if fmt == "pdf" and total > EXPORT_MERGE_MAX:
+            raise ValueError(f"merged PDF is limited to {EXPORT_MERGE_MAX} reports, use ZIP")
+        self.id = uuid.uuid4().hex[:12]
+        self.fmt = fmt
+        self.lang = lang
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.state = "running"
+        self.error = None
+        self.started = time.time()
+        self.finished = None
+        self.size = None
+        self.path = os.path.abspath(data_path("exports", f"export_{self.id}.{fmt}"))
+        self._records = records
+        self._image_for = image_for
+        self._pool = None
+        self._cancel = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"pathan-export-{self.id}", daemon=True)
+        self._thread.start()
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def progress(self):
+        return (self.done + self.failed) / float(self.total) if self.total else 1.0
+
+    def _jobs(self):
+        for fields in self._records:
+            image = None
+            if self._image_for:
+                try: image = self._image_for(fields)
+                except Exception: pass
+            yield fields, (record_patient(fields), fields.get('AI Conclusion') or '', image, self.lang)
+
+    def _results(self):
+        # Скользящее окно: следующий отчёт отправляется в пул, когда забран готовый
+        pool = self._pool = export_pool()
+        window = deque()
+        jobs = self._jobs()
+        limit = EXPORT_WORKERS * IN_FLIGHT_PER_WORKER
+        for fields, args in jobs:
+            window.append((fields, pool.submit(_render, args)))
+            if len(window) >= limit:
+                yield window.popleft()
+            if self._cancel.is_set():
+                break
+        while window:
+            yield window.popleft()
+
+    def _run(self):
+        tmp = self.path + ".part"
+        try:
+            if self.fmt == "zip":
+                with zipfile.ZipFile(tmp, "w", zipfile.ZIP_STORED) as zf:
+                    for fields, future in self._results():
+                        data = self._collect(future)
+                        if data: zf.writestr(file_name(fields), data)
+            else:
+                writer = PdfWriter()
+                for fields, future in self._results():
+                    data = self._collect(future)
+                    if data: writer.append(PdfReader(BytesIO(data)))
+                with open(tmp, "wb") as f:
+                    writer.write(f)
+            if self._cancel.is_set():
+                self.state = "cancelled"
+                os.remove(tmp)
+            else:
+                os.replace(tmp, self.path)
+                self.size = os.path.getsize(self.path)
+                self.state = "done"
+        except Exception as e:
+            self.state = "error"
+            self.error = f"{type(e).__name__}: {e}"
+            try: os.remove(tmp)
+            except OSError: pass
+        finally:
+            self.finished = time.time()
+            observe("export", self.finished - self.started, self.state == "error")
+
+    def _collect(self, future):
+        if self._cancel.is_set():
+            future.cancel()
+            return None
+        try:
+            data = future.result()
+            self.done += 1
+            return data
+        except BrokenProcessPool:
+            _reset_pool(self._pool)
+            raise
+        except Exception as e:
+            self.failed += 1
+            self.error = f"{type(e).__name__}: {e}"
+            return None
+
+    @property
+    def downloadable(self):
+        return self.size is not None and self.size <= EXPORT_DOWNLOAD_MAX
+
+    def read(self):
+        if not self.downloadable:
+            raise ValueError(f"export is larger than {EXPORT_DOWNLOAD_MAX} bytes, take it from {self.path}")
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+_jobs = OrderedDict()
+_jobs_lock = threading.Lock()
+
+
+def start_export(records, total, fmt="zip", lang="RU", image_for=None):
+    job = ExportJob(records, total, fmt, lang, image_for)
+    with _jobs_lock:
+        _jobs[job.id] = job
+        # Старые завершённые выгрузки удаляются вместе с файлами
+        while len(_jobs) > EXPORT_KEEP:
+            old_id, old = next(iter(_jobs.items()))
+            if old.state == "running":
+                break
+            del _jobs[old_id]
+            try: os.remove(old.path)
+            except OSError: pass
+    return job
+
+
+def export_job(job_id):
+    with _jobs_lock:
+        return _jobs.get(job_id)
@@ -0,0 +1,107 @@
+import hashlib
+import math
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+from pathan.config import env_int
+from pathan.metrics import span
+
+# --- ПОДГОТОВКА СНИМКА ---
+# Снимок декодируется один раз с уменьшением, приводится к RGB и кодируется в
+# компактный JPEG. Эти байты уходят в модель, в превью и в PDF.
+
+# Gemini режет изображение на плитки 768x768 (258 токенов каждая), поэтому
+# бюджет по умолчанию - около четырёх плиток.
+IMAGE_MAX_PIXELS = env_int("PATHAN_IMAGE_MAX_PIXELS", 1536 * 1536)
+IMAGE_QUALITY = env_int("PATHAN_IMAGE_QUALITY", 85)
+PREPARED_CACHE_SIZE = env_int("PATHAN_PREPARED_CACHE_SIZE", 32)
+
+MIME_TYPE = "image/jpeg"
+
+
+class PreparedImage:
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+        self.mime_type = MIME_TYPE
+        self.digest = hashlib.sha256(data).hexdigest()
+
+    def blob(self):
+        # Формат inline-части для google.generativeai
+        return {"mime_type": self.mime_type, "data": self.data}
+
+    def parts(self):
+        # Все изображения, которые уходят в модель вместе с промптом
+        return [self.blob()]
+
+    def open(self):
+        return Image.open(BytesIO(self.data))
+
+
+def target_size(size, max_pixels=IMAGE_MAX_PIXELS):
+    w, h = size
+    if w * h <= max_pixels:
+        return size
+    scale = math.sqrt(max_pixels / float(w * h))
+    return max(1, int(w * scale)), max(1, int(h * scale))
+
+
+def to_rgb(im):
+    if im.mode == "RGB":
+        return im
+    if im.mode in ("RGBA", "LA") or (im.mode == "P" and "transparency" in im.info):
+        im = im.convert("RGBA")
+        background = Image.new("RGB", im.size, (255, 255, 255))
+        background.paste(im, mask=im.getchannel("A"))
+        return background
+    return im.convert("RGB")
+
+
+def prepare_image(source, max_pixels=IMAGE_MAX_PIXELS, quality=IMAGE_QUALITY):
+    raw = source if isinstance(source, (bytes, bytearray)) else source.getvalue()
+    with span("image_decode"):
+        return _prepare(raw, max_pixels, quality)
+
+
+def _prepare(raw, max_pixels, quality):
+    im = Image.open(BytesIO(raw))
+    orientation = im.getexif().get(0x0112, 1)
+    size = target_size(im.size, max_pixels)
+
+    # Уже подходящий JPEG отдаём как есть, без повторного кодирования
+    if im.format == "JPEG" and im.mode == "RGB" and size == im.size and orientation == 1:
+        return PreparedImage(bytes(raw), im.size)
+
+    if im.format == "JPEG":
+        # DCT-масштабирование при декодировании: полный битмап не создаётся
+        im.draft("RGB", size)
+    im = ImageOps.exif_transpose(im)
+    im = to_rgb(im)
+    im.thumbnail(target_size(im.size, max_pixels), Image.LANCZOS, reducing_gap=2.0)
+
+    buf = BytesIO()
+    im.save(buf, format="JPEG", quality=quality, optimize=True)
+    return PreparedImage(buf.getvalue(), im.size)
+
+
+_prepared = OrderedDict()
+_prepared_lock = threading.Lock()
+
+
+def prepare_upload(upload):
+    # Перезапуски скрипта и повторные загрузки того же файла не пересчитывают снимок
+    raw = upload if isinstance(upload, (bytes, bytearray)) else upload.getvalue()
+    key = hashlib.sha1(raw).hexdigest()
+    with _prepared_lock:
+        if key in _prepared:
+            _prepared.move_to_end(key)
+            return _prepared[key]
+    prepared = prepare_image(raw)
+    with _prepared_lock:
+        _prepared[key] = prepared
+        while len(_prepared) > PREPARED_CACHE_SIZE:
+            _prepared.popitem(last=False)
+    return prepared
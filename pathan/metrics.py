@@ -0,0 +1,187 @@
+import bisect
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pathan.config import env_float, env_int
+
+# --- МЕТРИКИ ЗАДЕРЖЕК ---
+# Замеры этапов (декодирование, вызов модели, PDF, Airtable) копятся в
+# гистограммах процесса и отдаются в текстовом формате Prometheus.
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RESERVOIR_SIZE = 1024
+METRICS_PORT = env_int("PATHAN_METRICS_PORT", 0)
+METRICS_FILE = os.environ.get("PATHAN_METRICS_FILE", "")
+METRICS_FILE_INTERVAL = env_float("PATHAN_METRICS_FILE_INTERVAL", 15)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.errors = 0
+        # Последние замеры для p50/p95 в панели администратора
+        self.recent = []
+        self._next = 0
+
+    def observe(self, seconds, error=False):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+        if error:
+            self.errors += 1
+        if len(self.recent) < RESERVOIR_SIZE:
+            self.recent.append(seconds)
+        else:
+            self.recent[self._next] = seconds
+            self._next = (self._next + 1) % RESERVOIR_SIZE
+
+    def quantile(self, q):
+        if not self.recent:
+            return None
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+
+_lock = threading.Lock()
+_histograms = {}
+_gauges = {}
+
+
+def observe(stage, seconds, error=False):
+    with _lock:
+        h = _histograms.get(stage)
+        if h is None:
+            h = _histograms[stage] = Histogram()
+        h.observe(seconds, error)
+
+
+@contextmanager
+def span(stage):
+    started = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        observe(stage, time.perf_counter() - started, error)
+
+
+def timed(stage):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def register_gauge(name, help_text, fn):
+    # fn() -> число или {метка: число}
+    with _lock:
+        _gauges[name] = (help_text, fn)
+
+
+def summary():
+    with _lock:
+        return [
+            {"stage": stage, "count": h.count, "errors": h.errors, "p50": h.quantile(0.5), "p95": h.quantile(0.95)}
+            for stage, h in sorted(_histograms.items())
+        ]
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+def render_prometheus():
+    lines = [
+        "# HELP pathan_stage_seconds Duration of PathanAI pipeline stages.",
+        "# TYPE pathan_stage_seconds histogram",
+    ]
+    with _lock:
+        histograms = sorted((stage, list(h.counts), h.sum, h.count, h.errors) for stage, h in _histograms.items())
+        gauges = sorted(_gauges.items())
+    for stage, counts, total, count, _ in histograms:
+        cumulative = 0
+        for bound, n in zip(BUCKETS + (float("inf"),), counts):
+            cumulative += n
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f'pathan_stage_seconds_bucket{{stage="{_label(stage)}",le="{le}"}} {cumulative}')
+        lines.append(f'pathan_stage_seconds_sum{{stage="{_label(stage)}"}} {total}')
+        lines.append(f'pathan_stage_seconds_count{{stage="{_label(stage)}"}} {count}')
+    lines.append("# HELP pathan_stage_errors_total Pipeline stages that raised.")
+    lines.append("# TYPE pathan_stage_errors_total counter")
+    for stage, _, _, _, errors in histograms:
+        lines.append(f'pathan_stage_errors_total{{stage="{_label(stage)}"}} {errors}')
+    for name, (help_text, fn) in gauges:
+        try: value = fn()
+        except Exception: continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        if isinstance(value, dict):
+            for labels, v in sorted(value.items()):
+                lines.append(f'{name}{{key="{_label(labels)}"}} {v}')
+        else:
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# --- ЭКСПОРТ ---
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def write_file(path=None):
+    path = path or METRICS_FILE
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(render_prometheus())
+    os.replace(tmp, path)
+
+
+def _file_loop():
+    while True:
+        time.sleep(METRICS_FILE_INTERVAL)
+        try: write_file()
+        except Exception: pass
+
+
+_exporter_started = False
+
+
+def start_exporter():
+    # Вызывается на каждом перезапуске скрипта, запускается один раз на процесс
+    global _exporter_started
+    with _lock:
+        if _exporter_started:
+            return
+        _exporter_started = True
+    if METRICS_PORT:
+        try:
+            server = ThreadingHTTPServer(("127.0.0.1", METRICS_PORT), _Handler)
+            threading.Thread(target=server.serve_forever, name="pathan-metrics", daemon=True).start()
+        except OSError:
+            pass
+    if METRICS_FILE:
+        threading.Thread(target=_file_loop, name="pathan-metrics-file", daemon=True).start()
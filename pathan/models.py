@@ -0,0 +1,85 @@
+import threading
+import time
+
+import google.generativeai as genai
+
+from pathan.config import env_float
+
+# --- РЕЕСТР МОДЕЛЕЙ ---
+# Список моделей запрашивается у Gemini один раз на процесс и обновляется в фоне,
+# поэтому перезапуски скрипта Streamlit не ждут сетевой вызов list_models().
+# Если первый запрос не удался, до следующей попытки (в фоне, не чаще раза в
+# REGISTRY_RETRY) список пуст и маршрутизатор берёт модели по умолчанию.
+
+REGISTRY_TTL = env_float("PATHAN_MODELS_TTL", 3600)
+REGISTRY_RETRY = env_float("PATHAN_MODELS_RETRY", 60)
+
+
+class ModelRegistry:
+    def __init__(self, ttl=REGISTRY_TTL, list_models=None, retry=REGISTRY_RETRY):
+        self.ttl = ttl
+        self.retry = retry
+        self._list_models = list_models or genai.list_models
+        self._lock = threading.Lock()
+        self._methods = {}
+        self._names = []
+        self._loaded_at = None
+        self._failed_at = None
+        self._refreshing = False
+
+    def refresh(self):
+        methods = {}
+        names = []
+        for m in self._list_models():
+            methods[m.name] = tuple(m.supported_generation_methods)
+            names.append(m.name)
+        with self._lock:
+            self._methods = methods
+            self._names = names
+            self._loaded_at = time.monotonic()
+            self._failed_at = None
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception:
+            with self._lock:
+                self._failed_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _ensure_loaded(self):
+        with self._lock:
+            now = time.monotonic()
+            loaded_at, failed_at = self._loaded_at, self._failed_at
+            if loaded_at is not None or failed_at is not None:
+                due = (loaded_at is None or now - loaded_at > self.ttl) and (failed_at is None or now - failed_at > self.retry)
+                if due and not self._refreshing:
+                    self._refreshing = True
+                    threading.Thread(target=self._refresh_in_background, daemon=True).start()
+                return
+        # Первый вызов в процессе: ждём список синхронно
+        try:
+            self.refresh()
+        except Exception:
+            with self._lock:
+                self._failed_at = time.monotonic()
+
+    def generate_models(self):
+        self._ensure_loaded()
+        with self._lock:
+            return [n for n in self._names if "generateContent" in self._methods[n]]
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def registry():
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ModelRegistry()
+    return _registry
@@ -0,0 +1,149 @@
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from pathan.config import env_int
+from pathan.metrics import span
+
+# --- ПЕРЦЕПТИВНЫЙ ХЭШ СНИМКОВ ---
+# 64-битный pHash (DCT уменьшенного снимка): у переснятого, пересжатого или
+# чуть обрезанного снимка он отличается на несколько бит. Хэши записей
+# архива лежат в одном массиве uint64, поиск - XOR и popcount по всему
+# массиву в NumPy, 100 тыс. снимков просматриваются за миллисекунды.
+
+HASH_FIELD = "Image pHash"
+HASH_SIZE = 8
+HASH_SOURCE = 32
+# Расстояние Хэмминга (из 64 бит): почти тот же снимок / похожий снимок
+DUPLICATE_DISTANCE = env_int("PATHAN_PHASH_DUPLICATE", 8)
+SIMILAR_DISTANCE = env_int("PATHAN_PHASH_SIMILAR", 16)
+HASH_CACHE_SIZE = 64
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    m = np.cos(np.pi * (2 * i + 1) * k / (2.0 * n)) * np.sqrt(2.0 / n)
+    m[0] /= np.sqrt(2.0)
+    return m
+
+
+_DCT = _dct_matrix(HASH_SOURCE)
+
+
+def phash(data):
+    # Байты изображения -> 16 hex-символов
+    im = Image.open(BytesIO(data))
+    # JPEG декодируется сразу в уменьшенном виде
+    im.draft("L", (HASH_SOURCE * 4, HASH_SOURCE * 4))
+    a = np.asarray(im.convert("L").resize((HASH_SOURCE, HASH_SOURCE), Image.LANCZOS), np.float64)
+    low = (_DCT @ a @ _DCT.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    bits = low > np.median(low[1:])
+    return "%016x" % int(np.packbits(bits).view(">u8")[0])
+
+
+_hashes = OrderedDict()
+_hashes_lock = threading.Lock()
+
+
+def image_phash(prepared):
+    # Перезапуски скрипта с тем же снимком не пересчитывают хэш
+    with _hashes_lock:
+        value = _hashes.get(prepared.digest)
+        if value is not None:
+            _hashes.move_to_end(prepared.digest)
+            return value
+    with span("image_phash"):
+        value = phash(prepared.data)
+    with _hashes_lock:
+        _hashes[prepared.digest] = value
+        while len(_hashes) > HASH_CACHE_SIZE:
+            _hashes.popitem(last=False)
+    return value
+
+
+if hasattr(np, "bitwise_count"):
+    _popcount = np.bitwise_count
+else:
+    _BITS = np.array([bin(i).count("1") for i in range(256)], np.uint8)
+
+    def _popcount(a):
+        return _BITS[a.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class PHashIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = []
+        self._slots = {}
+        self._hashes = np.zeros(1024, np.uint64)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, record_id, value):
+        try: h = np.uint64(int(value, 16))
+        except (TypeError, ValueError): return
+        with self._lock:
+            i = self._slots.get(record_id)
+            if i is None:
+                if len(self._ids) == len(self._hashes):
+                    self._hashes = np.concatenate([self._hashes, np.zeros(len(self._hashes), np.uint64)])
+                i = self._slots[record_id] = len(self._ids)
+                self._ids.append(record_id)
+            self._hashes[i] = h
+
+    def remove(self, record_id):
+        with self._lock:
+            i = self._slots.pop(record_id, None)
+            if i is None:
+                return
+            # На место удалённого встаёт последний
+            last = len(self._ids) - 1
+            if i != last:
+                self._ids[i] = self._ids[last]
+                self._hashes[i] = self._hashes[last]
+                self._slots[self._ids[i]] = i
+            self._ids.pop()
+
+    def near(self, value, max_distance=SIMILAR_DISTANCE, limit=5, exclude=None):
+        # [(id записи, расстояние)] по возрастанию расстояния
+        h = np.uint64(int(value, 16))
+        with self._lock:
+            dist = _popcount(self._hashes[:len(self._ids)] ^ h)
+            found = np.flatnonzero(dist <= max_distance)
+            found = found[np.argsort(dist[found], kind="stable")]
+            out = []
+            for i in found:
+                if self._ids[i] != exclude:
+                    out.append((self._ids[i], int(dist[i])))
+                    if len(out) >= limit: break
+            return out
+
+    def on_records(self, records):
+        # Слушатель зеркала архива: новые и изменённые записи Airtable
+        for r in records:
+            value = r.get('fields', {}).get(HASH_FIELD)
+            if r.get('deleted') or not value: self.remove(r['id'])
+            else: self.add(r['id'], value)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def phash_index(mirror):
+    # Один индекс на зеркало архива; строится из SQLite один раз на процесс
+    with _indexes_lock:
+        index = _indexes.get(id(mirror))
+        if index is None:
+            index = _indexes[id(mirror)] = PHashIndex()
+            # Слушатель подключается до чтения зеркала, чтобы не пропустить запись между ними
+            mirror.listeners.append(index.on_records)
+            with span("phash_index"):
+                for record_id, value in mirror.field_values(HASH_FIELD):
+                    index.add(record_id, value)
+        return index
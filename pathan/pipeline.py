@@ -0,0 +1,121 @@
+import time
+
+from pathan.analytics import TISSUE_FIELD, TURNAROUND_FIELD
+from pathan.archive import archive_mirror, table_key
+from pathan.assets import asset_store
+from pathan.cache import response_cache, response_key
+from pathan.metrics import span
+from pathan.phash import HASH_FIELD, image_phash
+from pathan.report import create_pdf
+from pathan.router import model_router
+from pathan.scheduler import model_scheduler
+from pathan.writer import record_writer
+
+# --- КОНВЕЙЕР АНАЛИЗА ---
+# Промпт, вызов модели, краткий вывод, запись в Airtable и PDF без Streamlit.
+# Им пользуются и приложение, и фоновый сервис (pathan/service.py).
+
+PATIENT_FIELDS = ("p_name", "gender", "weight", "dob", "biopsy", "tissue", "anamnesis")
+# Колонки таблицы записей Airtable. Обязательные: Patient Name, Gender, Weight,
+# Birth Date, Anamnesis, Biopsy Method, AI Conclusion, Short Summary (текст),
+# Doctor (связь с таблицей пользователей). Необязательные, добавлены позже -
+# их стоит завести в базе, иначе писатель сохраняет записи без них:
+#   Image Hash          - текст, sha256 снимка в локальном хранилище (pathan/assets.py)
+#   Image pHash         - текст, 16 hex-символов перцептивного хэша (pathan/phash.py)
+#   Tissue              - текст (или single select), тип ткани
+#   Turnaround Seconds  - число с одним знаком после запятой
+OPTIONAL_FIELDS = ("Image Hash", HASH_FIELD, TISSUE_FIELD, TURNAROUND_FIELD)
+
+
+def patient_data(values):
+    # Данные пациента из внешнего запроса: недостающие поля - прочерк, как в отчёте; 0 - значение
+    return {k: "-" if values.get(k) in (None, "") else values.get(k) for k in PATIENT_FIELDS}
+
+
+def build_prompt(p_data, lang, tiles=0):
+    # tiles: число полей высокого разрешения, приложенных к обзору целого слайда
+    p_name, gender, weight, dob, biopsy, anamnesis = (p_data[k] for k in ("p_name", "gender", "weight", "dob", "biopsy", "anamnesis"))
+    tissue = p_data.get("tissue") or "-"
+    if lang == 'RU':
+        slide = f" Первое изображение - обзор всего слайда, следующие {tiles} - поля ткани в полном разрешении." if tiles else ""
+        return f"Роль: Патологоанатом. Пациент: {p_name}, {gender}, {weight}, {dob}. Метод: {biopsy}. Ткань: {tissue}. Анамнез: {anamnesis}.{slide} Опиши гистологию, дай заключение и КРАТКИЙ ВЫВОД."
+    slide = f" The first image is an overview of the whole slide, the next {tiles} are full-resolution tissue fields." if tiles else ""
+    return f"Role: Pathologist. Patient: {p_name}, {gender}, {weight}, {dob}. Method: {biopsy}. Tissue: {tissue}. History: {anamnesis}.{slide} Describe histology, provide conclusion and SHORT SUMMARY."
+
+
+def extract_summary(txt):
+    separator = "ВЫВОД" if "ВЫВОД" in txt else ("SUMMARY" if "SUMMARY" in txt else None)
+    return txt.split(separator)[-1][:200] if separator else "See full report"
+
+
+def submit_analysis(prompt, prepared, stream=False):
+    # (текст из кэша, None) или (None, билет планировщика)
+    parts = prepared.parts()
+    # Модель выбирается на каждый вызов по задержкам и ошибкам (pathan/router.py)
+    model = model_router()
+    cache_key = response_key(model.label(), prompt, b"".join(p["data"] for p in parts))
+    txt = response_cache().get(cache_key)
+    if txt is not None:
+        return txt, None
+    # Общая очередь процесса; такой же запрос из другой сессии получает тот же билет
+    ticket = model_scheduler().submit(
+        cache_key, lambda: model.generate_content([prompt, *parts], stream=stream), stream=stream,
+        on_done=lambda answer: response_cache().put(cache_key, answer))
+    return None, ticket
+
+
+def analyze(prompt, prepared):
+    txt, ticket = submit_analysis(prompt, prepared)
+    if ticket is None:
+        return txt
+    with span("model_call"):
+        return ticket.result()
+
+
+def archive_writer(records_table):
+    # Созданные записи сразу попадают в локальное зеркало архива
+    return record_writer(records_table, table_key(records_table), on_written=archive_mirror(records_table).upsert,
+                         optional_fields=OPTIONAL_FIELDS)
+
+
+def store_image(prepared):
+    # Снимок сохраняется локально, запись ссылается на него по хэшу
+    if prepared is None: return None
+    try: return asset_store().put(prepared.data, prepared.digest)
+    except Exception: return None
+
+
+def analysis_fields(patient_data, analysis_full, summary, image_file, user_id, turnaround=None):
+    fields = {
+        "Patient Name": patient_data['p_name'],
+        "Gender": patient_data['gender'],
+        "Weight": patient_data['weight'],
+        "Birth Date": str(patient_data['dob']),
+        "Anamnesis": patient_data['anamnesis'],
+        "Biopsy Method": patient_data['biopsy'],
+        TISSUE_FIELD: patient_data.get('tissue'),
+        "AI Conclusion": analysis_full,
+        "Short Summary": summary,
+    }
+    # Doctor - связь с таблицей пользователей; у заданий без врача её нет
+    if user_id: fields["Doctor"] = [user_id]
+    image_hash = store_image(image_file)
+    if image_hash: fields["Image Hash"] = image_hash
+    try: fields[HASH_FIELD] = image_phash(image_file)
+    except Exception: pass
+    # Срок от загрузки снимка до сохранения заключения, секунд
+    if turnaround is not None: fields[TURNAROUND_FIELD] = round(turnaround, 1)
+    return fields
+
+
+def run_analysis(p_data, prepared, lang="RU", user_id=None, records_table=None, started=None):
+    # Полный путь одного снимка: модель, краткий вывод, запись в очередь Airtable, PDF
+    txt = analyze(build_prompt(p_data, lang, len(getattr(prepared, "tiles", ()))), prepared)
+    summary = extract_summary(txt)
+    saved = None
+    if records_table is not None:
+        turnaround = time.time() - started if started else None
+        with span("save_analysis"):
+            saved = archive_writer(records_table).submit(analysis_fields(p_data, txt, summary, prepared, user_id, turnaround))
+    pdf = create_pdf(p_data, txt, prepared.data, lang)
+    return {"text": txt, "summary": summary, "pdf": pdf, "saved": saved}
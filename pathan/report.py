@@ -0,0 +1,209 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from fpdf import FPDF
+from PIL import Image
+
+from pathan.config import env_int
+from pathan.metrics import timed
+
+# --- ГЕНЕРАЦИЯ PDF ---
+# Шрифт разбирается один раз на процесс, снимок встраивается из памяти без
+# временных файлов, готовые отчёты запоминаются по хэшу содержимого.
+
+FONT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "DejaVuSans.ttf")
+PDF_MEMO_BYTES = env_int("PATHAN_PDF_MEMO_BYTES", 32 * 1024 * 1024)
+
+PDF_TR = {
+    "pdf_title": {"RU": "PathanAI: Медицинское заключение", "EN": "PathanAI: Medical Report"},
+    "pdf_data": {"RU": "ДАННЫЕ:", "EN": "PATIENT DATA:"},
+    "pdf_concl": {"RU": "ЗАКЛЮЧЕНИЕ:", "EN": "CONCLUSION:"},
+    "pdf_pat": {"RU": "Пациент", "EN": "Patient"},
+    "pdf_gen": {"RU": "Пол", "EN": "Gender"},
+    "pdf_meth": {"RU": "Метод", "EN": "Method"},
+    "pdf_w": {"RU": "Вес", "EN": "Weight"},
+    "pdf_dob": {"RU": "Д.Р.", "EN": "DOB"},
+    "pdf_anam": {"RU": "Анамнез", "EN": "History"},
+}
+
+_fonts = {}
+_fonts_lock = threading.Lock()
+
+
+class ReportPDF(FPDF):
+    def add_font(self, family, style='', fname='', uni=False):
+        key = (family, style, fname, uni)
+        cached = _fonts.get(key)
+        if cached is None:
+            with _fonts_lock:
+                cached = _fonts.get(key)
+                if cached is None:
+                    fonts_before, files_before = set(self.fonts), set(self.font_files)
+                    FPDF.add_font(self, family, style, fname, uni)
+                    # Снимок метрик до того, как документ начнёт пополнять subset
+                    cached = (
+                        {k: dict(v, subset=list(v.get('subset', []))) for k, v in self.fonts.items() if k not in fonts_before},
+                        {k: dict(v) for k, v in self.font_files.items() if k not in files_before},
+                    )
+                    _fonts[key] = cached
+                    return
+        fonts, files = cached
+        for fontkey, entry in fonts.items():
+            if fontkey not in self.fonts:
+                self.fonts[fontkey] = dict(entry, i=len(self.fonts) + 1, subset=list(entry['subset']))
+        for name, entry in files.items():
+            self.font_files.setdefault(name, dict(entry))
+
+    def image_data(self, data, x=None, y=None, w=0, h=0):
+        # Аналог FPDF.image для JPEG-байтов в памяти
+        name = "mem:" + hashlib.sha1(data).hexdigest()
+        if name not in self.images:
+            im = Image.open(BytesIO(data))
+            if im.format != "JPEG" or im.mode not in ("RGB", "L", "CMYK"):
+                buf = BytesIO()
+                im.convert("RGB").save(buf, format="JPEG", quality=90)
+                data = buf.getvalue()
+                im = Image.open(BytesIO(data))
+            colspace = {"RGB": "DeviceRGB", "L": "DeviceGray", "CMYK": "DeviceCMYK"}[im.mode]
+            self.images[name] = {
+                'i': len(self.images) + 1, 'w': im.size[0], 'h': im.size[1],
+                'cs': colspace, 'bpc': 8, 'f': 'DCTDecode', 'data': data,
+            }
+        self.image(name, x, y, w, h)
+
+
+def new_pdf():
+    pdf = ReportPDF()
+    pdf.add_page()
+    font = 'DejaVu'
+    try: pdf.add_font('DejaVu', '', FONT_PATH, uni=True)
+    except Exception: font = 'Arial'
+    pdf.set_font(font, '', 12)
+    return pdf, font
+
+
+def record_patient(fields):
+    # Данные пациента для отчёта из полей записи архива
+    return {
+        'p_name': fields.get('Patient Name', 'No Name'), 'gender': fields.get('Gender', '?'), 'weight': fields.get('Weight', 0),
+        'dob': fields.get('Birth Date', '-'), 'anamnesis': fields.get('Anamnesis', '-'), 'biopsy': fields.get('Biopsy Method', '-')
+    }
+
+
+def _clean(text):
+    return text.replace('**', '').replace('##', '').replace('* ', '- ')
+
+
+@timed("create_pdf")
+def build_report(patient_data, analysis_text, image_data, lang_code):
+    def pdf_t(k): return PDF_TR[k][lang_code]
+    pdf, font = new_pdf()
+    pdf.set_font(font, '', 20)
+    pdf.cell(0, 10, pdf_t("pdf_title"), ln=True, align='C')
+    pdf.ln(5)
+    pdf.set_fill_color(240, 240, 240)
+    pdf.set_font(font, '', 12)
+    pdf.cell(0, 10, pdf_t("pdf_data"), ln=True, fill=True)
+    text = f"{pdf_t('pdf_pat')}: {patient_data['p_name']}\n{pdf_t('pdf_gen')}: {patient_data['gender']} | {pdf_t('pdf_meth')}: {patient_data['biopsy']}\n{pdf_t('pdf_w')}: {patient_data['weight']} | {pdf_t('pdf_dob')}: {patient_data['dob']}\n{pdf_t('pdf_anam')}: {patient_data['anamnesis']}"
+    pdf.multi_cell(0, 8, text)
+    pdf.ln(5)
+    if image_data:
+        try: pdf.image_data(image_data, x=(210-100)/2, w=100)
+        except Exception: pass
+    pdf.ln(5)
+    pdf.cell(0, 10, pdf_t("pdf_concl"), ln=True, fill=True)
+    pdf.ln(2)
+    pdf.multi_cell(0, 6, _clean(analysis_text))
+    return pdf.output(dest='S').encode('latin-1')
+
+
+@timed("create_pdf")
+def build_consult_report(patient_data, analysis_text, image_data):
+    # Макет отчёта appforgitOne.py
+    pdf, font = new_pdf()
+    pdf.set_font(font, '', 20)
+    pdf.cell(0, 10, 'PathanAI: Медицинское заключение', ln=True, align='C')
+    pdf.set_font(font, '', 10)
+    pdf.cell(0, 10, 'Система поддержки принятия врачебных решений', ln=True, align='C')
+    pdf.ln(5)
+
+    pdf.set_fill_color(240, 240, 240)
+    pdf.set_font(font, '', 12)
+    pdf.cell(0, 10, 'ДАННЫЕ ПАЦИЕНТА:', ln=True, fill=True)
+    text_data = (
+        f"Пол: {patient_data['gender']} | Вес: {patient_data['weight']} кг | Д.Р.: {patient_data['dob']}\n"
+        f"Курение: {patient_data['smoking']}\n"
+        f"Биопсия: {patient_data['biopsy']} | Ткань: {patient_data['tissue']}\n"
+        f"Анамнез: {patient_data['anamnesis']}"
+    )
+    pdf.multi_cell(0, 8, text_data)
+    pdf.ln(5)
+
+    if image_data:
+        try:
+            pdf.image_data(image_data, x=55, w=100)
+            pdf.ln(5)
+        except Exception as e:
+            pdf.set_font(font, '', 10)
+            pdf.cell(0, 10, f'[Не удалось добавить изображение: {str(e)}]', ln=True)
+
+    pdf.set_fill_color(240, 240, 240)
+    pdf.set_font(font, '', 12)
+    pdf.cell(0, 10, 'ЗАКЛЮЧЕНИЕ ИИ:', ln=True, fill=True)
+    pdf.ln(2)
+    pdf.multi_cell(0, 6, _clean(analysis_text))
+
+    pdf.ln(10)
+    pdf.set_font(font, '', 8)
+    pdf.cell(0, 10, 'Дисклеймер: Данный отчет создан ИИ-прототипом PathanAI. Требует верификации врачом.', ln=True, align='C')
+    return pdf.output(dest='S').encode('latin-1')
+
+
+# --- КЭШ ГОТОВЫХ ОТЧЁТОВ ---
+_memo = OrderedDict()
+_memo_size = 0
+_memo_lock = threading.Lock()
+
+
+def report_key(layout, patient_data, analysis_text, image_data, lang_code=None):
+    h = hashlib.sha256()
+    for part in (layout, repr(sorted((k, str(v)) for k, v in patient_data.items())), analysis_text or "", lang_code or ""):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    h.update(image_data or b"")
+    return h.hexdigest()
+
+
+def _memoized(key, build):
+    global _memo_size
+    with _memo_lock:
+        if key in _memo:
+            _memo.move_to_end(key)
+            return _memo[key]
+    data = build()
+    with _memo_lock:
+        if key not in _memo:
+            _memo[key] = data
+            _memo_size += len(data)
+        while _memo_size > PDF_MEMO_BYTES and len(_memo) > 1:
+            _, old = _memo.popitem(last=False)
+            _memo_size -= len(old)
+    return data
+
+
+def create_pdf(patient_data, analysis_text, image_data, lang_code):
+    key = report_key("report", patient_data, analysis_text, image_data, lang_code)
+    return _memoized(key, lambda: build_report(patient_data, analysis_text, image_data, lang_code))
+
+
+def create_consult_pdf(patient_data, analysis_text, image_data):
+    key = report_key("consult", patient_data, analysis_text, image_data)
+    return _memoized(key, lambda: build_consult_report(patient_data, analysis_text, image_data))
+
+
+def warm_up():
+    # Разбор шрифта и первая сборка документа до прихода пользователей
+    build_report({"p_name": "", "gender": "", "biopsy": "", "weight": "", "dob": "", "anamnesis": ""}, "", None, "RU")
@@ -0,0 +1,109 @@
+import threading
+
+import google.generativeai as genai
+import requests
+from pyairtable import Api
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from pathan.config import env_float, env_int
+
+# --- ОБЩИЕ РЕСУРСЫ ПРОЦЕССА ---
+# Клиенты Airtable, модели Gemini и HTTP-сессия создаются один раз на процесс
+# сервера и используются всеми сессиями Streamlit.
+
+HTTP_TIMEOUT = (env_float("PATHAN_HTTP_CONNECT_TIMEOUT", 5), env_float("PATHAN_HTTP_READ_TIMEOUT", 30))
+HTTP_POOL_SIZE = env_int("PATHAN_HTTP_POOL_SIZE", 16)
+AIRTABLE_ENDPOINT = "https://api.airtable.com"
+
+_lock = threading.RLock()
+_objects = {}
+
+
+def once(key, factory):
+    # Потокобезопасная ленивая инициализация
+    obj = _objects.get(key)
+    if obj is None:
+        with _lock:
+            obj = _objects.get(key)
+            if obj is None:
+                obj = _objects[key] = factory()
+    return obj
+
+
+def configure_genai(api_key):
+    def configure():
+        genai.configure(api_key=api_key)
+        return True
+    once(("genai", api_key), configure)
+
+
+def generative_model(name):
+    return once(("model", name), lambda: genai.GenerativeModel(name))
+
+
+def airtable_api(token, endpoint_url=AIRTABLE_ENDPOINT):
+    return once(("airtable", token, endpoint_url), lambda: Api(token, timeout=HTTP_TIMEOUT, endpoint_url=endpoint_url))
+
+
+def airtable_tables(config):
+    # config - раздел [airtable] из secrets
+    endpoint = config.get("ENDPOINT_URL", AIRTABLE_ENDPOINT)
+    key = ("tables", config["API_TOKEN"], config["BASE_ID"], config["TABLE_USERS"], config["TABLE_RECORDS"], endpoint)
+
+    def build():
+        api = airtable_api(config["API_TOKEN"], endpoint)
+        return api.table(config["BASE_ID"], config["TABLE_USERS"]), api.table(config["BASE_ID"], config["TABLE_RECORDS"])
+    return once(key, build)
+
+
+class _TimeoutSession(requests.Session):
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", HTTP_TIMEOUT)
+        return super().request(method, url, **kwargs)
+
+
+def http_session():
+    def build():
+        session = _TimeoutSession()
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("GET", "HEAD"))
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+    return once("http", build)
+
+
+# --- ПРОГРЕВ ---
+def warm_up(secrets):
+    # Всё, за что иначе заплатил бы первый пользователь после старта сервера
+    from pathan import metrics
+    from pathan.archive import archive_mirror
+    from pathan.assets import asset_store
+    from pathan.models import registry
+    from pathan.pipeline import archive_writer
+    from pathan.report import warm_up as warm_up_report
+
+    metrics.start_exporter()
+    http_session()
+    steps = []
+    if "GEMINI_API_KEY" in secrets:
+        configure_genai(secrets["GEMINI_API_KEY"])
+        steps.append(("models", lambda: registry().refresh()))
+    steps.append(("pdf", warm_up_report))
+    steps.append(("assets", asset_store))
+    if "airtable" in secrets:
+        users_table, records_table = airtable_tables(secrets["airtable"])
+        mirror = archive_mirror(records_table)
+        steps.append(("archive", mirror.maybe_sync))
+        # Писатель при создании дописывает в Airtable записи, оставшиеся в журнале
+        steps.append(("writer", lambda: archive_writer(records_table)))
+    done = {}
+    for name, step in steps:
+        try:
+            with metrics.span("warm_up_" + name):
+                step()
+            done[name] = True
+        except Exception as e:
+            done[name] = f"{type(e).__name__}: {e}"
+    return done
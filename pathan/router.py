@@ -0,0 +1,292 @@
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque, namedtuple
+
+from pathan.config import env_float, env_int
+from pathan.metrics import register_gauge
+from pathan.models import registry
+from pathan.resources import generative_model
+from pathan.scheduler import model_scheduler
+from pathan.streaming import close_stream, iter_text
+
+# --- МАРШРУТИЗАЦИЯ ПО МОДЕЛЯМ ---
+# Кандидаты - модели flash/pro из реестра (или список PATHAN_MODELS). По
+# каждой копятся последние задержки (до первого чанка при потоковом выводе)
+# и ошибки, запрос уходит в модель с лучшим p95 с поправкой на долю ошибок.
+# Если ответ не начался за p95 выбранной модели, параллельно запускается
+# следующая, и побеждает та, что ответит первой. Поток проигравшей модели
+# закрывается сразу, обычный (не потоковый) вызов проигравшей дорабатывает
+# в фоне. Ошибка посреди потока считается ошибкой модели. Ошибка (в том числе 429)
+# переводит запрос на следующую модель. Небольшая доля запросов уходит в
+# другие модели, иначе при медленном хвосте основной p95 запасной неизвестен.
+# Первая попытка идёт в слоте планировщика, который вызвал роутер. Хедж
+# занимает ещё один слот и токен ведра запросов и не запускается, если их
+# нет; попытка на следующей модели после ошибки берёт токен и занимает
+# освободившийся слот.
+
+ROUTER_MODELS = [n.strip() for n in os.environ.get("PATHAN_MODELS", "").split(",") if n.strip()]
+ROUTER_CANDIDATES = env_int("PATHAN_ROUTER_CANDIDATES", 3)
+ROUTER_HEDGE = os.environ.get("PATHAN_ROUTER_HEDGE", "1") != "0"
+HEDGE_MIN_DELAY = env_float("PATHAN_ROUTER_HEDGE_MIN", 1.0)
+# Учитываются последние замеры не старше ROUTER_MAX_AGE: восстановившаяся модель снова получит запросы
+ROUTER_WINDOW = 50
+ROUTER_MAX_AGE = env_float("PATHAN_ROUTER_MAX_AGE", 900)
+MIN_SAMPLES = 3
+# Доля запросов, которые сначала идут в другую модель, чтобы замеры по ней
+# не устаревали; такой запрос хеджируется лучшей моделью по её p95
+ROUTER_EXPLORE = env_float("PATHAN_ROUTER_EXPLORE", 0.05)
+# Оценка модели без замеров: порядок предпочтения сохраняется, пока выбранная модель быстрее.
+# Для хеджа нужно хотя бы MIN_SAMPLES замеров
+PRIOR_SECONDS = 10.0
+ERROR_PENALTY = 10.0
+DEFAULT_MODELS = ("models/gemini-flash-latest",)
+EXCLUDED = ("tts", "image", "audio", "live", "embed")
+
+Chunk = namedtuple("Chunk", "text")
+
+
+class ModelStats:
+    def __init__(self):
+        self.samples = deque(maxlen=ROUTER_WINDOW)   # (время, секунды или None при ошибке)
+        self.calls = 0
+        self.wins = 0
+
+    def add(self, seconds):
+        self.samples.append((time.time(), seconds))
+        self.calls += 1
+
+    def _recent(self):
+        cutoff = time.time() - ROUTER_MAX_AGE
+        return [s for t, s in self.samples if t >= cutoff]
+
+    def p95(self, min_samples=1):
+        ok = sorted(s for s in self._recent() if s is not None)
+        if not ok or len(ok) < min_samples:
+            return None
+        return ok[min(len(ok) - 1, int(0.95 * len(ok)))]
+
+    def error_rate(self):
+        recent = self._recent()
+        return sum(s is None for s in recent) / float(len(recent)) if recent else 0.0
+
+    def score(self):
+        p95 = self.p95()
+        return (PRIOR_SECONDS if p95 is None else p95) * (1.0 + ERROR_PENALTY * self.error_rate())
+
+
+class RoutedResponse:
+    # То, что ждёт планировщик: .text или итерация по чанкам, как у ответа Gemini
+    def __init__(self, model, chunks):
+        self.model = model
+        self._chunks = chunks
+
+    def __iter__(self):
+        for text in self._chunks:
+            yield Chunk(text)
+
+    @property
+    def text(self):
+        return "".join(c.text for c in self)
+
+
+class ModelRouter:
+    # generate_content с той же сигнатурой, что у GenerativeModel: роутер
+    # передаётся туда же, где раньше была модель (BoundedChat, планировщик)
+    def __init__(self, models=None, registry_=None, model_factory=generative_model, hedge=ROUTER_HEDGE, scheduler=None):
+        self._models = list(models or ROUTER_MODELS)
+        self._registry = registry_
+        self._factory = model_factory
+        self.hedge = hedge
+        self._scheduler = scheduler
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.hedged = 0
+        self.hedges_skipped = 0
+        self.failovers = 0
+
+    def candidates(self):
+        if self._models:
+            return list(self._models)
+        try: names = (self._registry or registry()).generate_models()
+        except Exception: names = []
+        names = [n for n in names if "gemini" in n and ("flash" in n or "pro" in n) and not any(x in n for x in EXCLUDED)]
+        # flash раньше pro, lite - в конце, алиасы -latest раньше версий
+        names.sort(key=lambda n: ("flash" not in n, "lite" in n, "latest" not in n))
+        return names[:ROUTER_CANDIDATES] or list(DEFAULT_MODELS)
+
+    def label(self):
+        # Для ключа кэша ответов: ответ любой из моделей-кандидатов равноценен
+        return "router:" + ",".join(self.candidates())
+
+    def _stat(self, name, stream):
+        key = (name, bool(stream))
+        stat = self._stats.get(key)
+        if stat is None:
+            stat = self._stats[key] = ModelStats()
+        return stat
+
+    def ranked(self, stream=False):
+        names = self.candidates()
+        with self._lock:
+            scores = {n: self._stat(n, stream).score() for n in names}
+        # sorted устойчив: при равных оценках остаётся порядок предпочтения
+        return sorted(names, key=lambda n: scores[n])
+
+    def hedge_delay(self, name, stream=False):
+        with self._lock:
+            p95 = self._stat(name, stream).p95(MIN_SAMPLES)
+        return None if p95 is None else max(HEDGE_MIN_DELAY, p95)
+
+    def scheduler(self):
+        return self._scheduler or model_scheduler()
+
+    def _record(self, name, stream, seconds):
+        with self._lock:
+            self._stat(name, stream).add(seconds)
+
+    def _tracked(self, name, first, chunks, seconds):
+        # Замер потока попадает в статистику, когда поток дочитан: обрыв посреди
+        # ответа - ошибка модели, а не удачный вызов
+        try:
+            yield first
+            yield from chunks
+        except GeneratorExit:
+            self._record(name, True, seconds)
+            raise
+        except Exception:
+            self._record(name, True, None)
+            raise
+        self._record(name, True, seconds)
+
+    def _attempt(self, name, contents, stream, results, finished, race):
+        started = time.perf_counter()
+        try:
+            response = self._factory(name).generate_content(contents, stream=stream)
+            if stream:
+                # Ответ считается начатым с первого непустого чанка
+                chunks = iter_text(response)
+                first = next(chunks, "")
+            else:
+                text = response.text
+        except Exception as e:
+            self._record(name, stream, None)
+            finished()
+            results.put((name, False, e))
+            return
+        seconds = time.perf_counter() - started
+        # Побеждает первая удачная попытка; результат в очередь кладёт только она
+        with self._lock:
+            won = race["winner"] is None
+            if won:
+                race["winner"] = name
+        if not stream:
+            self._record(name, stream, seconds)
+            finished()
+            if won:
+                results.put((name, True, [text]))
+            return
+        if won:
+            finished()
+            results.put((name, True, self._tracked(name, first, chunks, seconds)))
+            return
+        # Проигравший поток закрывается, чтобы не держать соединение; если закрыть нечем - дочитывается здесь
+        try:
+            if not close_stream(response):
+                for _ in chunks:
+                    pass
+            self._record(name, stream, seconds)
+        except Exception:
+            self._record(name, stream, None)
+        finally:
+            finished()
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        order = self.ranked(stream)
+        delay = self.hedge_delay(order[0], stream) if self.hedge and len(order) > 1 else None
+        if len(order) > 1 and random.random() < ROUTER_EXPLORE:
+            with self._lock:
+                other = min(order[1:], key=lambda n: len(self._stat(n, stream)._recent()))
+            order.remove(other)
+            order.insert(0, other)
+        results = queue.Queue()
+        started = []
+        race = {"winner": None}
+        # Слоты хеджей держатся, пока не закончатся все попытки запроса: проигравший
+        # не потоковый вызов дорабатывает в фоне уже после того, как билет
+        # планировщика освободил свой слот. Поток победителя дочитывается в слоте билета
+        slots = {"running": 0, "extra": 0}
+
+        def finished():
+            with self._lock:
+                slots["running"] -= 1
+                extra = 0 if slots["running"] else slots["extra"]
+                slots["extra"] -= extra
+            for _ in range(extra):
+                self.scheduler().release_extra()
+
+        def launch(extra=False):
+            name = order[len(started)]
+            started.append(name)
+            with self._lock:
+                slots["running"] += 1
+                slots["extra"] += extra
+            threading.Thread(target=self._attempt, args=(name, contents, stream, results, finished, race),
+                             name="pathan-route", daemon=True).start()
+
+        launch()
+        began = time.perf_counter()
+        pending, error = 1, None
+        while pending:
+            timeout = None
+            if delay is not None and len(started) == 1:
+                timeout = max(0.0, began + delay - time.perf_counter())
+            try:
+                name, ok, value = results.get(timeout=timeout)
+            except queue.Empty:
+                # Хедж: выбранная модель не ответила за свой p95, запускаем следующую
+                delay = None
+                if not self.scheduler().try_extra():
+                    with self._lock: self.hedges_skipped += 1
+                    continue
+                with self._lock: self.hedged += 1
+                launch(extra=True)
+                pending += 1
+                continue
+            pending -= 1
+            if ok:
+                # Проигравшая попытка сама закроет поток или доработает в фоне и тоже даст замер
+                with self._lock: self._stat(name, stream).wins += 1
+                return RoutedResponse(name, value)
+            error = value
+            if not pending and len(started) < len(order):
+                with self._lock: self.failovers += 1
+                self.scheduler().bucket.acquire()
+                launch()
+                pending += 1
+        raise error
+
+    def stats(self):
+        with self._lock:
+            return [{"model": name, "stream": stream, "calls": s.calls, "wins": s.wins,
+                     "p95": s.p95(), "errors": s.error_rate()}
+                    for (name, stream), s in sorted(self._stats.items())]
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def model_router():
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = ModelRouter()
+                register_gauge("pathan_model_p95_seconds", "Recent p95 latency per routed model",
+                               lambda: {f"{s['model']}:{'stream' if s['stream'] else 'full'}": s["p95"] or 0.0 for s in _router.stats()})
+                register_gauge("pathan_model_error_rate", "Recent error rate per routed model",
+                               lambda: {f"{s['model']}:{'stream' if s['stream'] else 'full'}": s["errors"] for s in _router.stats()})
+    return _router
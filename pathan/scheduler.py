@@ -0,0 +1,251 @@
+import random
+import threading
+import time
+import uuid
+from collections import deque
+
+from pathan.config import env_float, env_int
+from pathan.metrics import observe, register_gauge
+from pathan.streaming import iter_text
+
+# --- ОЧЕРЕДЬ ВЫЗОВОВ МОДЕЛИ ---
+# Все сессии процесса ходят в Gemini через один планировщик: одновременно
+# не больше MODEL_CONCURRENCY вызовов, остальные ждут в FIFO-очереди и видят
+# свою позицию. Одинаковые запросы (тот же ключ кэша ответа), пока первый
+# ещё в работе, получают тот же билет. При 429 планировщик целиком делает
+# паузу с экспоненциальной задержкой и повторяет вызов. Частоту вызовов
+# ограничивает token bucket на GEMINI_RPM запросов в минуту.
+
+MODEL_CONCURRENCY = env_int("PATHAN_MODEL_CONCURRENCY", 4)
+MODEL_MAX_RETRIES = env_int("PATHAN_MODEL_MAX_RETRIES", 5)
+BACKOFF_BASE = env_float("PATHAN_MODEL_BACKOFF", 1.0)
+BACKOFF_MAX = 32.0
+GEMINI_RPM = env_float("PATHAN_GEMINI_RPM", 60)
+
+
+def is_rate_limited(exc):
+    # google.api_core: ResourceExhausted / TooManyRequests с code 429; HTTP-клиенты - response.status_code
+    code = getattr(exc, "code", None)
+    if code == 429 or getattr(code, "value", None) == 429:
+        return True
+    if getattr(getattr(exc, "response", None), "status_code", None) == 429:
+        return True
+    return type(exc).__name__ in ("ResourceExhausted", "TooManyRequests")
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute=GEMINI_RPM, burst=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(burst or max(1, MODEL_CONCURRENCY))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def try_acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+# Квота Gemini общая для всего процесса
+_bucket = TokenBucket()
+
+
+def gemini_bucket():
+    return _bucket
+
+
+class Ticket:
+    def __init__(self, key, fn, stream, on_done):
+        self.key = key
+        self.fn = fn
+        self.stream_call = stream
+        self.on_done = on_done
+        self.retries = 0
+        self.state = "queued"
+        self.error = None
+        self.submitted = time.time()
+        self._chunks = []
+        self._cond = threading.Condition()
+
+    def _push(self, text):
+        with self._cond:
+            self._chunks.append(text)
+            self._cond.notify_all()
+
+    def _finish(self, state, error=None):
+        with self._cond:
+            self.state = state
+            self.error = error
+            self._cond.notify_all()
+
+    def waiting(self):
+        return self.state == "queued"
+
+    def stream(self):
+        # Куски ответа по мере поступления; присоединившийся позже получает их с начала
+        i = 0
+        while True:
+            with self._cond:
+                while i >= len(self._chunks) and self.state in ("queued", "running"):
+                    self._cond.wait()
+                chunks = self._chunks[i:]
+                state, error = self.state, self.error
+            for chunk in chunks:
+                yield chunk
+            i += len(chunks)
+            if not chunks and state not in ("queued", "running"):
+                if error is not None:
+                    raise error
+                return
+
+    def result(self, timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.state in ("done", "failed"), timeout):
+                raise TimeoutError("model call is still queued")
+            if self.error is not None:
+                raise self.error
+            return "".join(self._chunks)
+
+    @property
+    def text(self):
+        return self.result()
+
+
+class ModelScheduler:
+    def __init__(self, concurrency=MODEL_CONCURRENCY, bucket=None):
+        self.concurrency = max(1, concurrency)
+        self.bucket = bucket or gemini_bucket()
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._inflight = {}
+        self._paused_until = 0.0
+        self.running = 0
+        self.extra = 0
+        self.coalesced = 0
+        self.rate_limited = 0
+        for i in range(self.concurrency):
+            threading.Thread(target=self._worker, name=f"pathan-model-{i}", daemon=True).start()
+
+    def submit(self, key, fn, stream=False, on_done=None):
+        # fn() -> ответ generate_content/send_message; stream=True - потоковый ответ.
+        # key=None - без объединения (например, уточняющий вопрос в чате)
+        with self._cond:
+            ticket = self._inflight.get(key) if key else None
+            if ticket is not None:
+                self.coalesced += 1
+                return ticket
+            ticket = Ticket(key or uuid.uuid4().hex, fn, stream, on_done)
+            self._inflight[ticket.key] = ticket
+            self._queue.append(ticket)
+            self._cond.notify()
+            return ticket
+
+    def position(self, ticket):
+        # 1 - следующий в очереди, 0 - уже выполняется или завершён
+        with self._cond:
+            try: return self._queue.index(ticket) + 1
+            except ValueError: return 0
+
+    def queued(self):
+        with self._cond:
+            return len(self._queue)
+
+    def try_extra(self):
+        # Дополнительная попытка вне очереди (хедж маршрутизатора): занимает
+        # свободный слот и токен, если они есть прямо сейчас, иначе отказ
+        with self._cond:
+            if self.running + self.extra >= self.concurrency or time.time() < self._paused_until:
+                return False
+            if not self.bucket.try_acquire():
+                return False
+            self.extra += 1
+            return True
+
+    def release_extra(self):
+        with self._cond:
+            self.extra -= 1
+            self._cond.notify()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                # Слоты, занятые хеджами, тоже считаются в MODEL_CONCURRENCY
+                while not self._queue or time.time() < self._paused_until or self.running + self.extra >= self.concurrency:
+                    self._cond.wait(max(0.05, self._paused_until - time.time()) if self._queue else None)
+                ticket = self._queue.popleft()
+                ticket.state = "running"
+                self.running += 1
+            observe("model_queue_wait", time.time() - ticket.submitted)
+            try:
+                self._run(ticket)
+            finally:
+                with self._cond:
+                    self.running -= 1
+                    if self._inflight.get(ticket.key) is ticket:
+                        del self._inflight[ticket.key]
+
+    def _run(self, ticket):
+        while True:
+            self.bucket.acquire()
+            try:
+                response = ticket.fn()
+                if ticket.stream_call:
+                    for chunk in iter_text(response):
+                        ticket._push(chunk)
+                else:
+                    ticket._push(response.text)
+                break
+            except Exception as e:
+                # Повтор возможен, только пока клиенту ещё ничего не отдано
+                if not is_rate_limited(e) or ticket._chunks or ticket.retries >= MODEL_MAX_RETRIES:
+                    ticket._finish("failed", e)
+                    return
+                ticket.retries += 1
+                self.rate_limited += 1
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (ticket.retries - 1)) * (0.5 + random.random() / 2)
+                with self._cond:
+                    # Пауза для всех воркеров: квота общая
+                    self._paused_until = max(self._paused_until, time.time() + delay)
+                time.sleep(delay)
+        if ticket.on_done is not None:
+            try: ticket.on_done("".join(ticket._chunks))
+            except Exception: pass
+        ticket._finish("done")
+
+    def stats(self):
+        with self._cond:
+            return {"queued": len(self._queue), "running": self.running + self.extra,
+                    "coalesced": self.coalesced, "rate_limited": self.rate_limited}
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def model_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = ModelScheduler()
+                register_gauge("pathan_model_queue_depth", "Model calls waiting for a slot", _scheduler.queued)
+                register_gauge("pathan_model_running", "Model calls in progress", lambda: _scheduler.stats()["running"])
+    return _scheduler
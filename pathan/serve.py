@@ -0,0 +1,33 @@
+import sys
+import threading
+
+# --- ЗАПУСК С ПРОГРЕВОМ ---
+# python -m pathan.serve appforgitOne_testPDF.py [аргументы streamlit run]
+# Streamlit выполняется в этом же процессе, поэтому прогретые клиенты,
+# модели и кэши достаются первой сессии готовыми.
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: python -m pathan.serve <app.py> [streamlit options]", file=sys.stderr)
+        sys.exit(2)
+    import streamlit as st
+    from streamlit.web import cli
+
+    from pathan.resources import warm_up
+
+    def run_warm_up():
+        try:
+            result = warm_up(st.secrets)
+            print(f"PathanAI warm-up: {result}", file=sys.stderr)
+        except Exception as e:
+            print(f"PathanAI warm-up failed: {e}", file=sys.stderr)
+
+    # Прогрев идёт параллельно со стартом сервера и не задерживает его
+    threading.Thread(target=run_warm_up, name="pathan-warm-up", daemon=True).start()
+    sys.argv = ["streamlit", "run"] + sys.argv[1:]
+    sys.exit(cli.main())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+import argparse
+import asyncio
+import base64
+import hmac
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import tomllib
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from pathan.config import data_path, env_float, env_int
+from pathan.imaging import prepare_upload
+from pathan.metrics import register_gauge, render_prometheus, span
+from pathan.pipeline import patient_data, run_analysis
+from pathan.scheduler import model_scheduler
+from pathan.users import user_directory
+from pathan.wsi import WSI_SUPPORTED, is_wsi, prepare_slide
+
+# --- СЕРВИС АНАЛИЗА БЕЗ STREAMLIT ---
+# python -m pathan.service [--host 0.0.0.0] [--port 8600] [--stand-ins]
+# HTTP на asyncio: POST /jobs ставит снимок в очередь и сразу отвечает id,
+# GET /jobs/{id} - статус и заключение, GET /jobs/{id}/pdf - отчёт,
+# /healthz и /metrics - для балансировщика и Prometheus. Задания выполняет
+# пул потоков через pathan/pipeline.py, вызовы модели идут через общий
+# планировщик.
+#
+# Состояние заданий и отчёты лежат в каталоге PATHAN_SERVICE_DIR (SQLite и
+# PDF-файлы). Экземпляры за балансировщиком монтируют один и тот же каталог,
+# поэтому статус и отчёт отдаёт любой из них, липкая маршрутизация не нужна.
+# Каждый экземпляр отмечается в общей базе раз в SERVICE_HEARTBEAT; задание
+# экземпляра, который перестал отмечаться, отдаётся как failed.
+#
+# /jobs требует заголовок "Authorization: Bearer <SERVICE_TOKEN>" (secrets.toml
+# или переменная PATHAN_SERVICE_TOKEN). doctor, если указан, должен быть id
+# пользователя из таблицы пользователей.
+#
+# Тело POST /jobs (JSON):
+#   {"patient": {"p_name": ..., "gender": ..., "weight": ..., "dob": ...,
+#                "biopsy": ..., "tissue": ..., "anamnesis": ...},
+#    "image": "<base64>", "filename": "slide.jpg", "lang": "RU", "doctor": "rec..."}
+
+SERVICE_PORT = env_int("PATHAN_SERVICE_PORT", 8600)
+SERVICE_WORKERS = env_int("PATHAN_SERVICE_WORKERS", 4)
+SERVICE_MAX_BODY = env_int("PATHAN_SERVICE_MAX_BODY", 64 * 1024 * 1024)
+SERVICE_KEEP_JOBS = env_int("PATHAN_SERVICE_KEEP_JOBS", 1000)
+SERVICE_HEARTBEAT = env_float("PATHAN_SERVICE_HEARTBEAT", 10)
+SERVICE_DIR = os.environ.get("PATHAN_SERVICE_DIR")
+SECRETS_FILE = os.environ.get("PATHAN_SECRETS", os.path.join(".streamlit", "secrets.toml"))
+STATUSES = ("queued", "running", "done", "failed")
+RECORD_ID = re.compile(r"rec[A-Za-z0-9]{14}")
+JOB_FIELDS = ("id", "instance", "status", "created", "started", "finished", "summary", "text", "saved", "error")
+
+
+def public(job):
+    out = {k: job[k] for k in ("id", "status", "created", "started", "finished")}
+    if job["status"] == "done":
+        out.update(summary=job["summary"], text=job["text"], saved=job["saved"], pdf=f"/jobs/{job['id']}/pdf")
+    if job["error"]:
+        out["error"] = job["error"]
+    return out
+
+
+class JobStore:
+    # Общая для всех экземпляров база заданий и каталог отчётов
+    def __init__(self, root=None):
+        self.root = root or SERVICE_DIR or os.path.dirname(data_path("service", "jobs.sqlite"))
+        os.makedirs(os.path.join(self.root, "reports"), exist_ok=True)
+        self.instance = uuid.uuid4().hex[:12]
+        self._lock = threading.Lock()
+        # Другие экземпляры пишут в ту же базу: WAL и ожидание блокировки вместо ошибки
+        self._db = sqlite3.connect(os.path.join(self.root, "jobs.sqlite"), timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, instance TEXT NOT NULL, status TEXT NOT NULL,"
+            " created REAL NOT NULL, started REAL, finished REAL, summary TEXT, text TEXT, saved TEXT, error TEXT)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_finished ON jobs(finished)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS instances (id TEXT PRIMARY KEY, seen REAL NOT NULL)")
+        self._db.commit()
+        self.beat()
+
+    def beat(self):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO instances VALUES (?,?)", (self.instance, time.time()))
+            self._db.execute("DELETE FROM instances WHERE seen < ?", (time.time() - 100 * SERVICE_HEARTBEAT,))
+            self._db.commit()
+
+    def report_path(self, job_id):
+        return os.path.join(self.root, "reports", job_id + ".pdf")
+
+    def insert(self, job_id, created):
+        with self._lock:
+            self._db.execute("INSERT INTO jobs (id, instance, status, created) VALUES (?,?,?,?)",
+                             (job_id, self.instance, "queued", created))
+            self._db.commit()
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            self._db.execute("UPDATE jobs SET %s WHERE id=?" % ", ".join(f"{k}=?" for k in fields),
+                             (*fields.values(), job_id))
+            self._db.commit()
+
+    def put_report(self, job_id, data):
+        path = self.report_path(job_id)
+        with open(path + ".part", "wb") as f:
+            f.write(data)
+        os.replace(path + ".part", path)
+
+    def read_report(self, job_id):
+        try:
+            with open(self.report_path(job_id), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT %s, (SELECT seen FROM instances WHERE id=jobs.instance) FROM jobs WHERE id=?"
+                % ", ".join(JOB_FIELDS), (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(JOB_FIELDS, row))
+        seen = row[-1]
+        if job["status"] in ("queued", "running") and (seen is None or seen < time.time() - 3 * SERVICE_HEARTBEAT):
+            # Экземпляр остановлен, снимок был только у него в памяти
+            job.update(status="failed", error="service instance stopped before the job finished")
+        return job
+
+    def counts(self):
+        # Задания этого экземпляра: метрики собираются с каждого экземпляра отдельно
+        with self._lock:
+            rows = dict(self._db.execute("SELECT status, COUNT(*) FROM jobs WHERE instance=? GROUP BY status",
+                                         (self.instance,)).fetchall())
+        return {s: rows.get(s, 0) for s in STATUSES}
+
+    def evict(self, keep):
+        # Старые завершённые задания уходят вместе с PDF; ждущие и идущие не трогаются
+        with self._lock:
+            old = [r[0] for r in self._db.execute(
+                "SELECT id FROM jobs WHERE finished IS NOT NULL ORDER BY finished DESC LIMIT -1 OFFSET ?",
+                (keep,)).fetchall()]
+            self._db.executemany("DELETE FROM jobs WHERE id=?", [(i,) for i in old])
+            self._db.commit()
+        for job_id in old:
+            try: os.remove(self.report_path(job_id))
+            except FileNotFoundError: pass
+
+
+class AnalysisService:
+    def __init__(self, records_table=None, workers=SERVICE_WORKERS, keep=SERVICE_KEEP_JOBS,
+                 users_table=None, token=None, store=None):
+        self.records_table = records_table
+        self.users_table = users_table
+        self.token = token
+        self.keep = keep
+        self.store = store or JobStore()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pathan-job")
+        self._server = None
+        threading.Thread(target=self._heartbeat, name="pathan-service-heartbeat", daemon=True).start()
+        register_gauge("pathan_service_jobs", "Analysis service jobs by status", self.counts)
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(SERVICE_HEARTBEAT)
+            try: self.store.beat()
+            except Exception: pass
+
+    # --- задания ---
+    def _check_doctor(self, doctor):
+        # Запись привязывается к врачу только из таблицы пользователей
+        if not isinstance(doctor, str) or not RECORD_ID.fullmatch(doctor):
+            raise ValueError("unknown doctor")
+        if self.users_table is None or user_directory(self.users_table).by_id(doctor) is None:
+            raise ValueError("unknown doctor")
+
+    def submit(self, payload):
+        patient = payload.get("patient")
+        if not isinstance(patient, dict) or not patient.get("p_name"):
+            raise ValueError("patient.p_name is required")
+        image = payload.get("image") or ""
+        if not isinstance(image, str):
+            raise ValueError("image must be a base64 string")
+        try: raw = base64.b64decode(image, validate=True)
+        except ValueError: raise ValueError("image must be base64")
+        if not raw:
+            raise ValueError("image is required")
+        lang = payload.get("lang", "RU")
+        if lang not in ("RU", "EN"):
+            raise ValueError("lang must be RU or EN")
+        doctor = payload.get("doctor")
+        if doctor:
+            self._check_doctor(doctor)
+        job_id, created = uuid.uuid4().hex, time.time()
+        self.store.insert(job_id, created)
+        self.store.evict(self.keep)
+        self._executor.submit(self._run, job_id, created, patient_data(patient), lang, doctor,
+                              payload.get("filename") or "", raw)
+        return job_id
+
+    def _run(self, job_id, created, p_data, lang, doctor, filename, raw):
+        self.store.update(job_id, status="running", started=time.time())
+        try:
+            with span("service_job"):
+                if is_wsi(filename):
+                    if not WSI_SUPPORTED:
+                        raise ValueError("whole-slide images need tifffile")
+                    prepared = prepare_slide(raw)
+                else:
+                    prepared = prepare_upload(raw)
+                result = run_analysis(p_data, prepared, lang, doctor, self.records_table, created)
+            self.store.put_report(job_id, result["pdf"])
+            self.store.update(job_id, status="done", finished=time.time(), text=result["text"],
+                              summary=result["summary"], saved=result["saved"])
+        except Exception as e:
+            self.store.update(job_id, status="failed", finished=time.time(), error=f"{type(e).__name__}: {e}")
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def counts(self):
+        return self.store.counts()
+
+    def authorized(self, header):
+        scheme, _, token = (header or "").partition(" ")
+        return bool(self.token) and scheme.lower() == "bearer" and hmac.compare_digest(
+            token.strip().encode("utf-8"), self.token.encode("utf-8"))
+
+    # --- HTTP ---
+    def route(self, method, path, body, authorization=None):
+        # -> (код, тело, content-type)
+        parts = [p for p in path.split("?")[0].split("/") if p]
+        if parts[:1] == ["jobs"] and not self.authorized(authorization):
+            return 401, {"error": "bearer token required"}, None
+        if parts == ["healthz"] and method == "GET":
+            return 200, {"ok": True, "jobs": self.counts(), "model_queue": model_scheduler().stats()}, None
+        if parts == ["metrics"] and method == "GET":
+            return 200, render_prometheus().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+        if parts == ["jobs"]:
+            if method != "POST":
+                return 405, {"error": "use POST"}, None
+            try:
+                payload = json.loads(body or b"{}")
+                if not isinstance(payload, dict):
+                    raise ValueError("JSON object expected")
+                job_id = self.submit(payload)
+            except ValueError as e:
+                return 400, {"error": str(e)}, None
+            except Exception as e:
+                # Справочник пользователей или общая база недоступны - клиент повторит позже
+                return 503, {"error": f"{type(e).__name__}: {e}"}, None
+            return 202, {"id": job_id, "status": "queued", "url": f"/jobs/{job_id}"}, None
+        if len(parts) in (2, 3) and parts[0] == "jobs" and parts[2:] in ([], ["pdf"]):
+            if method != "GET":
+                return 405, {"error": "use GET"}, None
+            job = self.get(parts[1])
+            if job is None:
+                return 404, {"error": "no such job"}, None
+            if len(parts) == 2:
+                return 200, public(job), None
+            if job["status"] != "done":
+                return 409, {"error": f"job is {job['status']}"}, None
+            pdf = self.store.read_report(job["id"])
+            if pdf is None:
+                return 410, {"error": "report expired"}, None
+            return 200, pdf, "application/pdf"
+        return 404, {"error": "not found"}, None
+
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if not line.strip():
+            return None
+        method, target, version = line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            header = await reader.readline()
+            if header in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = header.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length") or 0)
+        if length > SERVICE_MAX_BODY:
+            return method, target, version, headers, None
+        body = await reader.readexactly(length) if length else b""
+        return method, target, version, headers, body
+
+    async def _handle(self, reader, writer):
+        # Соединение держится открытым, пока клиент не попросит закрыть (keep-alive)
+        try:
+            while True:
+                try: request = await self._read_request(reader)
+                except (ValueError, asyncio.IncompleteReadError): request = None
+                if request is None:
+                    break
+                method, target, version, headers, body = request
+                if body is None:
+                    status, payload, ctype = 413, {"error": "body too large"}, None
+                else:
+                    # Разбор base64 большого снимка и обращения к общей базе заданий - в потоке,
+                    # цикл событий не ждёт
+                    status, payload, ctype = await asyncio.to_thread(
+                        self.route, method.upper(), target, body, headers.get("authorization"))
+                if not isinstance(payload, bytes):
+                    payload, ctype = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8"), "application/json"
+                close = body is None or headers.get("connection", "").lower() == "close" or version.strip() == "HTTP/1.0"
+                head = (f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                        f"Content-Type: {ctype}\r\nContent-Length: {len(payload)}\r\n"
+                        f"Connection: {'close' if close else 'keep-alive'}\r\n")
+                if status == 401:
+                    head += "WWW-Authenticate: Bearer\r\n"
+                writer.write((head + "\r\n").encode("latin-1") + payload)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=SERVICE_PORT):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def serve(self, host="127.0.0.1", port=SERVICE_PORT):
+        port = await self.start(host, port)
+        print(f"PathanAI service on http://{host}:{port}", file=sys.stderr)
+        async with self._server:
+            await self._server.serve_forever()
+
+
+def load_secrets(path=SECRETS_FILE):
+    # Тот же secrets.toml, что у приложения Streamlit; ключ Gemini и токен сервиса можно задать переменными окружения
+    secrets = {}
+    try:
+        with open(path, "rb") as f:
+            secrets = tomllib.load(f)
+    except FileNotFoundError:
+        pass
+    if os.environ.get("GEMINI_API_KEY"):
+        secrets["GEMINI_API_KEY"] = os.environ["GEMINI_API_KEY"]
+    if os.environ.get("PATHAN_SERVICE_TOKEN"):
+        secrets["SERVICE_TOKEN"] = os.environ["PATHAN_SERVICE_TOKEN"]
+    return secrets
+
+
+def stand_in_secrets():
+    # Локальный запуск без сети: модель из bench/fakes.py, Airtable - bench/airtable_stub.py
+    from bench import fakes
+    from bench.airtable_stub import AirtableStub
+    fakes.install()
+    stub = AirtableStub().start()
+    return {
+        "GEMINI_API_KEY": "stand-in",
+        "SERVICE_TOKEN": os.environ.get("PATHAN_SERVICE_TOKEN") or uuid.uuid4().hex,
+        "airtable": {"API_TOKEN": "stand-in", "BASE_ID": "appStandIn", "ENDPOINT_URL": stub.url,
+                     "TABLE_USERS": "users", "TABLE_RECORDS": "records"},
+    }
+
+
+def main(argv=None):
+    from pathan.resources import airtable_tables, configure_genai, warm_up
+
+    parser = argparse.ArgumentParser(description="PathanAI headless analysis service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    parser.add_argument("--workers", type=int, default=SERVICE_WORKERS)
+    parser.add_argument("--stand-ins", action="store_true", help="fake Gemini and a local Airtable stub")
+    args = parser.parse_args(argv)
+
+    secrets = stand_in_secrets() if args.stand_ins else load_secrets()
+    if "GEMINI_API_KEY" not in secrets:
+        print(f"GEMINI_API_KEY is missing (env or {SECRETS_FILE})", file=sys.stderr)
+        sys.exit(2)
+    if not secrets.get("SERVICE_TOKEN"):
+        print(f"SERVICE_TOKEN is missing (PATHAN_SERVICE_TOKEN or {SECRETS_FILE})", file=sys.stderr)
+        sys.exit(2)
+    if args.stand_ins:
+        print(f"Bearer token: {secrets['SERVICE_TOKEN']}", file=sys.stderr)
+    configure_genai(secrets["GEMINI_API_KEY"])
+    users_table, records_table = airtable_tables(secrets["airtable"]) if "airtable" in secrets else (None, None)
+    threading.Thread(target=warm_up, args=(secrets,), name="pathan-warm-up", daemon=True).start()
+    service = AnalysisService(records_table, args.workers, users_table=users_table, token=secrets["SERVICE_TOKEN"])
+    try: asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt: pass
+
+
+if __name__ == "__main__":
+    main()
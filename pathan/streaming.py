@@ -0,0 +1,31 @@
+import os
+
+# --- ПОТОКОВЫЙ ВЫВОД ---
+# PATHAN_STREAM=0 возвращает прежнее поведение (ждать полный ответ)
+STREAM_OUTPUT = os.environ.get("PATHAN_STREAM", "1") != "0"
+
+
+def iter_text(response):
+    # Служебные чанки без текста (finish_reason, safety) пропускаем
+    for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            continue
+        if text:
+            yield text
+
+
+def close_stream(response):
+    # Поток Gemini (gRPC или REST) обрывается через cancel() своего итератора;
+    # False - закрыть нечем, поток нужно дочитать
+    stream = getattr(response, "_iterator", None) or response
+    for name in ("cancel", "close"):
+        method = getattr(stream, name, None)
+        if callable(method):
+            try:
+                method()
+                return True
+            except Exception:
+                pass
+    return False
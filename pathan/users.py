@@ -0,0 +1,322 @@
+import base64
+import hashlib
+import hmac
+import secrets
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from pathan.archive import table_key
+from pathan.config import data_path, env_float, env_int
+from pathan.metrics import register_gauge, span
+
+# --- СПРАВОЧНИК ПОЛЬЗОВАТЕЛЕЙ И СЕССИИ ---
+# Таблица пользователей целиком держится в памяти процесса и перечитывается
+# раз в USER_CACHE_TTL (в фоне, пока отдаётся прежний снимок). Имени или id,
+# которых нет в снимке, ищутся в Airtable по одному и запоминаются, в том
+# числе как отсутствующие. Одновременные промахи по одному ключу делают
+# один запрос. Вход выдаёт токен сессии; перезагрузка страницы находит
+# пользователя по токену без Airtable. Пароли хранятся как PBKDF2-SHA256;
+# открытый пароль из старых записей заменяется хэшем при первом входе.
+
+USER_CACHE_TTL = env_float("PATHAN_USER_CACHE_TTL", 300)
+USER_NEGATIVE_TTL = env_float("PATHAN_USER_NEGATIVE_TTL", 30)
+SESSION_TTL = env_float("PATHAN_SESSION_TTL", 12 * 3600)
+# ~0.25 с на одно ядро; время видно в метриках как стадия password_hash
+PASSWORD_ITERATIONS = env_int("PATHAN_PASSWORD_ITERATIONS", 600_000)
+HASH_SCHEME = "pbkdf2_sha256"
+USER_FIELDS = ("Name", "Password", "Email", "Role")
+_MISS = object()
+
+
+# --- пароли ---
+def _b64(data):
+    return base64.b64encode(data).decode("ascii")
+
+
+def hash_password(password, iterations=PASSWORD_ITERATIONS, salt=None):
+    salt = salt or secrets.token_bytes(16)
+    with span("password_hash"):
+        digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return f"{HASH_SCHEME}${iterations}${_b64(salt)}${_b64(digest)}"
+
+
+def verify_password(stored, password):
+    # -> (пароль верный, запись нужно перехэшировать)
+    if not stored or not password:
+        return False, False
+    if not stored.startswith(HASH_SCHEME + "$"):
+        # Старая запись с открытым паролем
+        return hmac.compare_digest(stored.encode("utf-8"), password.encode("utf-8")), True
+    try:
+        _, iterations, salt, digest = stored.split("$")
+        iterations, salt = int(iterations), base64.b64decode(salt, validate=True)
+    except ValueError:
+        return False, False
+    if iterations < 1 or not salt:
+        return False, False
+    ok = hmac.compare_digest(hash_password(password, iterations, salt), stored)
+    return ok, ok and iterations < PASSWORD_ITERATIONS
+
+
+def _quote(value):
+    return str(value).replace("\\", "\\\\").replace("'", "\\'")
+
+
+# --- справочник ---
+class UserDirectory:
+    def __init__(self, table, ttl=USER_CACHE_TTL, negative_ttl=USER_NEGATIVE_TTL):
+        self.table = table
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._by_id = {}
+        self._by_name = {}
+        self._missing = {}      # ('id'|'name', значение) -> время промаха
+        self._inflight = {}     # ключ -> Future
+        self._loaded = 0.0
+        self._refreshing = False
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.loads = 0
+
+    def _store(self, record):
+        self._by_id[record['id']] = record
+        name = record.get('fields', {}).get('Name')
+        if name:
+            self._by_name[name] = record
+        self._missing.pop(('id', record['id']), None)
+        self._missing.pop(('name', name), None)
+
+    def _load_all(self):
+        with span("users_load"):
+            records = self.table.all(fields=list(USER_FIELDS))
+        with self._lock:
+            self._by_id, self._by_name = {}, {}
+            for r in records:
+                self._store(r)
+            self._missing.clear()
+            self._loaded = time.time()
+            self.loads += 1
+
+    def _refresh_in_background(self):
+        try: self._load_all()
+        except Exception: pass
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _ensure_loaded(self):
+        with self._lock:
+            if self._loaded and time.time() - self._loaded < self.ttl:
+                return
+            if self._loaded:
+                # Устаревший снимок отдаётся, пока новый грузится
+                if not self._refreshing:
+                    self._refreshing = True
+                    threading.Thread(target=self._refresh_in_background, name="pathan-users", daemon=True).start()
+                return
+        self._single_flight(("all",), self._load_all, lambda: None if self._loaded else _MISS)
+
+    def _single_flight(self, key, fn, cached):
+        # cached() проверяется под тем же замком, что и регистрация запроса:
+        # результат, сохранённый только что завершившимся запросом, не запрашивается снова
+        with self._lock:
+            value = cached()
+            if value is not _MISS:
+                return value
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def _cached(self, kind, value):
+        record = (self._by_name if kind == 'name' else self._by_id).get(value)
+        if record is not None:
+            return record
+        missed = self._missing.get((kind, value))
+        return None if missed and time.time() - missed < self.negative_ttl else _MISS
+
+    def _lookup(self, kind, value, fetch):
+        try: self._ensure_loaded()
+        except Exception: pass
+        with self._lock:
+            record = self._cached(kind, value)
+            if record is not _MISS:
+                if record is None: self.negative_hits += 1
+                else: self.hits += 1
+                return record
+            self.misses += 1
+        # Нет в снимке: запись могла появиться после загрузки (регистрация на другом экземпляре)
+        def load():
+            record = fetch()
+            with self._lock:
+                if record is None:
+                    self._missing[(kind, value)] = time.time()
+                else:
+                    self._store(record)
+            return record
+        return self._single_flight((kind, value), load, lambda: self._cached(kind, value))
+
+    def by_name(self, name):
+        def fetch():
+            with span("users_fetch"):
+                matches = self.table.all(formula=f"{{Name}}='{_quote(name)}'", max_records=1)
+            return matches[0] if matches else None
+        return self._lookup('name', name, fetch)
+
+    def by_id(self, record_id):
+        def fetch():
+            with span("users_fetch"):
+                try: return self.table.get(record_id)
+                except Exception as e:
+                    if getattr(getattr(e, "response", None), "status_code", None) == 404:
+                        return None
+                    raise
+        return self._lookup('id', record_id, fetch)
+
+    def records(self):
+        try: self._ensure_loaded()
+        except Exception: pass
+        with self._lock:
+            return list(self._by_id.values())
+
+    # --- вход и регистрация ---
+    def authenticate(self, name, password):
+        record = self.by_name(name)
+        if record is None:
+            # Время ответа не выдаёт, есть ли такое имя
+            hash_password(password or "")
+            return None
+        ok, upgrade = verify_password(record.get('fields', {}).get('Password'), password)
+        if not ok:
+            return None
+        if upgrade:
+            self._upgrade(record, password)
+        return record
+
+    def _upgrade(self, record, password):
+        fields = dict(record['fields'], Password=hash_password(password))
+        with self._lock:
+            self._store(dict(record, fields=fields))
+
+        def write():
+            try: self.table.update(record['id'], {"Password": fields["Password"]})
+            except Exception: pass
+        # Запись в Airtable не задерживает вход
+        threading.Thread(target=write, name="pathan-password-upgrade", daemon=True).start()
+
+    def register(self, name, password, email, role="Doctor"):
+        # Проверка имени идёт мимо кэша: отрицательная запись не должна пустить дубликат
+        with span("users_fetch"):
+            if self.table.all(formula=f"{{Name}}='{_quote(name)}'", max_records=1):
+                return None
+        record = self.table.create({"Name": name, "Password": hash_password(password), "Email": email, "Role": role})
+        with self._lock:
+            self._store(record)
+        return record
+
+    def stats(self):
+        with self._lock:
+            return {"users": len(self._by_id), "hits": self.hits, "misses": self.misses,
+                    "negative_hits": self.negative_hits, "loads": self.loads}
+
+
+# --- токены сессий ---
+class SessionTokens:
+    # Токен -> id пользователя. В памяти процесса; копия в SQLite переживает
+    # перезапуск сервера, чтобы после деплоя не входить заново. На диске лежит
+    # только SHA-256 токена.
+    def __init__(self, path=None, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._tokens = {}   # sha256 -> (id пользователя, истекает)
+        self._db = sqlite3.connect(path or data_path("sessions.sqlite"), check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS sessions (token TEXT PRIMARY KEY, user_id TEXT NOT NULL, expires REAL NOT NULL)")
+        self._db.execute("DELETE FROM sessions WHERE expires < ?", (time.time(),))
+        self._db.commit()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def issue(self, user_id):
+        token = secrets.token_urlsafe(24)
+        key, expires = self._key(token), time.time() + self.ttl
+        with self._lock:
+            self._tokens[key] = (user_id, expires)
+            self._db.execute("INSERT OR REPLACE INTO sessions VALUES (?,?,?)", (key, user_id, expires))
+            self._db.commit()
+        return token
+
+    def resolve(self, token):
+        if not token:
+            return None
+        key, now = self._key(token), time.time()
+        with self._lock:
+            entry = self._tokens.get(key)
+            if entry is None:
+                entry = self._db.execute("SELECT user_id, expires FROM sessions WHERE token=?", (key,)).fetchone()
+                if entry is not None:
+                    self._tokens[key] = entry
+            if entry is None:
+                return None
+            if entry[1] < now:
+                self._revoke(key)
+                return None
+        return entry[0]
+
+    def _revoke(self, key):
+        self._tokens.pop(key, None)
+        self._db.execute("DELETE FROM sessions WHERE token=?", (key,))
+        self._db.commit()
+
+    def revoke(self, token):
+        if token:
+            with self._lock:
+                self._revoke(self._key(token))
+
+    def __len__(self):
+        return len(self._tokens)
+
+
+_directories = {}
+_directories_lock = threading.Lock()
+_sessions = None
+
+
+def user_directory(table):
+    # Один справочник на таблицу пользователей на процесс
+    key = table_key(table)
+    with _directories_lock:
+        directory = _directories.get(key)
+        if directory is None:
+            directory = _directories[key] = UserDirectory(table)
+            register_gauge("pathan_user_directory", "User directory cache counters", directory.stats)
+        else:
+            directory.table = table
+        return directory
+
+
+def session_tokens():
+    global _sessions
+    if _sessions is None:
+        with _directories_lock:
+            if _sessions is None:
+                _sessions = SessionTokens()
+                register_gauge("pathan_session_tokens", "Session tokens held in memory", lambda: len(_sessions))
+    return _sessions
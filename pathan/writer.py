@@ -0,0 +1,279 @@
+import json
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+
+import requests
+
+from pathan.config import data_path, env_float, env_int
+from pathan.metrics import observe, register_gauge
+
+# --- ОТЛОЖЕННАЯ ЗАПИСЬ В AIRTABLE ---
+# save_analysis только ставит запись в очередь. Фоновый поток пишет пачками
+# по 10 (лимит batch create в Airtable) и повторяет при 429/5xx. Каждая
+# запись сначала попадает в журнал на диске и переживает перезапуск процесса.
+# Если сеть или Airtable недоступны дольше MAX_RETRIES попыток, пачка
+# возвращается в очередь и остаётся в журнале. Пачка с ошибкой 4xx пишется
+# по одной записи, и в файл ошибок уходит только сама плохая запись.
+# Необязательные поля, которых нет в таблице (UNKNOWN_FIELD_NAME), писатель
+# запоминает и дальше отправляет записи без них: пробел в схеме базы не
+# останавливает сохранение заключений.
+# Журнал сжимается до незавершённых записей при запуске и на ходу, когда
+# завершённых (ack/fail) набирается JOURNAL_COMPACT.
+
+BATCH_SIZE = 10
+BATCH_LINGER = env_float("PATHAN_WRITER_LINGER", 0.2)
+MAX_RETRIES = env_int("PATHAN_WRITER_MAX_RETRIES", 8)
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60.0
+JOURNAL_COMPACT = env_int("PATHAN_WRITER_COMPACT", 1000)
+_UNKNOWN_FIELD = re.compile(r'Unknown field name: \\?"(.+?)\\?"')
+
+
+def is_retryable(exc):
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None)
+    return status == 429 or (status is not None and status >= 500)
+
+
+def unknown_field(exc):
+    # Имя поля из ответа 422 UNKNOWN_FIELD_NAME, иначе None
+    response = getattr(exc, "response", None)
+    if getattr(response, "status_code", None) != 422:
+        return None
+    try: error = response.json().get("error", {})
+    except ValueError: return None
+    if not isinstance(error, dict) or error.get("type") != "UNKNOWN_FIELD_NAME":
+        return None
+    match = _UNKNOWN_FIELD.search(error.get("message", ""))
+    return match.group(1) if match else None
+
+
+class RecordWriter:
+    def __init__(self, table, journal_path=None, on_written=None, optional_fields=()):
+        self.table = table
+        self.on_written = on_written
+        # Поля, без которых запись можно сохранить, если их нет в таблице
+        self.optional_fields = set(optional_fields)
+        self.dropped_fields = set()
+        self.journal_path = journal_path or data_path("writer_journal.jsonl")
+        self.failed_path = os.path.splitext(self.journal_path)[0] + "_failed.jsonl"
+        self._queue = queue.Queue()
+        self._journal_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        # Незавершённые записи журнала и число завершённых с последнего сжатия; под _journal_lock
+        self._open = {}
+        self._closed = 0
+        # Принятые, но ещё не записанные и не отброшенные; меняется под _stats_lock
+        self.pending = 0
+        self.written = 0
+        self.retries = 0
+        self.requeued = 0
+        self.failed = self._count_lines(self.failed_path)
+        self.last_error = None
+        replayed = self._replay()
+        self.pending = len(replayed)
+        for entry in replayed:
+            self._queue.put(entry)
+        self._thread = threading.Thread(target=self._run, name="pathan-writer", daemon=True)
+        self._thread.start()
+
+    # --- журнал ---
+    def _count_lines(self, path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                return sum(1 for _ in f)
+        except FileNotFoundError:
+            return 0
+
+    def _write_lines(self, path, mode, entries):
+        with open(path, mode, encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _append(self, path, entries):
+        with self._journal_lock:
+            self._write_lines(path, "a", entries)
+
+    def _rewrite(self):
+        # Вызывается под _journal_lock: в журнале остаются только незавершённые put
+        tmp = self.journal_path + ".tmp"
+        self._write_lines(tmp, "w", self._open.values())
+        os.replace(tmp, self.journal_path)
+        self._closed = 0
+
+    def _log(self, entries):
+        with self._journal_lock:
+            self._write_lines(self.journal_path, "a", entries)
+            for entry in entries:
+                if entry["op"] == "put":
+                    self._open[entry["id"]] = entry
+                else:
+                    for i in entry["ids"]:
+                        self._open.pop(i, None)
+                    self._closed += len(entry["ids"])
+            if self._closed >= JOURNAL_COMPACT:
+                self._rewrite()
+
+    def _replay(self):
+        pending = {}
+        try:
+            with open(self.journal_path, encoding="utf-8") as f:
+                for line in f:
+                    try: entry = json.loads(line)
+                    except ValueError: continue  # оборванная последняя строка
+                    if entry.get("op") == "put":
+                        pending[entry["id"]] = entry
+                    else:
+                        for i in entry.get("ids", []):
+                            pending.pop(i, None)
+        except FileNotFoundError:
+            return []
+        with self._journal_lock:
+            self._open = pending
+            self._rewrite()
+        return list(pending.values())
+
+    # --- публичный интерфейс ---
+    def submit_many(self, fields_list):
+        entries = [{"op": "put", "id": uuid.uuid4().hex, "fields": fields} for fields in fields_list]
+        self._log(entries)
+        with self._stats_lock:
+            self.pending += len(entries)
+        for entry in entries:
+            self._queue.put(entry)
+        return [e["id"] for e in entries]
+
+    def submit(self, fields):
+        return self.submit_many([fields])[0]
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "queued": self.pending,
+                "written": self.written,
+                "retries": self.retries,
+                "requeued": self.requeued,
+                "dropped_fields": sorted(self.dropped_fields),
+                "failed": self.failed,
+                "last_error": self.last_error,
+            }
+
+    # --- фоновый поток ---
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + BATCH_LINGER
+        while len(batch) < BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try: batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty: break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try: self._write(batch)
+            except Exception as e:
+                # Сбой самого писателя (журнал, диск): пачка остаётся в журнале и очереди
+                with self._stats_lock:
+                    self.last_error = f"{type(e).__name__}: {e}"
+                self._requeue(batch)
+                time.sleep(BACKOFF_MAX)
+
+    def _requeue(self, batch):
+        with self._stats_lock:
+            self.requeued += len(batch)
+        for entry in batch:
+            self._queue.put(entry)
+
+    def _create(self, batch):
+        # -> (созданные записи, None) или (None, исключение)
+        # В журнале остаются полные поля: после добавления колонки их можно дописать вручную
+        while True:
+            dropped = self.dropped_fields
+            started = time.perf_counter()
+            try:
+                created = self.table.batch_create([{k: v for k, v in e["fields"].items() if k not in dropped} for e in batch])
+                break
+            except Exception as e:
+                observe("airtable_write", time.perf_counter() - started, error=True)
+                with self._stats_lock:
+                    self.last_error = f"{type(e).__name__}: {e}"
+                name = unknown_field(e)
+                if name not in self.optional_fields or name in dropped:
+                    return None, e
+                with self._stats_lock:
+                    self.dropped_fields = dropped | {name}
+        observe("airtable_write", time.perf_counter() - started)
+        return created, None
+
+    def _write(self, batch):
+        for attempt in range(MAX_RETRIES + 1):
+            created, error = self._create(batch)
+            if error is None:
+                self._done(batch, created)
+                return
+            if not is_retryable(error):
+                break
+            if attempt < MAX_RETRIES:
+                with self._stats_lock:
+                    self.retries += 1
+                time.sleep(min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+        else:
+            # Airtable недоступен дольше всех попыток: записи не теряются, а ждут своей очереди снова
+            self._requeue(batch)
+            return
+        if len(batch) > 1:
+            # Ошибка 4xx относится к одной из записей: остальные пишутся без неё
+            for entry in batch:
+                self._write([entry])
+            return
+        # Неустранимая ошибка самой записи: в отдельный файл для ручного разбора
+        self._append(self.failed_path, [dict(batch[0], error=self.last_error)])
+        self._log([{"op": "fail", "ids": [batch[0]["id"]]}])
+        with self._stats_lock:
+            self.failed += 1
+            self.pending -= 1
+
+    def _done(self, batch, created):
+        self._log([{"op": "ack", "ids": [e["id"] for e in batch]}])
+        with self._stats_lock:
+            self.written += len(batch)
+            self.pending -= len(batch)
+        if self.on_written:
+            try: self.on_written(created)
+            except Exception: pass
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def record_writer(table, key, on_written=None, optional_fields=()):
+    # Один писатель на таблицу на процесс
+    with _writers_lock:
+        writer = _writers.get(key)
+        if writer is None:
+            name = "".join(c if c.isalnum() else "_" for c in key)
+            writer = RecordWriter(table, data_path(f"writer_{name}.jsonl"), on_written, optional_fields)
+            _writers[key] = writer
+        return writer
+
+
+def _writer_stat(name):
+    with _writers_lock:
+        writers = list(_writers.items())
+    return {key: w.stats()[name] for key, w in writers}
+
+
+register_gauge("pathan_write_queue_depth", "Records waiting to be written to Airtable.", lambda: _writer_stat("queued"))
+register_gauge("pathan_write_failed", "Records that could not be written to Airtable.", lambda: _writer_stat("failed"))
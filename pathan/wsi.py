@@ -0,0 +1,262 @@
+import hashlib
+import mmap
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from pathan.config import data_path, env_int
+from pathan.imaging import IMAGE_QUALITY, PreparedImage
+from pathan.metrics import span
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+# --- ЦЕЛЫЕ СЛАЙДЫ (TIFF / SVS) ---
+# Гигапиксельный слайд никогда не декодируется целиком. Файл отображается в
+# память, тайлы TIFF читаются и декодируются по одному. Обзор строится с
+# самого мелкого подходящего уровня пирамиды, по нему NumPy-порогом ищется
+# ткань, и в модель уходят обзор и несколько самых информативных полей
+# в полном разрешении. Пик памяти ограничен обзором, одним полем и
+# небольшим кэшем декодированных тайлов, а не размером слайда.
+
+WSI_SUPPORTED = tifffile is not None
+WSI_EXTENSIONS = ("tif", "tiff", "svs")
+# Сторона поля совпадает с плиткой Gemini (768x768)
+WSI_TILE = env_int("PATHAN_WSI_TILE", 768)
+WSI_TILES = env_int("PATHAN_WSI_TILES", 6)
+WSI_OVERVIEW = env_int("PATHAN_WSI_OVERVIEW", 1536)
+# Уровень пирамиды, с которого берутся поля (0 - полное разрешение)
+WSI_LEVEL = env_int("PATHAN_WSI_LEVEL", 0)
+SEGMENT_CACHE_SIZE = 16
+PREPARED_CACHE_SIZE = 4
+
+# Стекло светлое и ненасыщенное, ткань темнее и окрашена
+BACKGROUND_LEVEL = 215
+MIN_SATURATION = 18
+MIN_DARKNESS = 25
+MIN_TISSUE = 0.5
+
+
+def is_wsi(name):
+    return WSI_SUPPORTED and (name or "").lower().rsplit(".", 1)[-1] in WSI_EXTENSIONS
+
+
+def tissue_mask(rgb):
+    # rgb: (h, w, 3) uint8 -> bool (h, w)
+    lo = rgb.min(axis=2)
+    hi = rgb.max(axis=2)
+    return (lo < BACKGROUND_LEVEL) & ((hi.astype(np.int16) - lo) >= MIN_SATURATION) & (hi > MIN_DARKNESS)
+
+
+def _encode(rgb, quality=IMAGE_QUALITY):
+    im = Image.fromarray(rgb)
+    buf = BytesIO()
+    im.save(buf, format="JPEG", quality=quality, optimize=True)
+    return PreparedImage(buf.getvalue(), im.size)
+
+
+class Level:
+    def __init__(self, page):
+        if page.dtype != np.uint8 or page.shaped[0] != 1 or page.shaped[1] != 1:
+            raise ValueError("unsupported slide layout: %s %s" % (page.dtype, page.shaped))
+        self.page = page
+        self.height, self.width = page.imagelength, page.imagewidth
+        if page.is_tiled:
+            self.seg_h, self.seg_w = page.tilelength, page.tilewidth
+        else:
+            self.seg_h, self.seg_w = min(page.rowsperstrip or self.height, self.height), self.width
+        self.across = -(-self.width // self.seg_w)
+        self.down = -(-self.height // self.seg_h)
+
+
+class Slide:
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._tif = tifffile.TiffFile(path)
+        self._segments = OrderedDict()
+        series = self._tif.series[0]
+        self.levels = [Level(series.levels[0].keyframe)]
+        pages = [lvl.keyframe for lvl in series.levels[1:]]
+        if not pages:
+            # Пирамида без OME/SVS-разметки: уменьшенные копии лежат отдельными сериями
+            base = self.levels[0]
+            pages = [other.keyframe for other in self._tif.series[1:]
+                     if other.keyframe.imagewidth < base.width
+                     and abs(other.keyframe.imagelength / float(other.keyframe.imagewidth) - base.height / float(base.width)) < 0.02]
+        for page in pages:
+            try: self.levels.append(Level(page))
+            except ValueError: pass
+        self.width, self.height = self.levels[0].width, self.levels[0].height
+
+    def close(self):
+        self._segments.clear()
+        self._tif.close()
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _segment(self, level, index):
+        key = (id(level), index)
+        seg = self._segments.get(key)
+        if seg is not None:
+            self._segments.move_to_end(key)
+            return seg
+        page = level.page
+        offset, count = page.dataoffsets[index], page.databytecounts[index]
+        # Срез mmap читает с диска только байты этого тайла
+        data = self._map[offset:offset + count] if count else None
+        seg, _, shape = page.decode(data, index, jpegtables=page.jpegtables)
+        if seg is None:
+            seg = np.full((level.seg_h, level.seg_w, 3), 255, np.uint8)
+        else:
+            seg = seg.reshape(shape)[0]
+            if seg.shape[2] == 1: seg = np.repeat(seg, 3, axis=2)
+            elif seg.shape[2] > 3: seg = seg[:, :, :3]
+        self._segments[key] = seg
+        while len(self._segments) > SEGMENT_CACHE_SIZE:
+            self._segments.popitem(last=False)
+        return seg
+
+    def read_region(self, level, x, y, w, h):
+        out = np.full((h, w, 3), 255, np.uint8)
+        for row in range(y // level.seg_h, min(level.down, (y + h - 1) // level.seg_h + 1)):
+            for col in range(x // level.seg_w, min(level.across, (x + w - 1) // level.seg_w + 1)):
+                seg = self._segment(level, row * level.across + col)
+                sy, sx = row * level.seg_h, col * level.seg_w
+                y0, x0 = max(y, sy), max(x, sx)
+                y1 = min(y + h, sy + seg.shape[0], level.height)
+                x1 = min(x + w, sx + seg.shape[1], level.width)
+                if y1 > y0 and x1 > x0:
+                    out[y0 - y:y1 - y, x0 - x:x1 - x] = seg[y0 - sy:y1 - sy, x0 - sx:x1 - sx]
+        return out
+
+    def overview(self, max_side=WSI_OVERVIEW):
+        # Самый мелкий уровень, который всё ещё не меньше max_side
+        fits = [lvl for lvl in self.levels if max(lvl.width, lvl.height) >= max_side]
+        level = min(fits, key=lambda lvl: lvl.width) if fits else max(self.levels, key=lambda lvl: lvl.width)
+        # Наибольший целый шаг, после которого сторона ещё не меньше max_side; остаток
+        # (меньше чем вдвое) добирается сглаживающим уменьшением
+        step = max(1, max(level.width, level.height) // max_side)
+        out = np.full((-(-level.height // step), -(-level.width // step), 3), 255, np.uint8)
+        # Прореживание по тайлам: в памяти только обзор и текущий тайл
+        for index in range(level.across * level.down):
+            row, col = divmod(index, level.across)
+            sy, sx = row * level.seg_h, col * level.seg_w
+            seg = self._segment(level, index)
+            seg = seg[:max(0, min(seg.shape[0], level.height - sy)), :max(0, min(seg.shape[1], level.width - sx))]
+            ky, kx = -sy % step, -sx % step
+            part = seg[ky::step, kx::step]
+            oy, ox = (sy + ky) // step, (sx + kx) // step
+            out[oy:oy + part.shape[0], ox:ox + part.shape[1]] = part
+        self._segments.clear()
+        side = max(out.shape[0], out.shape[1])
+        if side > max_side:
+            size = (max(1, round(out.shape[1] * max_side / side)), max(1, round(out.shape[0] * max_side / side)))
+            out = np.asarray(Image.fromarray(out).resize(size, Image.LANCZOS))
+        return out
+
+    def pick_tiles(self, overview, count=WSI_TILES, tile=WSI_TILE, level=None):
+        level = level or self.levels[min(WSI_LEVEL, len(self.levels) - 1)]
+        cols, rows = level.width // tile, level.height // tile
+        if not cols or not rows or not count:
+            return []
+        # Сетка полей в координатах обзора: доля ткани и её текстура на каждом поле
+        sy = overview.shape[0] / float(level.height)
+        sx = overview.shape[1] / float(level.width)
+        h, w = max(rows, int(rows * tile * sy)), max(cols, int(cols * tile * sx))
+        mask = tissue_mask(overview)[:h, :w].astype(np.float32)
+        gray = overview[:h, :w].mean(axis=2, dtype=np.float32)
+
+        def cells(a):
+            return np.asarray(Image.fromarray(np.ascontiguousarray(a, np.float32)).resize((cols, rows), Image.BOX))
+
+        frac = cells(mask)
+        # Разброс яркости только по ткани, чтобы край ткани со стеклом не выигрывал
+        n = np.maximum(frac, 1e-6)
+        mean = cells(gray * mask) / n
+        std = np.sqrt(np.maximum(cells(gray * gray * mask) / n - mean ** 2, 0))
+        score = np.where(frac >= MIN_TISSUE, frac * (1.0 + std / 64.0), 0.0)
+
+        picked = []
+        order = [i for i in np.argsort(score, axis=None)[::-1] if score.flat[i] > 0]
+        # Сначала поля не соседствующие друг с другом, затем добор оставшимися
+        for spread in (2, 0):
+            for i in order:
+                if len(picked) >= count: break
+                r, c = divmod(int(i), cols)
+                if (r, c) in picked: continue
+                if all(max(abs(r - pr), abs(c - pc)) >= spread for pr, pc in picked):
+                    picked.append((r, c))
+        return [(c * tile, r * tile) for r, c in picked]
+
+
+class SlideImage(PreparedImage):
+    # Обзор ведёт себя как обычный снимок (превью, PDF, хранилище),
+    # поля уходят в модель дополнительными частями
+    def __init__(self, overview, tiles, slide_size):
+        PreparedImage.__init__(self, overview.data, overview.size)
+        self.tiles = tiles
+        self.slide_size = slide_size
+
+    def parts(self):
+        return [self.blob()] + [t.blob() for _, _, t in self.tiles]
+
+
+def _read(path):
+    with Slide(path) as slide:
+        with span("wsi_overview"):
+            ov = slide.overview()
+        with span("wsi_tiles"):
+            level = slide.levels[min(WSI_LEVEL, len(slide.levels) - 1)]
+            tiles = []
+            for x, y in slide.pick_tiles(ov, level=level):
+                tiles.append((x, y, _encode(slide.read_region(level, x, y, WSI_TILE, WSI_TILE))))
+        return SlideImage(_encode(ov), tiles, (slide.width, slide.height))
+
+
+def prepare_slide(source):
+    # source: путь к файлу, bytes или загруженный файл Streamlit
+    if isinstance(source, str):
+        return _read(source)
+    raw = source if isinstance(source, (bytes, bytearray)) else source.getbuffer()
+    # Загрузка выгружается во временный файл, чтобы читать её через mmap
+    path = data_path("wsi", uuid.uuid4().hex + ".tif")
+    try:
+        with open(path, "wb") as f:
+            f.write(raw)
+        return _read(path)
+    finally:
+        try: os.remove(path)
+        except OSError: pass
+
+
+_prepared = OrderedDict()
+_prepared_lock = threading.Lock()
+
+
+def prepare_wsi_upload(upload):
+    # Перезапуски скрипта не перечитывают слайд
+    key = getattr(upload, "file_id", None) or hashlib.sha1(upload.getbuffer()).hexdigest()
+    with _prepared_lock:
+        if key in _prepared:
+            _prepared.move_to_end(key)
+            return _prepared[key]
+    prepared = prepare_slide(upload)
+    with _prepared_lock:
+        _prepared[key] = prepared
+        while len(_prepared) > PREPARED_CACHE_SIZE:
+            _prepared.popitem(last=False)
+    return prepared
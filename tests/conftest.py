@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# Локальные данные тестов (журналы, SQLite) - во временном каталоге, не в .pathan
+os.environ.setdefault("PATHAN_DATA_DIR", tempfile.mkdtemp(prefix="pathan-tests-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
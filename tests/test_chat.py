@@ -0,0 +1,49 @@
+import re
+import threading
+from io import BytesIO
+
+import google.generativeai as genai
+from PIL import Image
+
+from bench import fakes
+from pathan.chat import BoundedChat
+from pathan.imaging import prepare_image
+from pathan.scheduler import TokenBucket, model_scheduler
+
+
+class SummaryModel(fakes.FakeGenerativeModel):
+    # Запоминает, какие ходы ушли в каждый пересказ
+    def __init__(self):
+        super().__init__()
+        self.summarized = []
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        if isinstance(contents, list) and len(contents) == 2 and isinstance(contents[1], str):
+            self.summarized.extend(re.findall(r"Врач: вопрос (\d+)", contents[1]))
+        return super().generate_content(contents, stream=stream, **kwargs)
+
+
+def test_concurrent_turns_are_compacted_once(monkeypatch):
+    monkeypatch.setattr(genai, "upload_file", fakes.fake_upload_file)
+    monkeypatch.setattr(fakes.settings, "latency", 0.02)
+    monkeypatch.setattr(fakes.settings, "output_chars", 200)
+    monkeypatch.setattr(model_scheduler(), "bucket", TokenBucket(rate_per_minute=1e9))
+    buf = BytesIO()
+    Image.new("RGB", (64, 64), "white").save(buf, format="JPEG")
+    model = SummaryModel()
+    chat = BoundedChat(model, "Анализ снимка", prepare_image(buf.getvalue()), "Норма.", budget=300, keep_turns=2)
+    answer = "Ответ. " * 40
+    threads = [threading.Thread(target=chat.record, args=(f"вопрос {i}", answer)) for i in range(40)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join(5)
+    while chat._compacting is not None:
+        chat._wait_compaction()
+    # Каждый ход либо пересказан ровно один раз, либо ещё лежит в истории
+    kept = [q.split()[1] for q, _ in chat.turns]
+    assert sorted(model.summarized + kept, key=int) == [str(i) for i in range(40)]
+    assert chat.compactions >= 1
+    assert chat.history_tokens() <= chat.budget
+    size = fakes.request_size(chat.contents("вопрос"))
+    assert size < fakes.request_size(chat.contents("вопрос")[:2]) + 4 * chat.budget * 3
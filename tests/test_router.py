@@ -0,0 +1,75 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from pathan import router as router_module
+from pathan.router import ModelRouter
+from pathan.scheduler import ModelScheduler, TokenBucket
+
+
+class Stream:
+    # Потоковый ответ: итератор с cancel(), как у gRPC/REST-потоков Gemini
+    def __init__(self, chunks, delay=0.0, fail_after=None):
+        self._chunks = chunks
+        self._delay = delay
+        self._fail_after = fail_after
+        self.cancelled = threading.Event()
+        self._iterator = self
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def __iter__(self):
+        time.sleep(self._delay)
+        for i, text in enumerate(self._chunks):
+            if self.cancelled.is_set():
+                return
+            if self._fail_after is not None and i >= self._fail_after:
+                raise RuntimeError("stream broke")
+            yield SimpleNamespace(text=text)
+
+
+class Model:
+    def __init__(self, make):
+        self.make = make
+        self.responses = []
+
+    def generate_content(self, contents, stream=False):
+        response = self.make()
+        self.responses.append(response)
+        return response
+
+
+def make_router(models, monkeypatch):
+    monkeypatch.setattr(router_module, "HEDGE_MIN_DELAY", 0.05)
+    monkeypatch.setattr(router_module, "ROUTER_EXPLORE", 0)
+    scheduler = ModelScheduler(concurrency=2, bucket=TokenBucket(rate_per_minute=1e9))
+    return ModelRouter(models=list(models), model_factory=lambda n: models[n], scheduler=scheduler)
+
+
+def stat(router, name):
+    return next(s for s in router.stats() if s["model"] == name and s["stream"])
+
+
+def test_losing_stream_is_cancelled(monkeypatch):
+    slow = Model(lambda: Stream(["a"], delay=0.01))
+    fast = Model(lambda: Stream(["b", "-rest"]))
+    router = make_router({"a": slow, "b": fast}, monkeypatch)
+    for _ in range(3):
+        "".join(c.text for c in router.generate_content("x", stream=True))
+    slow.make = lambda: Stream(["a"], delay=0.5)
+    response = router.generate_content("x", stream=True)
+    assert response.model == "b" and "".join(c.text for c in response) == "b-rest"
+    assert slow.responses[-1].cancelled.wait(2)
+    assert router.hedged == 1
+
+
+def test_mid_stream_failure_counts_as_error(monkeypatch):
+    broken = Model(lambda: Stream(["a", "b", "c"], fail_after=1))
+    router = make_router({"a": broken}, monkeypatch)
+    response = router.generate_content("x", stream=True)
+    with pytest.raises(RuntimeError):
+        "".join(c.text for c in response)
+    assert stat(router, "a")["errors"] == 1.0
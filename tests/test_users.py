@@ -0,0 +1,109 @@
+import threading
+import time
+
+from pathan import users as users_module
+from pathan.users import SessionTokens, UserDirectory, hash_password, verify_password
+
+FAST = 1000
+
+
+class FakeUsers:
+    def __init__(self, records=()):
+        self.records = {r["id"]: r for r in records}
+        self.all_calls = []
+        self.updates = []
+        self.gate = None
+
+    def all(self, fields=None, formula=None, max_records=None):
+        self.all_calls.append(formula)
+        if self.gate is not None:
+            self.gate.wait(5)
+        out = list(self.records.values())
+        if formula is not None:
+            out = [r for r in out if formula == "{Name}='%s'" % r["fields"].get("Name")]
+        return out[:max_records] if max_records else out
+
+    def get(self, record_id):
+        return self.records[record_id]
+
+    def update(self, record_id, fields):
+        self.updates.append((record_id, fields))
+        self.records[record_id]["fields"].update(fields)
+
+
+def user(record_id, name, password):
+    return {"id": record_id, "fields": {"Name": name, "Password": password, "Role": "Doctor"}}
+
+
+def test_password_round_trip():
+    stored = hash_password("s3cret", iterations=FAST)
+    assert stored.startswith("pbkdf2_sha256$1000$")
+    assert stored != hash_password("s3cret", iterations=FAST)
+    assert verify_password(stored, "s3cret")[0]
+    assert not verify_password(stored, "s3cret ")[0]
+
+
+def test_weaker_hash_is_flagged_for_upgrade(monkeypatch):
+    monkeypatch.setattr(users_module, "PASSWORD_ITERATIONS", FAST * 2)
+    assert verify_password(hash_password("pw", iterations=FAST), "pw") == (True, True)
+    assert verify_password(hash_password("pw", iterations=FAST * 2), "pw") == (True, False)
+
+
+def test_malformed_hash_never_matches():
+    for stored in ("pbkdf2_sha256$", "pbkdf2_sha256$abc$c2FsdA==$ZGln", "pbkdf2_sha256$1000$!!$ZGln",
+                   "pbkdf2_sha256$1000$c2FsdA==", "pbkdf2_sha256$1000$c2FsdA==$ZGln$extra",
+                   "pbkdf2_sha256$0$c2FsdA==$ZGln", "pbkdf2_sha256$-5$c2FsdA==$ZGln", "pbkdf2_sha256$1000$$ZGln"):
+        assert verify_password(stored, "pbkdf2_sha256") == (False, False)
+    assert verify_password("", "pw") == (False, False)
+    assert verify_password(None, "pw") == (False, False)
+
+
+def test_plaintext_password_is_upgraded_on_login(monkeypatch):
+    monkeypatch.setattr(users_module, "PASSWORD_ITERATIONS", FAST)
+    table = FakeUsers([user("rec1", "ivanov", "old-plain")])
+    directory = UserDirectory(table)
+    assert directory.authenticate("ivanov", "wrong") is None
+    assert directory.authenticate("ivanov", "old-plain")["id"] == "rec1"
+    deadline = time.time() + 5
+    while not table.updates and time.time() < deadline:
+        time.sleep(0.01)
+    (record_id, fields), = table.updates
+    assert record_id == "rec1" and fields["Password"].startswith("pbkdf2_sha256$")
+    # Следующий вход идёт по хэшу и запись больше не переписывается
+    assert directory.authenticate("ivanov", "old-plain")["id"] == "rec1"
+    time.sleep(0.05)
+    assert len(table.updates) == 1
+
+
+def test_session_token_expires(tmp_path):
+    tokens = SessionTokens(str(tmp_path / "sessions.sqlite"), ttl=0.2)
+    token = tokens.issue("rec1")
+    assert tokens.resolve(token) == "rec1"
+    # Копия на диске переживает перезапуск
+    assert SessionTokens(str(tmp_path / "sessions.sqlite"), ttl=0.2).resolve(token) == "rec1"
+    time.sleep(0.3)
+    assert tokens.resolve(token) is None
+    assert SessionTokens(str(tmp_path / "sessions.sqlite")).resolve(token) is None
+    assert tokens.resolve("not-a-token") is None
+
+
+def test_unknown_name_is_fetched_once_and_cached_as_missing():
+    table = FakeUsers([user("rec1", "ivanov", "pw")])
+    directory = UserDirectory(table, negative_ttl=60)
+    directory.records()
+    table.all_calls.clear()
+    table.gate = threading.Event()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(directory.by_name("ghost"))) for _ in range(8)]
+    for th in threads:
+        th.start()
+    time.sleep(0.1)
+    table.gate.set()
+    for th in threads:
+        th.join(5)
+    assert results == [None] * 8
+    assert table.all_calls == ["{Name}='ghost'"]
+    # Отрицательная запись отвечает без Airtable, пока не истечёт
+    assert directory.by_name("ghost") is None
+    assert len(table.all_calls) == 1
+    assert directory.stats()["negative_hits"] >= 1
@@ -0,0 +1,155 @@
+import json
+import threading
+import time
+
+import requests
+
+from pathan import writer as writer_module
+from pathan.writer import RecordWriter
+
+
+class FakeTable:
+    def __init__(self, fail=None):
+        self.fail = fail or (lambda fields_list: None)
+        self.created = []
+        self.calls = 0
+        self._ids = 0
+
+    def batch_create(self, fields_list):
+        self.calls += 1
+        error = self.fail(fields_list)
+        if error is not None:
+            raise error
+        out = []
+        for fields in fields_list:
+            self._ids += 1
+            out.append({"id": f"rec{self._ids}", "createdTime": "", "fields": fields})
+        self.created.extend(out)
+        return out
+
+
+def http_error(status, body=None):
+    response = requests.Response()
+    response.status_code = status
+    response._content = json.dumps(body or {}).encode("utf-8")
+    return requests.HTTPError(f"{status} Client Error", response=response)
+
+
+def wait_idle(writer, timeout=5.0):
+    deadline = time.time() + timeout
+    while writer.stats()["queued"] and time.time() < deadline:
+        time.sleep(0.01)
+    assert writer.stats()["queued"] == 0
+
+
+def read_journal(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_replay_writes_only_unacknowledged(tmp_path):
+    journal = tmp_path / "journal.jsonl"
+    entries = [
+        {"op": "put", "id": "a", "fields": {"Patient Name": "A"}},
+        {"op": "put", "id": "b", "fields": {"Patient Name": "B"}},
+        {"op": "ack", "ids": ["a"]},
+        {"op": "put", "id": "c", "fields": {"Patient Name": "C"}},
+    ]
+    journal.write_text("\n".join(json.dumps(e) for e in entries) + "\n{\"op\": \"pu", encoding="utf-8")
+    table = FakeTable()
+    writer = RecordWriter(table, str(journal))
+    wait_idle(writer)
+    assert sorted(r["fields"]["Patient Name"] for r in table.created) == ["B", "C"]
+    # После записи в журнале не остаётся незавершённых put
+    replayed = RecordWriter(FakeTable(), str(journal))._replay()
+    assert replayed == []
+
+
+def test_bad_record_does_not_fail_its_batch(tmp_path):
+    def fail(fields_list):
+        if any(f.get("bad") for f in fields_list):
+            return http_error(422, {"error": {"type": "INVALID_VALUE_FOR_COLUMN"}})
+    table = FakeTable(fail)
+    writer = RecordWriter(table, str(tmp_path / "journal.jsonl"))
+    writer.submit_many([{"n": 1}, {"n": 2, "bad": True}, {"n": 3}])
+    wait_idle(writer)
+    assert sorted(r["fields"]["n"] for r in table.created) == [1, 3]
+    stats = writer.stats()
+    assert stats["written"] == 2 and stats["failed"] == 1
+    failed = read_journal(writer.failed_path)
+    assert [e["fields"]["n"] for e in failed] == [2]
+
+
+def test_outage_longer_than_retries_keeps_records(tmp_path, monkeypatch):
+    monkeypatch.setattr(writer_module, "MAX_RETRIES", 1)
+    monkeypatch.setattr(writer_module, "BACKOFF_BASE", 0.001)
+    outage = {"left": 5}
+
+    def fail(fields_list):
+        if outage["left"]:
+            outage["left"] -= 1
+            return requests.ConnectionError("down")
+    table = FakeTable(fail)
+    writer = RecordWriter(table, str(tmp_path / "journal.jsonl"))
+    writer.submit({"n": 1})
+    wait_idle(writer)
+    stats = writer.stats()
+    assert stats["written"] == 1 and stats["failed"] == 0 and stats["requeued"] >= 1
+    assert not any(e.get("op") == "fail" for e in read_journal(writer.journal_path))
+
+
+def test_queued_counts_records_being_batched(tmp_path):
+    release = threading.Event()
+
+    def fail(fields_list):
+        release.wait(5)
+    writer = RecordWriter(FakeTable(fail), str(tmp_path / "journal.jsonl"))
+    writer.submit_many([{"n": i} for i in range(5)])
+    # И во время ожидания пачки, и во время записи все пять ещё не записаны
+    for _ in range(20):
+        assert writer.stats()["queued"] == 5
+        time.sleep(0.02)
+    release.set()
+    wait_idle(writer)
+    assert writer.stats()["written"] == 5
+
+
+def test_unknown_optional_field_is_dropped(tmp_path):
+    def fail(fields_list):
+        if any("Image pHash" in f for f in fields_list):
+            return http_error(422, {"error": {"type": "UNKNOWN_FIELD_NAME", "message": 'Unknown field name: "Image pHash"'}})
+    table = FakeTable(fail)
+    writer = RecordWriter(table, str(tmp_path / "journal.jsonl"), optional_fields=("Image pHash",))
+    writer.submit_many([{"n": 1, "Image pHash": "00ff"}, {"n": 2, "Image pHash": "ff00"}])
+    wait_idle(writer)
+    assert sorted(r["fields"]["n"] for r in table.created) == [1, 2]
+    assert writer.stats()["failed"] == 0 and writer.stats()["dropped_fields"] == ["Image pHash"]
+
+
+def test_unknown_required_field_still_fails(tmp_path):
+    def fail(fields_list):
+        return http_error(422, {"error": {"type": "UNKNOWN_FIELD_NAME", "message": 'Unknown field name: "Patient Name"'}})
+    writer = RecordWriter(FakeTable(fail), str(tmp_path / "journal.jsonl"), optional_fields=("Image pHash",))
+    writer.submit({"Patient Name": "A"})
+    wait_idle(writer)
+    assert writer.stats()["failed"] == 1
+
+
+def test_journal_is_compacted_while_running(tmp_path, monkeypatch):
+    monkeypatch.setattr(writer_module, "JOURNAL_COMPACT", 3)
+    slots = threading.Semaphore(0)
+    table = FakeTable(lambda fields_list: slots.acquire(timeout=5) and None)
+    writer = RecordWriter(table, str(tmp_path / "journal.jsonl"))
+    writer.submit_many([{"n": n} for n in range(3)])
+    deadline = time.time() + 5
+    while not table.calls and time.time() < deadline:
+        time.sleep(0.01)
+    # Первая пачка уже в Airtable, вторая ждёт в очереди
+    writer.submit_many([{"n": 3}, {"n": 4}])
+    slots.release()
+    while writer.stats()["written"] < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    assert [e["fields"]["n"] for e in read_journal(writer.journal_path)] == [3, 4]
+    slots.release()
+    wait_idle(writer)
+    assert RecordWriter(FakeTable(), writer.journal_path)._replay() == []